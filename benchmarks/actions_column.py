@@ -0,0 +1,87 @@
+"""
+Measure the time ActionsColumn takes to render the action links of a large table.
+
+Renders the actions of N stages (three links each, as on a project's stage list) with the way ActionsColumn used
+to do it, reversing every link of every row, and with the URL templates it reverses once. No database is needed.
+
+    python benchmarks/actions_column.py [rows] [repeats]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'fabric_bolt.core.settings.test')
+
+from django.conf.urls import include, patterns, url
+from django.core import urlresolvers
+from django.utils.html import mark_safe
+
+from fabric_bolt.core.mixins.tables import A, AttributeDict
+from fabric_bolt.projects.tables import StageTable
+
+
+# Just the project URLs: the full URLconf runs the admin's autodiscovery, which needs a database
+urlpatterns = patterns('', url(r'^projects/', include('fabric_bolt.projects.urls')))
+
+
+class Stage(object):
+
+    def __init__(self, pk):
+        self.pk = pk
+        self.project_id = pk // 10 + 1
+
+
+def reversing_render(column, record):
+    """ActionsColumn.render as it was: reverse and build the attributes for every link of every row"""
+
+    links = []
+
+    for link in column.links:
+        title = link['title']
+        url = link['url']
+        attrs = link['attrs'] if 'attrs' in link else None
+
+        if 'args' in link:
+            args = [a.resolve(record) if isinstance(a, A) else a for a in link['args']]
+        else:
+            args = None
+
+        attrs = AttributeDict(attrs if attrs is not None else column.attrs.get('a', {}))
+
+        try:
+            attrs['href'] = urlresolvers.reverse(url, args=args)
+        except urlresolvers.NoReverseMatch:
+            attrs['href'] = url
+
+        links.append('<a {attrs}>{text}</a>'.format(
+            attrs=attrs.as_html(),
+            text=mark_safe(title)
+        ))
+
+    return mark_safe(column.delimiter.join(links))
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    urlresolvers.set_urlconf(__name__)
+
+    records = [Stage(pk) for pk in range(1, rows + 1)]
+    column = StageTable.base_columns['actions']
+
+    renderers = (
+        ('reverse per link', lambda record: reversing_render(column, record)),
+        ('url templates', lambda record: column.render(None, record, None)),
+    )
+
+    for name, render in renderers:
+        seconds = min(timeit.repeat(lambda: [render(record) for record in records], number=1, repeat=repeats))
+        print('{:<17} {} rows: {:.2f} ms per table ({:.1f} us per row)'.format(
+            name, rows, seconds * 1000, seconds * 1000000 / rows))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Measure the CPU cost of streaming deployment output over the socket.io path.
+
+Starts N fake deployments that each print a line every half second and reads their output with the old
+non-blocking spin loop (one thread per deployment) and with the gevent reader used by ChatNamespace. Prints the CPU
+seconds burned by this process per deployment for each reader.
+
+    python benchmarks/socket_output_reader.py [deployments] [seconds]
+"""
+
+import fcntl
+import os
+import subprocess
+import sys
+import time
+from threading import Thread
+
+import gevent
+from gevent import subprocess as gevent_subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fabric_bolt.projects.output import iter_process_output
+
+
+def child_command(seconds):
+    script = 'import sys, time\nfor x in range(%d):\n    print("line %%d" %% x)\n    sys.stdout.flush()\n    time.sleep(0.5)\n'
+    return [sys.executable, '-c', script % (seconds * 2)]
+
+
+def spin_reader(process):
+    """The reader ChatNamespace used before: a non-blocking read in a tight loop"""
+    fd = process.stdout.fileno()
+    fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+
+    while True:
+        try:
+            nextline = process.stdout.read()
+        except IOError:
+            nextline = ''
+
+        if nextline == '' and process.poll() is not None:
+            break
+
+        time.sleep(0.00001)
+
+
+def gevent_reader(process):
+    for chunk in iter_process_output(process):
+        pass
+
+    process.wait()
+
+
+def cpu_seconds():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def run_spin(deployments, seconds):
+    processes = [subprocess.Popen(child_command(seconds), stdout=subprocess.PIPE) for x in range(deployments)]
+    threads = [Thread(target=spin_reader, args=(process,)) for process in processes]
+
+    start = cpu_seconds()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return cpu_seconds() - start
+
+
+def run_gevent(deployments, seconds):
+    processes = [gevent_subprocess.Popen(child_command(seconds), stdout=subprocess.PIPE) for x in range(deployments)]
+
+    start = cpu_seconds()
+    gevent.joinall([gevent.spawn(gevent_reader, process) for process in processes])
+
+    return cpu_seconds() - start
+
+
+def main():
+    deployments = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    for name, runner in (('spin loop', run_spin), ('gevent reader', run_gevent)):
+        used = runner(deployments, seconds)
+        print('{:<14} {:>3} deployments for {}s: {:.3f} CPU seconds ({:.4f} per deployment per second)'.format(
+            name, deployments, seconds, used, used / deployments / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+from django.contrib.auth.middleware import get_user
+from django.utils.functional import SimpleLazyObject
+
+
+def get_session_user(request):
+    user = get_user(request)
+    if user.pk:
+        # Where DeployUser.get_group_names keeps the user's groups between requests
+        user._session = request.session
+    return user
+
+
+class GroupMembershipMiddleware(object):
+    """
+    Hands the session to the logged in user so its group names are kept there. Goes after AuthenticationMiddleware.
+    """
+
+    def process_request(self, request):
+        request.user = SimpleLazyObject(lambda: get_session_user(request))
@@ -7,13 +7,19 @@ import urllib
 import hashlib
 
 from django.db import models
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save, pre_delete
+from django.dispatch import receiver
 from django.conf import settings
+from django.contrib.auth.models import Group
 from django.templatetags.static import static
 from django.utils.translation import ugettext_lazy as _
 
 from custom_user.models import AbstractEmailUser
 from custom_user.models import EmailUserManager
 
+from fabric_bolt.accounts.permissions import load_group_names
+
 
 class UserManager(EmailUserManager):
     def get_query_set(self):
@@ -58,12 +64,24 @@ class DeployUser(AbstractEmailUser):
     last_name = models.CharField(_('last name'), max_length=30, blank=True)
     template = models.CharField(max_length=255, blank=True, choices=TEMPLATES, default=YETI)
 
+    # Goes up whenever the user's groups (or whether they're active) change; see accounts.permissions
+    groups_version = models.PositiveIntegerField(default=0, editable=False)
+
     #objects = UserManager() # I don't think its a good idea to always prefetch the groups. T
                              # hat's an extra query every single time. We don't always need the groups.
 
     def __unicode__(self):
         return u'{} {}'.format(self.first_name, self.last_name)
 
+    def save(self, *args, **kwargs):
+        # groups_version is only ever moved forward by bump_groups_version; an instance loaded before a bump must not
+        # write its older value back
+        if not self._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name != 'groups_version']
+
+        super(DeployUser, self).save(*args, **kwargs)
+
     @property
     def role(self):
         """
@@ -71,31 +89,35 @@ class DeployUser(AbstractEmailUser):
         """
         return self.group_strigify()
 
-    def _get_groups(self):
+    def get_group_names(self):
+        """
+        The names of the user's groups, looked up once per instance (so once per request for request.user) and kept
+        in the session when GroupMembershipMiddleware handed it over
+        """
         if not hasattr(self, '_cached_groups'):
-            self._cached_groups = self.groups.values_list("name", flat=True)
+            self._cached_groups = load_group_names(self, getattr(self, '_session', None))
         return self._cached_groups
 
     def user_is_admin(self):
         if not self.pk:
             return False
-        return "Admin" in self._get_groups()
+        return "Admin" in self.get_group_names()
 
     def user_is_deployer(self):
         if not self.pk:
             return False
-        return "Deployer" in self._get_groups()
+        return "Deployer" in self.get_group_names()
 
     def user_is_historian(self):
         if not self.pk:
             return False
-        return "Historian" in self._get_groups()
+        return "Historian" in self.get_group_names()
 
     def group_strigify(self):
         """
         Converts this user's group(s) to a string and returns it.
         """
-        return "/".join([group.name for group in self.groups.all()])
+        return "/".join(self.get_group_names())
 
     def gravatar(self, size=20):
         """
@@ -106,4 +128,70 @@ class DeployUser(AbstractEmailUser):
         gravatar_url = "http://www.gravatar.com/avatar/" + hashlib.md5(self.email.lower()).hexdigest() + "?"
         gravatar_url += urllib.urlencode({'d': default, 's': str(size)})
 
-        return gravatar_url
\ No newline at end of file
+        return gravatar_url
+
+
+@receiver(post_save, sender=DeployUser)
+@receiver(post_delete, sender=DeployUser)
+def invalidate_sidebar_users(sender, instance, update_fields=None, **kwargs):
+    # Every login saves last_login, which the sidebar doesn't show
+    if update_fields and set(update_fields) == set(['last_login']):
+        return
+
+    from fabric_bolt.core.sidebar import invalidate_sidebar_lists
+    invalidate_sidebar_lists()
+
+
+def bump_groups_version(user_ids):
+    """Make the sessions of these users look their groups up again"""
+
+    if user_ids:
+        DeployUser.objects.filter(pk__in=list(user_ids)).update(groups_version=F('groups_version') + 1)
+
+
+@receiver(m2m_changed, sender=DeployUser.groups.through)
+def invalidate_group_names(sender, instance, action, reverse, pk_set=None, **kwargs):
+    if isinstance(instance, DeployUser):
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            bump_groups_version([instance.pk])
+            instance.groups_version += 1
+            instance.__dict__.pop('_cached_groups', None)
+
+    elif action == 'pre_clear':
+        # Who was in the group is gone by post_clear
+        instance._cleared_user_ids = list(instance.user_set.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        bump_groups_version(instance.__dict__.pop('_cleared_user_ids', ()))
+    elif action in ('post_add', 'post_remove'):
+        bump_groups_version(pk_set)
+
+
+@receiver(post_save, sender=Group)
+def invalidate_group_members(sender, instance, created, **kwargs):
+    if not created:
+        bump_groups_version(instance.user_set.values_list('pk', flat=True))
+
+
+@receiver(pre_delete, sender=Group)
+def remember_group_members(sender, instance, **kwargs):
+    instance._deleted_user_ids = list(instance.user_set.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Group)
+def invalidate_deleted_group_members(sender, instance, **kwargs):
+    bump_groups_version(instance.__dict__.pop('_deleted_user_ids', ()))
+
+
+@receiver(post_init, sender=DeployUser)
+def remember_is_active(sender, instance, **kwargs):
+    instance._loaded_is_active = instance.is_active
+
+
+@receiver(post_save, sender=DeployUser)
+def invalidate_activation(sender, instance, created, **kwargs):
+    if not created and instance.is_active != instance._loaded_is_active:
+        bump_groups_version([instance.pk])
+        instance.groups_version += 1
+        instance.__dict__.pop('_cached_groups', None)
+
+    instance._loaded_is_active = instance.is_active
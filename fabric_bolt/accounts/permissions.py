@@ -0,0 +1,26 @@
+"""
+The names of a user's groups, which every permission check comes down to.
+
+They are looked up once per request (``DeployUser.get_group_names``) and, with GroupMembershipMiddleware, kept in
+the session along with the user's ``groups_version``. That counter is stored on the user's row and goes up whenever
+their groups change, they're activated or deactivated, or one of their groups is renamed or deleted. Every process
+reads the same row, so a session holding an older version looks the groups up again whichever worker serves it.
+"""
+
+
+GROUPS_SESSION_KEY = '_group_names'
+
+
+def load_group_names(user, session=None):
+    """The names of ``user``'s groups, from ``session`` if it has them for the user's current groups version"""
+
+    if session is None:
+        return list(user.groups.values_list('name', flat=True))
+
+    cached = session.get(GROUPS_SESSION_KEY)
+    if cached and cached['version'] == user.groups_version and cached['user'] == user.pk:
+        return cached['names']
+
+    names = list(user.groups.values_list('name', flat=True))
+    session[GROUPS_SESSION_KEY] = {'version': user.groups_version, 'user': user.pk, 'names': names}
+    return names
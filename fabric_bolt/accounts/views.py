@@ -15,6 +15,7 @@ from django_tables2 import SingleTableView
 
 from fabric_bolt.core.mixins.views import MultipleGroupRequiredMixin
 from fabric_bolt.accounts import forms, tables
+from fabric_bolt.projects.models import Deployment
 
 
 class UserPermissions(TemplateView):
@@ -151,6 +152,17 @@ class UserAdd(MultipleGroupRequiredMixin, CreateView):
 class UserDetail(DetailView):
     model = auth.get_user_model()
 
+    # Deployments listed under Recent Deployments
+    recent_deployments_limit = 10
+
+    def get_context_data(self, **kwargs):
+        context = super(UserDetail, self).get_context_data(**kwargs)
+
+        context['recent_deployments'] = Deployment.objects.lightweight().filter(user=self.object)\
+            .select_related('stage__project', 'task').order_by('-date_created', '-pk')[:self.recent_deployments_limit]
+
+        return context
+
 
 # Admin Delete User
 class UserDelete(MultipleGroupRequiredMixin, DeleteView):
@@ -1,13 +1,71 @@
 from __future__ import absolute_import, unicode_literals
 
-from django.core.paginator import Paginator
+from django.conf import settings
+from django.core.paginator import InvalidPage, Paginator
 from django.core import urlresolvers
 from django.utils.html import mark_safe, escape
 
 import django_tables2 as tables
+from django_tables2.rows import BoundRows
 from django_tables2.tables import Table
 from django_tables2.utils import Accessor as A, AttributeDict
 
+from fabric_bolt.core.paginator import KeysetPaginator
+
+
+# Reversed ActionsColumn URLs with placeholders where the arguments go, see get_url_template
+_url_templates = {}
+
+# Stands in for the n-th argument while reversing; digits, so it matches the usual pk patterns
+URL_ARG_MARKER = '7305918264{:03d}'
+
+
+def get_url_template(url, arg_count):
+    """
+    A format string for the URL named ``url`` taking ``arg_count`` arguments, reversed once: ``{0}``, ``{1}``...
+    stand where the arguments go. None when the URL can't be reversed with numbers for arguments.
+    """
+
+    key = (settings.ROOT_URLCONF, urlresolvers.get_urlconf(), urlresolvers.get_script_prefix(), url, arg_count)
+    if key not in _url_templates:
+        markers = [URL_ARG_MARKER.format(index) for index in range(arg_count)]
+        try:
+            template = urlresolvers.reverse(url, args=markers).replace('{', '{{').replace('}', '}}')
+        except urlresolvers.NoReverseMatch:
+            template = None
+        else:
+            for index, marker in enumerate(markers):
+                if template.count(marker) != 1:
+                    template = None
+                    break
+                template = template.replace(marker, '{%d}' % index)
+
+        _url_templates[key] = template
+
+    return _url_templates[key]
+
+
+def reverse_link(url, args):
+    """
+    ``urlresolvers.reverse``, for the links of ActionsColumn: falls back to ``url`` itself when it isn't the name of
+    a URL. Links whose arguments are all numbers (pks, mostly) are filled into a template reversed only once.
+    """
+
+    if args is None:
+        args = []
+
+    numbers = all((isinstance(arg, (int, long)) and not isinstance(arg, bool)) or
+                  (isinstance(arg, basestring) and arg.isdigit()) for arg in args)
+    if numbers:
+        template = get_url_template(url, len(args))
+        if template is not None:
+            return template.format(*args)
+
+    try:
+        return urlresolvers.reverse(url, args=args or None)
+    except urlresolvers.NoReverseMatch:
+        return url
+
 
 class ActionsColumn(tables.Column):
     """
@@ -24,45 +82,66 @@ class ActionsColumn(tables.Column):
         if links is not None:
             self.links = links
 
-    def render(self, value, record, bound_column):
-        if not self.links:
-            raise NotImplementedError('Links not assigned.')
-        if not isinstance(self.links, (list, tuple,dict)):
-            raise NotImplementedError('Links must be an iterable.')
+    def get_compiled_links(self):
+        """(link, HTML of its attributes other than href) for each link, worked out on the first render"""
 
-        links = []
+        if getattr(self, '_compiled_links', None) is None:
+            if not self.links:
+                raise NotImplementedError('Links not assigned.')
+            if not isinstance(self.links, (list, tuple,dict)):
+                raise NotImplementedError('Links must be an iterable.')
+
+            compiled_links = []
+            for link in self.links:
+                attrs = link['attrs'] if 'attrs' in link else None
+                attrs = AttributeDict(attrs if attrs is not None else self.attrs.get('a', {}))
+                attrs.pop('href', None)
+                compiled_links.append((link, attrs.as_html()))
 
-        for link in self.links:
-            title = link['title']
-            url = link['url']
-            attrs = link['attrs'] if 'attrs' in link else None
+            self._compiled_links = compiled_links
 
+        return self._compiled_links
+
+    def render(self, value, record, bound_column):
+        links = []
+
+        for link, attrs in self.get_compiled_links():
             if 'args' in link:
                 args = [a.resolve(record) if isinstance(a, A) else a for a in link['args']]
             else:
                 args = None
 
-            attrs = AttributeDict(attrs if attrs is not None else self.attrs.get('a', {}))
-
-            try:
-                attrs['href'] = urlresolvers.reverse(url, args=args)
-            except urlresolvers.NoReverseMatch:
-                attrs['href'] = url
-
-            links.append('<a {attrs}>{text}</a>'.format(
-                attrs=attrs.as_html(),
-                text=mark_safe(title)
+            links.append('<a href="{href}" {attrs}>{text}</a>'.format(
+                href=escape(reverse_link(link['url'], args)),
+                attrs=attrs,
+                text=mark_safe(link['title'])
             ))
 
         return mark_safe(self.delimiter.join(links))
 
 
+class RequestConfig(tables.RequestConfig):
+    """django_tables2's RequestConfig, which also hands tables their keyset pagination cursor"""
+
+    def configure(self, table):
+        table.cursor = self.request.GET.get((table.prefix or '') + 'cursor')
+        super(RequestConfig, self).configure(table)
+
+
 class PaginateTable(Table):
-    """Generic table class that makes use of Django's built in paginate functionality"""
+    """Generic table class that makes use of Django's built in paginate functionality
+
+    Tables with a ``keyset_ordering`` page through their queryset with a KeysetPaginator while they are in that
+    ordering: every page takes the same time to fetch, however deep, and the total is an estimate. Sorted by one of
+    their columns they go back to numbered pages."""
+
+    keyset_ordering = None
 
     def __init__(self, *args, **kwargs):
         super(PaginateTable, self).__init__(*args, **kwargs)
         self.template = kwargs.get('template', 'fancy_paged_tables/table.html')
+        self.cursor = None
+        self.keyset = False
 
     def paginate(self, klass=Paginator, per_page=None, page=1, *args, **kwargs):
         """
@@ -86,6 +165,16 @@ class PaginateTable(Table):
         self.per_page_options = [20, 50, 100, 200]  # This should probably be a passed in option
         self.per_page = per_page = per_page or self._meta.per_page
 
+        if self.keyset_ordering and not self.order_by and hasattr(self.data, 'queryset'):
+            self.keyset = True
+            self.paginator = KeysetPaginator(self.data.queryset, per_page, self.keyset_ordering)
+            try:
+                self.page = self.paginator.page(self.cursor)
+            except InvalidPage:
+                self.page = self.paginator.page()
+            self.page.object_list = BoundRows(self.page.object_list, self)
+            return
+
         self.paginator = klass(self.rows, per_page, *args, **kwargs)
         self.page = self.paginator.page(page)
 
@@ -1,4 +1,4 @@
-
+from django.conf import settings
 from django.contrib import messages
 
 from braces.views import GroupRequiredMixin
@@ -8,7 +8,7 @@ class MultipleGroupRequiredMixin(GroupRequiredMixin):
 
     def check_membership(self, group):
         """ Check required group(s) """
-        user_groups = self.request.user.groups.values_list("name", flat=True)
+        user_groups = self.request.user.get_group_names()
         if isinstance(group, (list, tuple)):
             for req_group in group:
                 if req_group in user_groups:
@@ -18,4 +18,52 @@ class MultipleGroupRequiredMixin(GroupRequiredMixin):
         if not is_member:
             messages.add_message(self.request, messages.ERROR, 'You do not have sufficient permissions to do that.')
 
-        return is_member
\ No newline at end of file
+        return is_member
+
+
+def lazy_context(func):
+    """
+    A context value worked out the first time a template uses it (templates call callables), so one only used inside
+    a cached fragment costs nothing while the fragment is cached
+    """
+
+    values = []
+
+    def get_value():
+        if not values:
+            values.append(func())
+        return values[0]
+
+    return get_value
+
+
+class FragmentCacheMixin(object):
+    """
+    Gives a detail page's template what it needs to cache its tables as fragments::
+
+        {% cache fragment_cache_timeout deployments fragment_cache_key %}{% render_table deployment_table %}{% endcache %}
+
+    The key changes with the object, get_fragment_generation(), the user's groups and the query string, which holds
+    the tables' sorting and paging. It is the whole query string because the pagination links carry every table's
+    parameters.
+    Put the tables in the context with lazy_context so they are only built when their fragment isn't cached.
+    """
+
+    def get_fragment_generation(self):
+        """
+        A stamp that changes whenever anything in the cached fragments does. Subclasses must override it: only they
+        know what their page shows, such as the project generation for the project and stage pages.
+        """
+
+        raise NotImplementedError('{} must define get_fragment_generation()'.format(self.__class__.__name__))
+
+    def get_fragment_cache_key(self):
+        return u'{}.{}:{}:{}:{!r}'.format(self.object._meta.model_name, self.object.pk, self.get_fragment_generation(),
+                                          u'/'.join(sorted(self.request.user.get_group_names())),
+                                          sorted(self.request.GET.lists()))
+
+    def get_context_data(self, **kwargs):
+        context = super(FragmentCacheMixin, self).get_context_data(**kwargs)
+        context['fragment_cache_key'] = self.get_fragment_cache_key()
+        context['fragment_cache_timeout'] = getattr(settings, 'PROJECT_FRAGMENT_CACHE_TIMEOUT', 60 * 60)
+        return context
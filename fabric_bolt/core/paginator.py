@@ -0,0 +1,176 @@
+"""
+Keyset pagination for long, append-mostly lists such as deployment history.
+
+Instead of counting every row and skipping ``OFFSET`` rows to reach a page, each page is fetched with a ``WHERE``
+on the ordering columns of the row the previous page ended at, so every page costs the same however deep it is. A
+page is identified by an opaque cursor rather than a number, and the total is an estimate: the query planner's on
+PostgreSQL, a cached count elsewhere.
+"""
+
+import base64
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import InvalidPage
+from django.db import connections
+from django.db.models import Q
+
+
+def estimate_count(queryset):
+    """
+    The number of rows a queryset returns, roughly. Returns (count, approximate).
+
+    PostgreSQL's planner estimate is used when it is at least KEYSET_PAGINATOR_EXACT_COUNT_BELOW; below that the rows
+    are counted. Other databases count and keep the count in the cache for KEYSET_PAGINATOR_COUNT_CACHE_TIMEOUT
+    seconds.
+    """
+
+    queryset = queryset.order_by()
+    connection = connections[queryset.db]
+
+    # Which columns are selected makes no difference to the count
+    sql, params = queryset.values_list('pk').query.sql_with_params()
+
+    if connection.vendor == 'postgresql':
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+
+        estimate = int(plan[0]['Plan']['Plan Rows'])
+        if estimate >= getattr(settings, 'KEYSET_PAGINATOR_EXACT_COUNT_BELOW', 1000):
+            return estimate, True
+        return queryset.count(), False
+
+    key = 'estimated_count:{}'.format(hashlib.md5(repr((sql, params))).hexdigest())
+    count = cache.get(key)
+    if count is not None:
+        return count, True
+
+    count = queryset.count()
+    cache.set(key, count, getattr(settings, 'KEYSET_PAGINATOR_COUNT_CACHE_TIMEOUT', 300))
+    return count, False
+
+
+class KeysetPage(object):
+
+    def __init__(self, object_list, paginator, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return '<Page of {} items>'.format(len(self))
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator(object):
+    """
+    Pages through a queryset in ``ordering``, which has to end with a unique field (the default is newest first).
+
+    ``page(cursor)`` returns the page a cursor points to, the first page without one. Cursors are opaque strings
+    made from the ordering values of the row next to the page, so pages stay put as rows are added.
+    """
+
+    def __init__(self, queryset, per_page, ordering=('-date_created', '-pk')):
+        self.per_page = int(per_page)
+        self.ordering = ordering
+        self.queryset = queryset.order_by(*ordering)
+
+        opts = queryset.model._meta
+        self.fields = [opts.pk if name.lstrip('-') == 'pk' else opts.get_field(name.lstrip('-')) for name in ordering]
+        self.descending = [name.startswith('-') for name in ordering]
+
+    @property
+    def count(self):
+        return self.estimated_count[0]
+
+    @property
+    def count_is_approximate(self):
+        return self.estimated_count[1]
+
+    @property
+    def estimated_count(self):
+        if not hasattr(self, '_estimated_count'):
+            self._estimated_count = estimate_count(self.queryset)
+        return self._estimated_count
+
+    def encode_cursor(self, direction, record):
+        values = []
+        for field in self.fields:
+            value = getattr(record, field.attname)
+            values.append(value.isoformat() if hasattr(value, 'isoformat') else value)
+
+        return base64.urlsafe_b64encode(json.dumps([direction] + values)).rstrip('=')
+
+    def decode_cursor(self, cursor):
+        """Return (direction, values) of a cursor. Raises InvalidPage if it isn't one of ours."""
+
+        try:
+            data = json.loads(base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)))
+            direction, values = data[0], data[1:]
+            if direction not in ('next', 'previous') or len(values) != len(self.fields):
+                raise ValueError(cursor)
+            return direction, [field.to_python(value) for field, value in zip(self.fields, values)]
+        except Exception:
+            raise InvalidPage('That page is not valid')
+
+    def get_keyset_filter(self, values, backwards=False):
+        """Rows after ``values`` in the ordering, or before them going ``backwards``"""
+
+        keyset_filter = None
+        for index, field in enumerate(self.fields):
+            lookup = 'lt' if self.descending[index] != backwards else 'gt'
+            condition = Q(**{'{}__{}'.format(field.name, lookup): values[index]})
+            for previous, value in zip(self.fields[:index], values):
+                condition &= Q(**{previous.name: value})
+            keyset_filter = condition if keyset_filter is None else keyset_filter | condition
+
+        return keyset_filter
+
+    def page(self, cursor=None):
+        direction, values = self.decode_cursor(cursor) if cursor else (None, None)
+
+        if direction is None:
+            rows = list(self.queryset[:self.per_page + 1])
+            has_next, has_previous = len(rows) > self.per_page, False
+            rows = rows[:self.per_page]
+        elif direction == 'next':
+            rows = list(self.queryset.filter(self.get_keyset_filter(values))[:self.per_page + 1])
+            has_next, has_previous = len(rows) > self.per_page, True
+            rows = rows[:self.per_page]
+        else:
+            reverse_ordering = [name[1:] if name.startswith('-') else '-' + name for name in self.ordering]
+            rows = list(self.queryset.filter(self.get_keyset_filter(values, backwards=True))
+                        .order_by(*reverse_ordering)[:self.per_page + 1])
+            has_next, has_previous = True, len(rows) > self.per_page
+            rows = rows[:self.per_page][::-1]
+
+        if not rows and direction is not None:
+            # Everything past the cursor is gone; start over
+            return self.page()
+
+        return KeysetPage(rows, self,
+                          next_cursor=self.encode_cursor('next', rows[-1]) if has_next else None,
+                          previous_cursor=self.encode_cursor('previous', rows[0]) if has_previous else None)
@@ -106,6 +106,84 @@ STATICFILES_FINDERS = (
 
 SOCKETIO_ENABLED = False
 
+# Base URL of the standalone deployment gateway (manage.py rundeploymentgateway), e.g. 'http://example.com:8001'.
+# When set, deployment pages stream their output from the gateway instead of the web workers.
+DEPLOYMENT_GATEWAY_URL = None
+
+# Origins (scheme://host[:port]) of the pages allowed to use the gateway besides its own, e.g. the web interface's
+# 'http://example.com'. The gateway acts with the user's session cookie, so requests from any other site are refused.
+DEPLOYMENT_GATEWAY_ALLOWED_ORIGINS = ()
+
+# Every live output watcher gets a bounded queue. When a watcher falls further behind than these limits the policy
+# decides what happens: 'coalesce' merges queued output, 'skip' jumps to the live tail, 'disconnect' drops the watcher.
+DEPLOYMENT_SUBSCRIBER_POLICY = 'skip'
+DEPLOYMENT_SUBSCRIBER_MAX_EVENTS = 200
+DEPLOYMENT_SUBSCRIBER_MAX_BYTES = 256 * 1024
+
+# Running deployments publish their live output to a memory-mapped ring buffer file in this directory, so any worker
+# process on the host can stream it. The newest DEPLOYMENT_RELAY_CAPACITY bytes are kept per deployment.
+DEPLOYMENT_RELAY_DIR = os.path.join(PUBLIC_DIR, '.deployment_relay')
+DEPLOYMENT_RELAY_CAPACITY = 1024 * 1024
+
+# Deployment output is kept from the start and from the end of a run, up to these many bytes each (stages can override
+# them); whatever is in between is dropped with a marker. Live output is streamed at no more than
+# DEPLOYMENT_OUTPUT_RATE_LIMIT bytes per second, None for no limit; anything over it only ends up in the saved log.
+DEPLOYMENT_OUTPUT_HEAD_SIZE = 2 * 1024 * 1024
+DEPLOYMENT_OUTPUT_TAIL_SIZE = 2 * 1024 * 1024
+DEPLOYMENT_OUTPUT_RATE_LIMIT = 256 * 1024
+
+# Seconds a stage's resolved configurations stay in the cache. Saving or deleting a configuration or stage moves their
+# version in the database, which every process checks, so they're dropped everywhere right away; this only bounds how
+# long a change made behind the ORM's back (a raw update) can go unnoticed.
+STAGE_CONFIGURATIONS_CACHE_TIMEOUT = 60 * 60 * 24
+
+# How fab gets a deployment's hosts and configurations: 'file' writes them to a private file in
+# DEPLOYMENT_ENVIRONMENT_DIR (None for a directory in the system temp dir) that is removed as soon as fab has read it;
+# 'command_line' passes them as --hosts and --set arguments, which shows them in ps and breaks on very large stages.
+DEPLOYMENT_CONFIG_DELIVERY = 'file'
+DEPLOYMENT_ENVIRONMENT_DIR = None
+
+# Carries live deployment events between web nodes, so a deployment can be watched from any of them. The memory broker
+# only reaches the current process; use fabric_bolt.projects.brokers.postgres.PostgresBroker (LISTEN/NOTIFY on the
+# default database) or fabric_bolt.projects.brokers.tcp.TCPBroker (manage.py runeventbroker) for more than one node.
+# runeventbroker listens on 127.0.0.1 by default and has no authentication: whoever can reach it can read every
+# deployment's output and inject events, so only bind it to a private interface the web nodes alone can reach.
+DEPLOYMENT_EVENT_BROKER = 'fabric_bolt.projects.brokers.memory.MemoryBroker'
+DEPLOYMENT_EVENT_BROKER_OPTIONS = {}
+
+# Days of launch window openings worked out ahead of time (see fabric_bolt.launch_window.schedule). The schedule is
+# built again halfway through, so a launch window opening further away than this is not found.
+LAUNCH_WINDOW_HORIZON_DAYS = 14
+
+# Scheduled deployments are run by manage.py rundeploymentscheduler, which sleeps until the next one is due. It
+# releases at most DEPLOYMENT_SCHEDULER_BATCH_SIZE at once, DEPLOYMENT_SCHEDULER_BATCH_INTERVAL seconds apart. New
+# schedules wake it through the event broker; with the memory broker (which can't reach it) it picks them up within
+# DEPLOYMENT_SCHEDULER_RECHECK_INTERVAL seconds.
+DEPLOYMENT_SCHEDULER_BATCH_SIZE = 20
+DEPLOYMENT_SCHEDULER_BATCH_INTERVAL = 1
+DEPLOYMENT_SCHEDULER_RECHECK_INTERVAL = 300
+
+# The sidebar shows the first SIDEBAR_LIST_LIMIT projects, hosts and users, kept in the cache for
+# SIDEBAR_CACHE_TIMEOUT seconds or until one of them changes. With SIDEBAR_AJAX it is loaded after the page, as a
+# fragment the browser caches.
+SIDEBAR_LIST_LIMIT = 50
+SIDEBAR_CACHE_TIMEOUT = 60 * 60
+SIDEBAR_AJAX = False
+
+# The tables on the project and stage pages are cached as template fragments for PROJECT_FRAGMENT_CACHE_TIMEOUT
+# seconds, or until something on the project changes
+PROJECT_FRAGMENT_CACHE_TIMEOUT = 60 * 60
+
+# Tables paged with a cursor (deployment history) show an estimate of their total: PostgreSQL's query planner's when
+# it is at least KEYSET_PAGINATOR_EXACT_COUNT_BELOW rows, otherwise a count cached for
+# KEYSET_PAGINATOR_COUNT_CACHE_TIMEOUT seconds
+KEYSET_PAGINATOR_EXACT_COUNT_BELOW = 1000
+KEYSET_PAGINATOR_COUNT_CACHE_TIMEOUT = 300
+
+# A deployment schedule that fires more than this many seconds late missed its run (the scheduler was down); its
+# misfire policy decides whether that run still happens
+DEPLOYMENT_SCHEDULE_MISFIRE_GRACE_TIME = 60
+
 ########## TEMPLATE CONFIGURATION
 GRAPPELLI_ADMIN_TITLE = 'Admin'
 
@@ -142,6 +220,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'fabric_bolt.accounts.middleware.GroupMembershipMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'stronghold.middleware.LoginRequiredMiddleware',
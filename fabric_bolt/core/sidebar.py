@@ -0,0 +1,106 @@
+"""
+The lists of projects, hosts and users in the sidebar.
+
+They are kept in the cache until a project, host or user is saved or deleted, which gives them a new version in the
+database (a CacheVersion) so every process drops its copy, and only loaded when a template shows them. Each list holds the first SIDEBAR_LIST_LIMIT items and the total, so a page costs the same however big the
+inventory gets. With SIDEBAR_AJAX the sidebar is a fragment of its own, loaded after the page and cached by the
+browser until the lists change.
+"""
+
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth import get_user_model
+from django.utils.functional import cached_property
+
+from fabric_bolt.hosts.models import Host
+from fabric_bolt.projects.models import CacheVersion, Project
+
+
+SIDEBAR_VERSION_NAME = 'sidebar_lists'
+
+
+class SidebarItem(object):
+
+    def __init__(self, pk, name):
+        self.pk = pk
+        self.name = name
+
+    def __unicode__(self):
+        return self.name
+
+
+class SidebarList(object):
+    """The first few items of a list (pk and name) and how many there are in all"""
+
+    def __init__(self, items, total):
+        self.items = [SidebarItem(pk, name) for pk, name in items]
+        self.total = total
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def more(self):
+        return self.total - len(self.items)
+
+
+def load_sidebar_lists():
+    limit = getattr(settings, 'SIDEBAR_LIST_LIMIT', 50)
+
+    lists = {}
+    for name, queryset in (('projects', Project.active_records.all()), ('hosts', Host.objects.all()),
+                           ('users', get_user_model().objects.all())):
+        items = [(item.pk, unicode(item)) for item in queryset[:limit]]
+        total = len(items) if len(items) < limit else queryset.count()
+        lists[name] = (items, total)
+
+    # Changes whenever the lists do, for the fragment's ETag
+    lists['version'] = hashlib.md5(repr(sorted(lists.items()))).hexdigest()
+
+    return lists
+
+
+def get_sidebar_lists():
+    key = 'sidebar_lists.{}'.format(CacheVersion.get(SIDEBAR_VERSION_NAME))
+
+    lists = cache.get(key)
+    if lists is None:
+        lists = load_sidebar_lists()
+        cache.set(key, lists, getattr(settings, 'SIDEBAR_CACHE_TIMEOUT', 60 * 60))
+    return lists
+
+
+def invalidate_sidebar_lists():
+    CacheVersion.bump([SIDEBAR_VERSION_NAME])
+
+
+class Sidebar(object):
+    """What templates see as ``sidebar``: the lists are fetched the first time one is used"""
+
+    def __init__(self):
+        self.ajax = getattr(settings, 'SIDEBAR_AJAX', False)
+
+    @cached_property
+    def lists(self):
+        return get_sidebar_lists()
+
+    @cached_property
+    def projects(self):
+        return SidebarList(*self.lists['projects'])
+
+    @cached_property
+    def hosts(self):
+        return SidebarList(*self.lists['hosts'])
+
+    @cached_property
+    def users(self):
+        return SidebarList(*self.lists['users'])
+
+    @property
+    def version(self):
+        return self.lists['version']
@@ -15,6 +15,7 @@ urlpatterns = patterns('',
     url(r'^admin/', include(admin.site.urls)),
     url(r'^', include('fabric_bolt.accounts.urls')),
     url(r'^$', views.Dashboard.as_view(), name='index'),
+    url(r'^sidebar/$', views.SidebarFragment.as_view(), name='sidebar'),
     url(r'^hosts/', include('fabric_bolt.hosts.urls')),
     url(r'^launch-window/', include('fabric_bolt.launch_window.urls')),
     url(r'^projects/', include('fabric_bolt.projects.urls')),
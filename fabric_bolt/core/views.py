@@ -1,17 +1,17 @@
+import hashlib
 import json
-from datetime import timedelta
-
-from django.db import connection
-from django.db.models.aggregates import Count
+from django.db.models.aggregates import Sum
 from django.contrib import messages
-from django.utils.timezone import now
+from django.utils.decorators import method_decorator
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.views.generic import TemplateView
 from django.template.defaultfilters import date as format_date
 from django.template.defaultfilters import time as format_time
-from croniter import croniter
 
-from fabric_bolt.launch_window.models import LaunchWindow
-from fabric_bolt.projects.models import Project, Deployment
+from fabric_bolt.core.sidebar import get_sidebar_lists
+from fabric_bolt.launch_window.schedule import get_launch_window_status
+from fabric_bolt.projects.models import Project, Deployment, DeploymentDailyStat
 
 
 class Dashboard(TemplateView):
@@ -22,22 +22,17 @@ class Dashboard(TemplateView):
         context = super(Dashboard, self).get_context_data(**kwargs)
 
         # Warn the user if we don't have an available Launch Window
-        has_one_window = False
-        next_window = None
-        for window in LaunchWindow.objects.all():  # put this back once the migrations are created
-            current_date = now()
-            next_window = croniter(window.cron_format, current_date).get_next(current_date)
-            if (next_window - current_date).seconds < 61:
-                has_one_window = True
-                continue
-
-        if not has_one_window:
-            messages.add_message(self.request, messages.ERROR,
-                'No available Launch Windows! Next window on %s @ %s' % (format_date(next_window), format_time(next_window)))
-
-        # Get the deployments and projects and bail if we don't have any
-        deploys = list(Deployment.objects.order_by('date_created'))
-        if len(deploys) == 0:
+        launch_window_status = get_launch_window_status()
+        if not launch_window_status['open']:
+            next_window = launch_window_status['next_open']
+            if next_window:
+                messages.add_message(self.request, messages.ERROR,
+                    'No available Launch Windows! Next window on %s @ %s' % (format_date(next_window), format_time(next_window)))
+            else:
+                messages.add_message(self.request, messages.ERROR, 'No available Launch Windows!')
+
+        # Bail if we don't have any deployments or projects
+        if not Deployment.objects.exists():
             return context
 
         projects = list(Project.active_records.all())
@@ -45,95 +40,60 @@ class Dashboard(TemplateView):
             return context
 
         # Deployment Stats Data
-        # Build pie chart data to show % projects deployed successfully
-        items = [[item['status'], item['count']] for item in Deployment.objects.order_by('status').values('status').annotate(count=Count('id'))]
+        # Build pie chart data to show % projects deployed successfully, leaving out deployments that haven't run yet
+        stats = DeploymentDailyStat.objects.exclude(status=Deployment.SCHEDULED).order_by('status').values('status')\
+            .annotate(count=Sum('count'))
+        items = [[item['status'], item['count']] for item in stats if item['count']]
         context['pie_chart_data'] = json.dumps(items)
 
         # Deployment History Data
-        # Get all projects with the days they were deployed and the count of the deploys on each day
-        chart_data = []
-
-        # If we're using postgres do this with one query, otherwise pound the db with the ORM.
-        if connection.vendor == 'postgresql':
-            # I couldn't figure out how to do this in the ORM with a Group By... here's a postgres version.
-            # If you're smarter than me, and can fix this, please do.
-            cursor = connection.cursor()
-            cursor.execute("""
-            SELECT project.name as project_name
-            , date_trunc('day', deployment.date_created) as deploy_date
-            , COUNT(date_trunc('day', deployment.date_created)) as deploy_count
-            FROM "projects_project" as project
-            LEFT JOIN "projects_stage" as stage ON ( project."id" = stage."project_id" )
-            LEFT JOIN "projects_deployment" as deployment ON ( stage."id" = deployment."stage_id" )
-            GROUP BY project.name, date_trunc('day', deployment.date_created)
-            ORDER BY date_trunc('day', deployment.date_created), project.name
-            """)
-
-            rows = cursor.fetchall()
-
-            # Get a distinct list of projects from our results
-            project_names = []
-            previous_project = ''
-            for row in rows:
-                if row[0] == previous_project:
-                    continue
-                previous_project = row[0]
-                project_names.append(row[0])
-
-            # Convert the sql results into a dictionary indexed by project and date (this makes the next step easier)
-            project_deployment_data = {}
-            for project in project_names:
-                project_deployment_data[project] = {}
-                for row in rows:
-                    if project == row[0] and row[1] is not None:
-                        project_deployment_data[project][row[1].strftime('%m/%d')] = row[2]
-
-            # Build the google chart data using the project and date dictionary
-            # We need an array for each day that has the deployment counts for each project
-            deploy_day = None
-            for row in rows:
-                # If we have a project w/ no deployments, keep going
-                if row[1] is None:
-                    continue
-
-                # If we already processed this day, keep going
-                if row[1] == deploy_day:
-                    continue
-
-                # Process this day for each project
-                deploy_day = row[1].strftime('%m/%d')
-                daily_counts = [deploy_day]
-                for project in project_names:
-                    daily_counts.append(project_deployment_data[project].get(deploy_day, 0))
-
-                chart_data.append(daily_counts)
-
-            chart_data = [['Day'] + project_names] + chart_data
-
-        else:
-            # Get the date range for all the deployments ever done
-            start_date = deploys[0].date_created
-            end_date = deploys[len(deploys)-1].date_created
-
-            # Step through each day and create an array of deployment counts from each project
-            for day in range(-1, (end_date.date() - start_date.date()).days + 1):
-                date = start_date + timedelta(days=day)
-                if day == -1:
-                    data = ['Day']
-                else:
-                    data = [date.strftime('%m/%d')]
-
-                for project in projects:
-                    if day == -1:
-                        data.append(project.name)
-                        continue
-
-                    range_ = (date.date(), date.date() + timedelta(days=1))
-                    # Nested ORM Call... not good.
-                    data.append(Deployment.objects.select_related('stage').filter(stage__project_id=project.pk, date_created__range=range_).count())
-
-                chart_data.append(data)
-
-        context['chart_data'] = json.dumps(chart_data)
-
-        return context
\ No newline at end of file
+        # The number of deployments of each project on each day, one column per project
+        context['chart_data'] = json.dumps(self.get_chart_data(projects))
+
+        return context
+
+    def get_chart_data(self, projects):
+        """
+        Lay the daily deployment stats out as the rows of the history chart: ['Day', project names...] then one row
+        per day with deployments, holding the number of deployments of each project that day.
+        """
+
+        counts = DeploymentDailyStat.objects.values('project_id', 'day').annotate(count=Sum('count')).order_by('day')
+
+        columns = dict((project.pk, index) for index, project in enumerate(projects, 1))
+
+        chart_data = [['Day'] + [project.name for project in projects]]
+        row = row_day = None
+        for item in counts:
+            column = columns.get(item['project_id'])
+            if column is None or not item['count']:
+                continue
+
+            if row is None or item['day'] != row_day:
+                row_day = item['day']
+                row = [row_day.strftime('%m/%d')] + [0] * len(projects)
+                chart_data.append(row)
+
+            row[column] += item['count']
+
+        return chart_data
+
+
+def get_sidebar_etag(request):
+    # What the user may see depends on their groups as well as the lists
+    user = request.user
+    return hashlib.md5('{}:{}:{}:{}'.format(get_sidebar_lists()['version'], user.pk, user.user_is_historian(),
+                                            user.user_is_admin())).hexdigest()
+
+
+class SidebarFragment(TemplateView):
+    """
+    The sidebar on its own, loaded after the page with SIDEBAR_AJAX. Browsers keep it and ask again with its ETag,
+    which stays the same until the lists change.
+    """
+    template_name = 'sidebar.html'
+
+    @method_decorator(cache_control(private=True, max_age=0))
+    @method_decorator(condition(etag_func=get_sidebar_etag))
+    def dispatch(self, request, *args, **kwargs):
+        return super(SidebarFragment, self).dispatch(request, *args, **kwargs)
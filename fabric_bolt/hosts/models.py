@@ -1,6 +1,8 @@
 import re
 
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.core.validators import URLValidator
 
 
@@ -21,3 +23,10 @@ class Host(models.Model):
 
     def __unicode__(self):
         return self.name
+
+
+@receiver(post_save, sender=Host)
+@receiver(post_delete, sender=Host)
+def invalidate_sidebar_hosts(sender, instance, **kwargs):
+    from fabric_bolt.core.sidebar import invalidate_sidebar_lists
+    invalidate_sidebar_lists()
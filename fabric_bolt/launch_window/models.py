@@ -1,5 +1,6 @@
-
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 
 
 class LaunchWindow(models.Model):
@@ -9,4 +10,11 @@ class LaunchWindow(models.Model):
     cron_format = models.CharField(max_length=255, blank=True, null=True)  # '* 09-17 * * 1-4': 9AM-5PM Mon-Thurs.
 
     def __unicode__(self):
-        return self.name
\ No newline at end of file
+        return self.name
+
+
+@receiver(post_save, sender=LaunchWindow)
+@receiver(post_delete, sender=LaunchWindow)
+def invalidate_launch_window_schedule(sender, instance, **kwargs):
+    from fabric_bolt.launch_window.schedule import invalidate_launch_window_schedule
+    invalidate_launch_window_schedule()
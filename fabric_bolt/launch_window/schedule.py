@@ -0,0 +1,250 @@
+"""
+When deployments are allowed, worked out ahead of time.
+
+A launch window is open during every minute its cron format matches. The schedule expands all the windows into
+open intervals over the next LAUNCH_WINDOW_HORIZON_DAYS days, merged into one sorted list, so whether deploying is
+allowed at some moment (and when the next window opens) is a binary search. Windows are expanded into one bit per
+minute of the horizon, which makes merging hundreds of them cheap. The schedule is cached until it needs
+extending or a launch window changes, and the answer for "now" is cached until the next time it changes.
+"""
+
+import logging
+import re
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from croniter import croniter
+
+from fabric_bolt.launch_window.models import LaunchWindow
+
+
+logger = logging.getLogger(__name__)
+
+SCHEDULE_CACHE_KEY = 'launch_window_schedule'
+STATUS_CACHE_KEY = 'launch_window_status'
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def _allowed(values, low, high):
+    if values[0] == '*':
+        return set(range(low, high + 1))
+    return set(values)
+
+
+def _minute_runs(minutes):
+    """Turn a set of minutes into (first, last + 1) runs of consecutive minutes"""
+
+    runs = []
+    for minute in sorted(minutes):
+        if runs and runs[-1][1] == minute:
+            runs[-1][1] = minute + 1
+        else:
+            runs.append([minute, minute + 1])
+    return runs
+
+
+def get_window_mask(cron_format, first_day, days):
+    """
+    The minutes a cron format matches over ``days`` days from midnight of ``first_day``, as the bits of an int:
+    bit n is set when the window is open during minute n.
+    """
+
+    midnight = datetime(first_day.year, first_day.month, first_day.day)
+
+    expanded = croniter(cron_format, midnight).expanded
+    if len(expanded) != 5:
+        return _step_window_mask(cron_format, midnight, days)
+
+    minutes = _allowed(expanded[0], 0, 59)
+    hours = _allowed(expanded[1], 0, 23)
+    days_of_month = _allowed(expanded[2], 1, 31)
+    months = _allowed(expanded[3], 1, 12)
+    days_of_week = set(day % 7 for day in _allowed(expanded[4], 0, 6))
+
+    # Like cron, a day matches either of day of month and day of week when both are given
+    either_day = expanded[2][0] != '*' and expanded[4][0] != '*'
+
+    hour_mask = 0
+    for first, last in _minute_runs(minutes):
+        hour_mask |= ((1 << (last - first)) - 1) << first
+
+    day_mask = 0
+    for hour in hours:
+        day_mask |= hour_mask << (hour * 60)
+
+    mask = 0
+    for index in range(days):
+        day = first_day + timedelta(days=index)
+        day_of_month = day.day in days_of_month
+        day_of_week = day.isoweekday() % 7 in days_of_week
+
+        if day.month in months and ((day_of_month or day_of_week) if either_day else (day_of_month and day_of_week)):
+            mask |= day_mask << (index * MINUTES_PER_DAY)
+
+    return mask
+
+
+def _step_window_mask(cron_format, midnight, days):
+    # Formats croniter expands differently (with seconds, say): walk through the matches one at a time. croniter can
+    # only localize its results with pytz, so this works on naive times.
+    mask = 0
+    matches = croniter(cron_format, midnight - timedelta(minutes=1))
+    while True:
+        minute = int((matches.get_next(datetime) - midnight).total_seconds() // 60)
+        if minute >= days * MINUTES_PER_DAY:
+            break
+        mask |= 1 << minute
+    return mask
+
+
+def get_mask_intervals(mask, start, end):
+    """The (open, close) intervals of a mask of minutes from midnight of ``start``, clipped to start and end"""
+
+    midnight = datetime(start.year, start.month, start.day, tzinfo=start.tzinfo)
+
+    intervals = []
+    for run in re.finditer('1+', bin(mask)[:1:-1]):
+        opens = max(midnight + timedelta(minutes=run.start()), start)
+        closes = min(midnight + timedelta(minutes=run.end()), end)
+        if opens < closes:
+            intervals.append((opens, closes))
+
+    return intervals
+
+
+def get_window_intervals(cron_format, start, end):
+    """The (open, close) intervals of a cron format between start and end, in order"""
+
+    days = (end.date() - start.date()).days + 1
+    return get_mask_intervals(get_window_mask(cron_format, start.date(), days), start, end)
+
+
+class LaunchWindowSchedule(object):
+    """Open intervals of all launch windows between ``start`` and ``end``, merged and sorted"""
+
+    def __init__(self, intervals, start, end, window_count=None):
+        self.start = start
+        self.end = end
+        self.window_count = len(intervals) if window_count is None else window_count
+
+        self.opens = []
+        self.closes = []
+        for opens, closes in sorted(intervals):
+            if self.closes and opens <= self.closes[-1]:
+                self.closes[-1] = max(self.closes[-1], closes)
+            else:
+                self.opens.append(opens)
+                self.closes.append(closes)
+
+    @classmethod
+    def build(cls, windows, start, days=None):
+        days = days or getattr(settings, 'LAUNCH_WINDOW_HORIZON_DAYS', 14)
+        end = start + timedelta(days=days)
+
+        # One bit per minute, so any number of windows comes down to or-ing ints together
+        mask = 0
+        window_count = 0
+        for window in windows:
+            if not window.cron_format:
+                continue
+            try:
+                mask |= get_window_mask(window.cron_format, start.date(), days + 1)
+            except Exception:
+                logger.exception('Launch window %s has an invalid cron format: %s', window.pk, window.cron_format)
+            else:
+                window_count += 1
+
+        return cls(get_mask_intervals(mask, start, end), start, end, window_count)
+
+    @property
+    def refresh_at(self):
+        # Build it again halfway, so there is always at least half the horizon ahead
+        return self.start + (self.end - self.start) / 2
+
+    def covers(self, at):
+        return self.start <= at < self.end
+
+    def get_interval(self, at):
+        """The (open, close) interval ``at`` falls in, or None while no window is open"""
+
+        index = bisect_right(self.opens, at) - 1
+        if index >= 0 and at < self.closes[index]:
+            return self.opens[index], self.closes[index]
+        return None
+
+    def is_open(self, at):
+        return self.get_interval(at) is not None
+
+    def get_next_open(self, at):
+        """When the next window opens after ``at``, or None if none opens within the schedule"""
+
+        index = bisect_right(self.opens, at)
+        if index < len(self.opens):
+            return self.opens[index]
+        return None
+
+    def get_open_time(self, at):
+        """
+        The first moment from ``at`` on that deploying is allowed: ``at`` itself while a window is open, or when the
+        next one opens. None if that is beyond the schedule. Without any launch windows deploying is always allowed.
+        """
+
+        if not self.window_count or self.is_open(at):
+            return at
+        return self.get_next_open(at)
+
+    def get_status(self, at):
+        """
+        Whether a window is open at ``at``, when it closes, when the next one opens and until when all of that
+        holds (the next boundary, or the end of the schedule).
+        """
+
+        interval = self.get_interval(at)
+        next_open = self.get_next_open(at)
+
+        if interval:
+            until = interval[1]
+        else:
+            until = next_open or self.end
+
+        return {
+            'open': interval is not None,
+            'closes': interval[1] if interval and interval[1] < self.end else None,
+            'next_open': next_open,
+            'until': min(until, self.end),
+        }
+
+
+def get_launch_window_schedule(at=None):
+    """The cached schedule, built again once ``at`` gets past the first half of it"""
+
+    at = at or timezone.now()
+
+    schedule = cache.get(SCHEDULE_CACHE_KEY)
+    if schedule is None or not schedule.covers(at) or at >= schedule.refresh_at:
+        schedule = LaunchWindowSchedule.build(LaunchWindow.objects.all(), at.replace(second=0, microsecond=0))
+        cache.set(SCHEDULE_CACHE_KEY, schedule, int((schedule.refresh_at - at).total_seconds()) + 1)
+
+    return schedule
+
+
+def get_launch_window_status(at=None):
+    """``LaunchWindowSchedule.get_status`` for now (or ``at``), cached until it changes"""
+
+    at = at or timezone.now()
+
+    status = cache.get(STATUS_CACHE_KEY)
+    if status is None or not status['checked'] <= at < status['until']:
+        status = get_launch_window_schedule(at).get_status(at)
+        status['checked'] = at
+        cache.set(STATUS_CACHE_KEY, status, max(int((status['until'] - at).total_seconds()), 1))
+
+    return status
+
+
+def invalidate_launch_window_schedule():
+    cache.delete_many([SCHEDULE_CACHE_KEY, STATUS_CACHE_KEY])
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+from fabric_bolt.launch_window.models import LaunchWindow
+from fabric_bolt.launch_window.schedule import LaunchWindowSchedule, get_launch_window_status, get_window_intervals
+
+
+class LaunchWindowScheduleTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+        # A Monday
+        self.start = datetime(2014, 3, 3, 8, 30, tzinfo=timezone.utc)
+
+    def test_window_intervals(self):
+        intervals = get_window_intervals('* 09-17 * * 1-4', self.start, self.start + timedelta(days=7))
+
+        # 09:00 to 18:00 Monday to Thursday
+        self.assertEqual(len(intervals), 4)
+        self.assertEqual(intervals[0], (datetime(2014, 3, 3, 9, tzinfo=timezone.utc), datetime(2014, 3, 3, 18, tzinfo=timezone.utc)))
+        self.assertEqual(intervals[-1][0], datetime(2014, 3, 6, 9, tzinfo=timezone.utc))
+
+        # Clipped to the start and end
+        intervals = get_window_intervals('* * * * *', self.start, self.start + timedelta(hours=1))
+        self.assertEqual(intervals, [(self.start, self.start + timedelta(hours=1))])
+
+    def test_schedule_status(self):
+        windows = [LaunchWindow(cron_format='* 09-17 * * 1-4'), LaunchWindow(cron_format='0-29 20 * * *')]
+        schedule = LaunchWindowSchedule.build(windows, self.start, days=7)
+
+        status = schedule.get_status(self.start)
+        self.assertFalse(status['open'])
+        self.assertEqual(status['next_open'], datetime(2014, 3, 3, 9, tzinfo=timezone.utc))
+        self.assertEqual(status['until'], status['next_open'])
+
+        status = schedule.get_status(datetime(2014, 3, 3, 20, 10, tzinfo=timezone.utc))
+        self.assertTrue(status['open'])
+        self.assertEqual(status['closes'], datetime(2014, 3, 3, 20, 30, tzinfo=timezone.utc))
+
+        # Friday evening, then nothing until Monday morning
+        status = schedule.get_status(datetime(2014, 3, 7, 21, tzinfo=timezone.utc))
+        self.assertEqual(status['next_open'], datetime(2014, 3, 8, 20, tzinfo=timezone.utc))
+
+    def test_status_is_cached_until_it_changes(self):
+        LaunchWindow.objects.create(name='Working hours', description='', cron_format='* 09-17 * * 1-4')
+
+        with self.assertNumQueries(1):
+            self.assertFalse(get_launch_window_status(self.start)['open'])
+            self.assertFalse(get_launch_window_status(self.start + timedelta(minutes=10))['open'])
+            self.assertTrue(get_launch_window_status(self.start + timedelta(minutes=30))['open'])
+
+        # Changing a launch window throws the schedule away
+        LaunchWindow.objects.update(cron_format='* * * * *')
+        LaunchWindow.objects.get().save()
+        self.assertTrue(get_launch_window_status(self.start)['open'])
+
+    def test_status_api(self):
+        password = 'mypassword'
+        user = get_user_model().objects.create_superuser('myemail@test.com', password)
+        self.client.login(email=user.email, password=password)
+
+        LaunchWindow.objects.create(name='Always', description='', cron_format='* * * * *')
+
+        result = self.client.get(reverse('launch_window_launchwindow_status'))
+        self.assertEqual(result['Content-Type'], 'application/json')
+        self.assertContains(result, '"open": true')
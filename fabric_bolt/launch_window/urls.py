@@ -5,6 +5,7 @@ from fabric_bolt.launch_window import views
 
 urlpatterns = patterns('',
     url(r'^list/$', views.LaunchWindowList.as_view(), name='launch_window_launchwindow_list'),
+    url(r'^status/$', views.LaunchWindowStatus.as_view(), name='launch_window_launchwindow_status'),
     url(r'^(?P<pk>\d+)/', views.LaunchWindowDetail.as_view(), name='launch_window_launchwindow_detail'),
     url(r'^create/$', views.LaunchWindowCreate.as_view(), name='launch_window_launchwindow_create'),
     url(r'^update/(?P<pk>\d+)/', views.LaunchWindowUpdate.as_view(), name='launch_window_launchwindow_update'),
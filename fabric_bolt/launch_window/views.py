@@ -1,3 +1,7 @@
+import json
+
+from django.http import HttpResponse
+from django.views.generic import View
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
 from django.views.generic.detail import DetailView
 from django.core.urlresolvers import reverse_lazy, reverse
@@ -6,6 +10,7 @@ from django_tables2.views import SingleTableView
 
 from fabric_bolt.core.mixins.views import MultipleGroupRequiredMixin
 from fabric_bolt.launch_window import models, tables, forms
+from fabric_bolt.launch_window.schedule import get_launch_window_status
 
 
 class LaunchWindowList(MultipleGroupRequiredMixin, SingleTableView):
@@ -66,4 +71,24 @@ class LaunchWindowDelete(MultipleGroupRequiredMixin, DeleteView):
 
     def delete(self, request, *args, **kwargs):
         messages.success(self.request, 'Launch Window {} Successfully Deleted'.format(self.get_object()))
-        return super(LaunchWindowDelete, self).delete(self, request, *args, **kwargs)
\ No newline at end of file
+        return super(LaunchWindowDelete, self).delete(self, request, *args, **kwargs)
+
+
+class LaunchWindowStatus(View):
+    """
+    JSON: is a launch window open now, when does it close and when does the next one open
+    """
+
+    def get(self, request, *args, **kwargs):
+        status = get_launch_window_status()
+
+        def isoformat(date):
+            return date.isoformat() if date else None
+
+        data = {
+            'open': status['open'],
+            'closes': isoformat(status['closes']),
+            'next_open': isoformat(status['next_open']),
+        }
+
+        return HttpResponse(json.dumps(data), content_type='application/json')
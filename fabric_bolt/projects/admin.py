@@ -11,9 +11,22 @@ class DeploymentModelAdmin(admin.ModelAdmin):
     list_display = ['stage', 'status', 'date_created', 'task']
 
 
+class DeploymentScheduleModelAdmin(admin.ModelAdmin):
+    list_display = ['stage', 'task_name', 'cron_format', 'enabled', 'next_fire_at', 'last_fired_at']
+    readonly_fields = ['next_fire_at', 'last_fired_at']
+
+
+class DeploymentHostModelAdmin(admin.ModelAdmin):
+    list_display = ['deployment', 'host', 'status', 'first_seen', 'last_seen']
+
+
 admin.site.register(models.Project)
 admin.site.register(models.ProjectType)
 admin.site.register(models.Configuration, ConfigurationModelAdmin)
+admin.site.register(models.ConfigurationSnapshot)
 admin.site.register(models.Stage)
 admin.site.register(models.Deployment, DeploymentModelAdmin)
+admin.site.register(models.DeploymentHost, DeploymentHostModelAdmin)
+admin.site.register(models.DeploymentPlan)
+admin.site.register(models.DeploymentSchedule, DeploymentScheduleModelAdmin)
 admin.site.register(models.Task)
\ No newline at end of file
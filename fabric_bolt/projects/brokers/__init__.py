@@ -0,0 +1,31 @@
+"""
+Pub/sub brokers that carry deployment events between processes and hosts.
+
+The broker is chosen with the DEPLOYMENT_EVENT_BROKER setting (a dotted path to a broker class) and configured with
+DEPLOYMENT_EVENT_BROKER_OPTIONS, which are passed to its constructor. One broker instance is shared per process.
+"""
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+
+_broker = None
+
+
+def load_broker(path, options=None):
+    module_name, class_name = path.rsplit('.', 1)
+    broker_class = getattr(import_module(module_name), class_name)
+
+    return broker_class(**(options or {}))
+
+
+def get_broker():
+    global _broker
+
+    if _broker is None:
+        _broker = load_broker(
+            getattr(settings, 'DEPLOYMENT_EVENT_BROKER', 'fabric_bolt.projects.brokers.memory.MemoryBroker'),
+            getattr(settings, 'DEPLOYMENT_EVENT_BROKER_OPTIONS', {}),
+        )
+
+    return _broker
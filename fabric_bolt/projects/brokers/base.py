@@ -0,0 +1,107 @@
+import json
+
+from fabric_bolt.projects.streaming import Subscriber
+
+
+def get_character_boundary(data, index):
+    """The nearest position at or before ``index`` that isn't inside a UTF-8 character of ``data``"""
+
+    for _ in range(3):
+        if index <= 0 or (ord(data[index]) & 0xC0) != 0x80:
+            break
+        index -= 1
+
+    return index
+
+
+def split_event(event, max_size=None):
+    """
+    Return the event ready to be sent as JSON, as several events if its JSON would be longer than ``max_size`` bytes.
+
+    Output is cut between characters, never inside one, and each part's ``offset`` stays a byte offset into the
+    output stream. Bytes that aren't UTF-8 are replaced, so they can't make the JSON encoding fail. Anything else
+    that can't be encoded raises ValueError or TypeError.
+    """
+
+    lines = event.get('lines')
+    if lines is None:
+        json.dumps(event)
+        return [event]
+
+    if isinstance(lines, unicode):
+        lines = lines.encode('utf-8')
+
+    parts = []
+    pending = [(0, lines)]
+    while pending:
+        start, data = pending.pop(0)
+
+        part = dict(event, lines=data.decode('utf-8', 'replace'))
+        if 'offset' in event:
+            part['offset'] = event['offset'] + start
+
+        cut = get_character_boundary(data, len(data) // 2)
+        if max_size is not None and cut > 0 and len(json.dumps(part)) > max_size:
+            # Escaping makes some text several times longer, so halve it until it fits
+            pending[0:0] = [(start, data[:cut]), (start + cut, data[cut:])]
+        else:
+            json.dumps(part)
+            parts.append(part)
+
+    return parts
+
+
+class BaseBroker(object):
+    """
+    Carries deployment events (the same dictionaries the streaming channels use) between processes.
+
+    Brokers only deliver events published while a subscription is open; there is no history. Subscriptions are
+    bounded ``Subscriber`` queues, so a slow consumer can never make the broker buffer without limit.
+    """
+
+    channel_prefix = 'fabric_bolt_deployment_'
+
+    def __init__(self, **options):
+        self.subscriptions = {}
+
+    def channel_name(self, deployment_id):
+        return '{}{}'.format(self.channel_prefix, int(deployment_id))
+
+    def publish(self, deployment_id, event):
+        raise NotImplementedError
+
+    def subscribe(self, deployment_id, **kwargs):
+        """Return a ``Subscriber`` that receives the deployment's events until ``unsubscribe`` is called"""
+
+        channel = self.channel_name(deployment_id)
+
+        subscriber = Subscriber(**kwargs)
+        first = channel not in self.subscriptions
+        self.subscriptions.setdefault(channel, set()).add(subscriber)
+
+        if first:
+            self.listen(channel)
+
+        return subscriber
+
+    def unsubscribe(self, deployment_id, subscriber):
+        channel = self.channel_name(deployment_id)
+
+        subscribers = self.subscriptions.get(channel, set())
+        subscribers.discard(subscriber)
+
+        if not subscribers and channel in self.subscriptions:
+            del self.subscriptions[channel]
+            self.unlisten(channel)
+
+    def dispatch(self, channel, event):
+        """Hand an event that arrived on a channel to this process's subscribers"""
+
+        for subscriber in list(self.subscriptions.get(channel, ())):
+            subscriber.put(event)
+
+    def listen(self, channel):
+        """Start receiving a channel's events from the backend"""
+
+    def unlisten(self, channel):
+        """Stop receiving a channel's events from the backend"""
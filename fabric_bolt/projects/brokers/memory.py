@@ -0,0 +1,8 @@
+from fabric_bolt.projects.brokers.base import BaseBroker
+
+
+class MemoryBroker(BaseBroker):
+    """Delivers events within the current process only. The default, and handy for tests."""
+
+    def publish(self, deployment_id, event):
+        self.dispatch(self.channel_name(deployment_id), event)
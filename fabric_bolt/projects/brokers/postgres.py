@@ -0,0 +1,149 @@
+import json
+import logging
+import os
+
+import gevent
+import psycopg2
+import psycopg2.extensions
+from django.conf import settings
+from gevent.lock import Semaphore
+from gevent.select import select
+from gevent.socket import wait_read, wait_write
+
+from fabric_bolt.projects.brokers.base import BaseBroker, split_event
+
+
+logger = logging.getLogger('fabric_bolt.brokers')
+
+
+class PostgresBroker(BaseBroker):
+    """
+    Carries events over Postgres LISTEN/NOTIFY, so every web node that shares the database sees every event.
+
+    Connections are opened in psycopg2's asynchronous mode and waited on through the gevent hub, so neither
+    publishing nor listening blocks other greenlets. NOTIFY payloads are limited to 8000 bytes, so long output is
+    split over several notifications.
+
+    Options: ``dsn`` (defaults to the default Django database) and ``reconnect_delay`` in seconds.
+    """
+
+    # Bytes of JSON per notification; NOTIFY takes payloads shorter than 8000 bytes
+    max_payload_size = 7900
+
+    def __init__(self, dsn=None, reconnect_delay=1, **options):
+        super(PostgresBroker, self).__init__(**options)
+
+        self.dsn = dsn or self.get_dsn()
+        self.reconnect_delay = reconnect_delay
+
+        self.publisher = None
+        self.publish_lock = Semaphore()
+
+        # LISTEN/UNLISTEN statements are run by the listener greenlet, which we wake up through a pipe
+        self.listener = None
+        self.commands = []
+        self.wakeup_read, self.wakeup_write = os.pipe()
+
+    def get_dsn(self):
+        database = settings.DATABASES['default']
+
+        parts = [
+            ('dbname', database.get('NAME')),
+            ('user', database.get('USER')),
+            ('password', database.get('PASSWORD')),
+            ('host', database.get('HOST')),
+            ('port', database.get('PORT')),
+        ]
+
+        return ' '.join("{}='{}'".format(key, str(value).replace("'", "\\'")) for key, value in parts if value)
+
+    def connect(self):
+        connection = psycopg2.connect(self.dsn, **{'async': 1})
+        self.wait(connection)
+        return connection
+
+    def wait(self, connection):
+        while True:
+            state = connection.poll()
+            if state == psycopg2.extensions.POLL_OK:
+                return
+            elif state == psycopg2.extensions.POLL_READ:
+                wait_read(connection.fileno())
+            elif state == psycopg2.extensions.POLL_WRITE:
+                wait_write(connection.fileno())
+            else:
+                raise psycopg2.OperationalError('Unexpected poll state: {}'.format(state))
+
+    def execute(self, connection, sql, params=None):
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        self.wait(connection)
+
+    def publish(self, deployment_id, event):
+        channel = self.channel_name(deployment_id)
+
+        try:
+            parts = split_event(event, self.max_payload_size)
+        except (TypeError, ValueError):
+            logger.exception('Could not encode event for deployment %s', deployment_id)
+            return
+
+        with self.publish_lock:
+            try:
+                if self.publisher is None or self.publisher.closed:
+                    self.publisher = self.connect()
+
+                for part in parts:
+                    self.execute(self.publisher, 'SELECT pg_notify(%s, %s)', [channel, json.dumps(part)])
+            except psycopg2.Error:
+                logger.exception('Could not publish event for deployment %s', deployment_id)
+                self.publisher = None
+
+    def listen(self, channel):
+        self.command('LISTEN {}'.format(channel))
+
+    def unlisten(self, channel):
+        self.command('UNLISTEN {}'.format(channel))
+
+    def command(self, sql):
+        self.commands.append(sql)
+
+        if self.listener is None:
+            self.listener = gevent.spawn(self.run_listener)
+        else:
+            os.write(self.wakeup_write, '.')
+
+    def run_listener(self):
+        while True:
+            try:
+                connection = self.connect()
+
+                # (Re)subscribe to everything we are interested in; anything queued is replayed on top
+                for channel in list(self.subscriptions):
+                    self.execute(connection, 'LISTEN {}'.format(channel))
+
+                self.listen_on(connection)
+            except psycopg2.Error:
+                logger.exception('Lost the LISTEN connection, reconnecting')
+
+            gevent.sleep(self.reconnect_delay)
+
+    def listen_on(self, connection):
+        while True:
+            while self.commands:
+                self.execute(connection, self.commands.pop(0))
+
+            readable, _, _ = select([connection.fileno(), self.wakeup_read], [], [])
+
+            if self.wakeup_read in readable:
+                os.read(self.wakeup_read, 4096)
+
+            if connection.fileno() in readable:
+                self.wait(connection)
+
+                while connection.notifies:
+                    notify = connection.notifies.pop(0)
+                    try:
+                        self.dispatch(notify.channel, json.loads(notify.payload))
+                    except ValueError:
+                        logger.warning('Ignoring malformed notification on %s', notify.channel)
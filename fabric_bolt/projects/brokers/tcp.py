@@ -0,0 +1,221 @@
+import json
+import logging
+import socket
+import time
+
+import gevent
+from gevent.lock import Semaphore
+from gevent.queue import Full, Queue
+from gevent.server import StreamServer
+from gevent.socket import create_connection
+
+from fabric_bolt.projects.brokers.base import BaseBroker, split_event
+
+
+logger = logging.getLogger('fabric_bolt.brokers')
+
+
+def encode(message):
+    return json.dumps(message) + '\n'
+
+
+class TCPBroker(BaseBroker):
+    """
+    Carries events through the broker daemon started with ``manage.py runeventbroker``.
+
+    Run one daemon and point every web node at it. The daemon doesn't authenticate its clients, so keep it on a
+    private network: anyone who can connect can read every deployment's output and publish events of their own.
+
+    The protocol is one JSON message per line: clients send
+    ``{"op": "subscribe" | "unsubscribe" | "publish", "channel": ..., "event": ...}`` and receive
+    ``{"channel": ..., "event": ...}``. If the daemon is unreachable events are dropped (and logged) rather than
+    holding up the deployment, and subscriptions are restored once it comes back. After a failed connection attempt
+    nothing tries again for ``reconnect_delay`` seconds, doubling up to ``max_reconnect_delay``, and every message sent
+    meanwhile is dropped straight away; so a deployment waits out ``connect_timeout`` at most once per attempt, not
+    once per chunk of output.
+
+    Options: ``host``, ``port``, ``reconnect_delay``, ``max_reconnect_delay`` and ``connect_timeout`` in seconds.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8002, reconnect_delay=1, max_reconnect_delay=60, connect_timeout=5,
+                 **options):
+        super(TCPBroker, self).__init__(**options)
+
+        self.address = (host, int(port))
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.connect_timeout = connect_timeout
+
+        self.socket = None
+        self.lock = Semaphore()
+
+        # When the next connection attempt may be made, and how long to wait after that one fails
+        self.retry_at = 0
+        self.retry_delay = reconnect_delay
+
+    def connect(self):
+        """
+        Connect to the daemon and re-register our subscriptions, unless the last attempt failed too recently. Call
+        with the lock held.
+        """
+
+        now = time.time()
+        if now < self.retry_at:
+            raise socket.error('Backing off until {:.0f}s from now'.format(self.retry_at - now))
+
+        try:
+            sock = create_connection(self.address, timeout=self.connect_timeout)
+        except socket.error as e:
+            self.retry_at = time.time() + self.retry_delay
+            self.retry_delay = min(self.retry_delay * 2, self.max_reconnect_delay)
+            logger.warning('Could not reach the event broker at %s:%s: %s', self.address[0], self.address[1], e)
+            raise
+
+        self.retry_at = 0
+        self.retry_delay = self.reconnect_delay
+        sock.settimeout(None)
+
+        for channel in list(self.subscriptions):
+            sock.sendall(encode({'op': 'subscribe', 'channel': channel}))
+
+        self.socket = sock
+        gevent.spawn(self.read_events, sock)
+
+    def send(self, message):
+        with self.lock:
+            if self.socket is None:
+                try:
+                    self.connect()
+                except socket.error:
+                    return False
+
+            try:
+                self.socket.sendall(encode(message))
+                return True
+            except socket.error as e:
+                logger.warning('Lost the event broker at %s:%s: %s', self.address[0], self.address[1], e)
+                self.socket.close()
+                self.socket = None
+                return False
+
+    def read_events(self, sock):
+        try:
+            for line in sock.makefile('r'):
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+
+                self.dispatch(message['channel'], message['event'])
+        except socket.error:
+            pass
+
+        with self.lock:
+            if self.socket is sock:
+                self.socket = None
+        sock.close()
+
+        # Keep trying for as long as anybody in this process is listening
+        while self.subscriptions and self.socket is None:
+            gevent.sleep(max(self.retry_at - time.time(), self.reconnect_delay))
+
+            with self.lock:
+                if self.socket is None:
+                    try:
+                        self.connect()
+                    except socket.error:
+                        pass
+
+    def publish(self, deployment_id, event):
+        try:
+            event, = split_event(event)
+        except (TypeError, ValueError):
+            logger.exception('Could not encode event for deployment %s', deployment_id)
+            return
+
+        self.send({'op': 'publish', 'channel': self.channel_name(deployment_id), 'event': event})
+
+    def listen(self, channel):
+        self.send({'op': 'subscribe', 'channel': channel})
+
+    def unlisten(self, channel):
+        self.send({'op': 'unsubscribe', 'channel': channel})
+
+
+class BrokerConnection(object):
+
+    def __init__(self, sock, max_queue):
+        self.socket = sock
+        self.queue = Queue(max_queue)
+        self.channels = set()
+
+
+class BrokerServer(StreamServer):
+    """
+    The broker daemon behind ``TCPBroker``.
+
+    Messages for each connection go through a bounded queue. A connection that falls ``max_queue`` messages behind
+    is closed rather than buffered, and its client reconnects and carries on from the live tail.
+    """
+
+    def __init__(self, listener, max_queue=1000, **kwargs):
+        super(BrokerServer, self).__init__(listener, **kwargs)
+
+        self.max_queue = max_queue
+        self.channels = {}
+
+    def handle(self, sock, address):
+        connection = BrokerConnection(sock, self.max_queue)
+        writer = gevent.spawn(self.write_messages, connection)
+
+        try:
+            for line in sock.makefile('r'):
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+
+                op = message.get('op')
+                channel = message.get('channel')
+
+                if op == 'subscribe':
+                    self.channels.setdefault(channel, set()).add(connection)
+                    connection.channels.add(channel)
+                elif op == 'unsubscribe':
+                    self.remove(connection, channel)
+                elif op == 'publish':
+                    self.publish(channel, message.get('event'))
+        except socket.error:
+            pass
+        finally:
+            for channel in list(connection.channels):
+                self.remove(connection, channel)
+
+            writer.kill()
+            sock.close()
+
+    def remove(self, connection, channel):
+        connection.channels.discard(channel)
+
+        connections = self.channels.get(channel)
+        if connections is not None:
+            connections.discard(connection)
+            if not connections:
+                del self.channels[channel]
+
+    def publish(self, channel, event):
+        data = encode({'channel': channel, 'event': event})
+
+        for connection in list(self.channels.get(channel, ())):
+            try:
+                connection.queue.put_nowait(data)
+            except Full:
+                logger.warning('Dropping a broker client that fell %s messages behind', self.max_queue)
+                connection.socket.close()
+
+    def write_messages(self, connection):
+        try:
+            for data in connection.queue:
+                connection.socket.sendall(data)
+        except socket.error:
+            connection.socket.close()
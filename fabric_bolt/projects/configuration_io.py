@@ -0,0 +1,301 @@
+"""
+Bulk import and export of a project's or stage's configurations.
+
+An export is a list of rows, one per configuration:
+
+    {"key": "port", "data_type": "number", "value": 8000, "prompt_me_for_input": false, "sensitive_value": false}
+
+Sensitive values are exported as null. Importing a row with a null value keeps the value the configuration already
+has, so an export can be edited and imported again without handling the secrets in it.
+
+An import is validated as a whole, compared against the configurations already there, and applied in one
+transaction: new keys with one bulk insert, changed keys with a few batched UPDATEs.
+"""
+
+import json
+import re
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from fabric_bolt.projects.models import Configuration, invalidate_project_generations, invalidate_stage_configurations
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+FORMATS = [('json', 'JSON')]
+if yaml is not None:
+    FORMATS.append(('yaml', 'YAML'))
+
+KEY_RE = re.compile(r'^[a-zA-Z_]+[0-9a-zA-Z_]*$')
+
+# How the prompt_me_for_input and sensitive_value flags may be written, besides true and false themselves
+FLAG_VALUES = {
+    'true': True, 'yes': True, 'on': True, '1': True,
+    'false': False, 'no': False, 'off': False, '0': False, '': False,
+}
+
+FIELDS = ('data_type', 'value', 'value_number', 'value_boolean', 'prompt_me_for_input', 'sensitive_value')
+
+# Rows per UPDATE statement; each row takes a couple of parameters per field and SQLite allows 999 in total
+UPDATE_BATCH_SIZE = 50
+
+
+class ConfigurationImportError(ValueError):
+    """The configurations to import can't be read or aren't valid. ``errors`` lists everything that is wrong."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(ConfigurationImportError, self).__init__('; '.join(errors))
+
+
+def get_scope_queryset(project, stage=None):
+    """The configurations set directly on a project (stage=None) or on one of its stages"""
+
+    queryset = Configuration.objects.filter(project=project)
+    if stage is None:
+        return queryset.filter(stage__isnull=True)
+    return queryset.filter(stage=stage)
+
+
+def export_configurations(project, stage=None):
+    """Return the configurations of a project or stage as a list of rows, ordered by key"""
+
+    rows = []
+    for config in get_scope_queryset(project, stage).order_by('key', 'pk'):
+        rows.append({
+            'key': config.key,
+            'data_type': config.data_type or Configuration.STRING_TYPE,
+            'value': None if config.sensitive_value else config.get_value(),
+            'prompt_me_for_input': config.prompt_me_for_input,
+            'sensitive_value': config.sensitive_value,
+        })
+
+    return rows
+
+
+def dump_configurations(rows, format='json'):
+    if format == 'yaml':
+        if yaml is None:
+            raise ConfigurationImportError(['YAML needs PyYAML, which is not installed'])
+        return yaml.safe_dump(rows, default_flow_style=False)
+
+    return json.dumps(rows, indent=2, sort_keys=True)
+
+
+def load_configurations(text, format='json'):
+    """Parse exported configurations into rows. A plain mapping of keys to values is accepted too."""
+
+    try:
+        if format == 'yaml':
+            if yaml is None:
+                raise ConfigurationImportError(['YAML needs PyYAML, which is not installed'])
+            data = yaml.safe_load(text)
+        else:
+            data = json.loads(text)
+    except ConfigurationImportError:
+        raise
+    except Exception as e:
+        raise ConfigurationImportError(['Could not read the {}: {}'.format(format.upper(), e)])
+
+    if isinstance(data, dict):
+        data = [{'key': key, 'value': value} for key, value in sorted(data.items())]
+
+    if not isinstance(data, list):
+        raise ConfigurationImportError(['Expected a list of configurations'])
+
+    return data
+
+
+def clean_flag(value):
+    """Read a yes/no flag of an imported row. Returns None for anything that isn't clearly one or the other."""
+
+    if value is None or isinstance(value, bool):
+        return bool(value)
+    if isinstance(value, (int, long)) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, basestring):
+        return FLAG_VALUES.get(value.strip().lower())
+    return None
+
+
+def clean_row(row, existing=None):
+    """
+    Turn an imported row into Configuration field values. Returns (key, values, errors). ``existing`` is the
+    configuration with this key already in place, if any.
+    """
+
+    if not isinstance(row, dict):
+        return None, None, ['{!r} is not a configuration'.format(row)]
+
+    key = row.get('key')
+    if not isinstance(key, basestring) or not KEY_RE.match(key):
+        return None, None, ['{!r} is not a valid key'.format(key)]
+
+    errors = []
+    value = row.get('value')
+
+    data_type = row.get('data_type')
+    if data_type is None:
+        if isinstance(value, bool):
+            data_type = Configuration.BOOLEAN_TYPE
+        elif isinstance(value, (int, long, float)):
+            data_type = Configuration.NUMBER_TYPE
+        else:
+            data_type = Configuration.STRING_TYPE
+
+    if data_type not in dict(Configuration.DATA_TYPES):
+        return key, None, ['{}: unknown data type {!r}'.format(key, data_type)]
+
+    values = {
+        'data_type': data_type,
+        'value': None,
+        'value_number': 0,
+        'value_boolean': False,
+    }
+
+    for flag in ('prompt_me_for_input', 'sensitive_value'):
+        values[flag] = clean_flag(row.get(flag))
+        if values[flag] is None:
+            errors.append('{}: {!r} is not a valid {}'.format(key, row.get(flag), flag))
+
+    if value is None and existing is not None and existing.data_type == data_type:
+        # Keep what's there, this is how sensitive values come back from an export
+        values['value'] = existing.value
+        values['value_number'] = existing.value_number
+        values['value_boolean'] = existing.value_boolean
+    elif data_type == Configuration.BOOLEAN_TYPE:
+        if not isinstance(value, bool):
+            errors.append('{}: {!r} is not a boolean'.format(key, value))
+        values['value_boolean'] = value
+    elif data_type == Configuration.NUMBER_TYPE:
+        if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+            errors.append('{}: {!r} is not a number'.format(key, value))
+        else:
+            values['value_number'] = float(value)
+    elif value is not None:
+        if isinstance(value, (dict, list)):
+            errors.append('{}: {!r} is not a string'.format(key, value))
+        else:
+            values['value'] = value if isinstance(value, basestring) else unicode(value)
+            if len(values['value']) > Configuration._meta.get_field('value').max_length:
+                errors.append('{}: value is too long'.format(key))
+
+    return key, values, errors
+
+
+class ConfigurationImport(object):
+    """
+    Compare imported rows with a project's or stage's configurations and apply the difference.
+
+    Keys missing from the import are left alone, unless ``delete_missing`` is set. Where a key is set more than
+    once the first configuration is the one that counts (see ``Stage.resolve_configurations``), so that is the one
+    updated; with ``delete_missing`` the extra ones go away.
+    """
+
+    def __init__(self, project, rows, stage=None, delete_missing=False):
+        self.project = project
+        self.stage = stage
+        self.rows = rows
+        self.delete_missing = delete_missing
+
+        self.created = []
+        self.updated = []
+        self.unchanged = []
+        self.deleted = []
+
+        self.compare()
+
+    def compare(self):
+        existing = {}
+        duplicates = []
+        for config in get_scope_queryset(self.project, self.stage).order_by('pk'):
+            if config.key in existing:
+                duplicates.append(config)
+            else:
+                existing[config.key] = config
+
+        errors = []
+        seen = set()
+        for row in self.rows:
+            key = row.get('key') if isinstance(row, dict) else None
+            key, values, row_errors = clean_row(row, existing.get(key) if isinstance(key, basestring) else None)
+            if row_errors:
+                errors.extend(row_errors)
+                continue
+
+            if key in seen:
+                errors.append('{}: set more than once'.format(key))
+                continue
+            seen.add(key)
+
+            config = existing.get(key)
+            if config is None:
+                self.created.append(Configuration(project=self.project, stage=self.stage, key=key, **values))
+            elif any(getattr(config, field) != value for field, value in values.items()):
+                for field, value in values.items():
+                    setattr(config, field, value)
+                self.updated.append(config)
+            else:
+                self.unchanged.append(config)
+
+        if errors:
+            raise ConfigurationImportError(errors)
+
+        if self.delete_missing:
+            self.deleted = [config for key, config in existing.items() if key not in seen] + duplicates
+
+    @property
+    def has_changes(self):
+        return bool(self.created or self.updated or self.deleted)
+
+    def apply(self):
+        if not self.has_changes:
+            return
+
+        with transaction.atomic():
+            if self.created:
+                Configuration.objects.bulk_create(self.created)
+
+            for start in range(0, len(self.updated), UPDATE_BATCH_SIZE):
+                self.update_batch(self.updated[start:start + UPDATE_BATCH_SIZE])
+
+            if self.deleted:
+                Configuration.objects.filter(pk__in=[config.pk for config in self.deleted]).delete()
+
+        # bulk_create and update() don't send the signals that keep the resolved configurations cache fresh
+        invalidate_stage_configurations([self.project.pk])
+
+        # Nor the ones that drop the cached fragments of the project's pages
+        invalidate_project_generations([self.project.pk])
+
+    def update_batch(self, configs):
+        """Update a batch of configurations, each with its own values, in a single UPDATE ... CASE statement"""
+
+        opts = Configuration._meta
+        qn = connection.ops.quote_name
+        pk_column = qn(opts.pk.column)
+
+        assignments = []
+        params = []
+        for name in FIELDS:
+            field = opts.get_field(name)
+            column = qn(field.column)
+            cases = []
+            for config in configs:
+                cases.append('WHEN %s THEN %s')
+                params.extend([config.pk, field.get_db_prep_save(getattr(config, name), connection)])
+            assignments.append('{0} = CASE {1} {2} ELSE {0} END'.format(column, pk_column, ' '.join(cases)))
+
+        date_update = opts.get_field('date_update')
+        assignments.append('{} = %s'.format(qn(date_update.column)))
+        params.append(date_update.get_db_prep_save(timezone.now(), connection))
+
+        sql = 'UPDATE {} SET {} WHERE {} IN ({})'.format(
+            qn(opts.db_table), ', '.join(assignments), pk_column, ', '.join(['%s'] * len(configs)))
+        params.extend(config.pk for config in configs)
+
+        connection.cursor().execute(sql, params)
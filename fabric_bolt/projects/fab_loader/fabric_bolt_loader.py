@@ -0,0 +1,71 @@
+"""
+The fabfile deployments run through when their configuration is delivered in a file.
+
+fab is started with ``--set fabric_bolt_environment=<path>``. The JSON file at that path names the real fabfile and
+holds the hosts, the env settings and Fabric's own options for the deployment; it is removed as soon as it has been
+read. The real fabfile's tasks are then handed to Fabric as if they were defined here. This keeps the command line
+the same size however many hosts and configurations the stage has, and keeps them out of ``ps``.
+"""
+
+import json
+import os
+import sys
+
+from fabric.api import env
+from fabric.state import env_options
+
+
+def _to_str(value):
+    # fab --set gives the fabfile byte strings, so do the same
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_to_str(item) for item in value]
+    return value
+
+
+def _set_option(option, value):
+    """Set a Fabric option (user, parallel, timeout...) the way its command line flag would"""
+
+    if option.action in ('store_true', 'store_false'):
+        if value:
+            env[option.dest] = option.action == 'store_true'
+        return
+
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+
+    env[option.dest] = option.check_value(option.get_opt_string(), str(value))
+
+
+def _load():
+    path = env.fabric_bolt_environment
+    try:
+        with open(path) as environment_file:
+            environment = json.load(environment_file)
+    finally:
+        os.unlink(path)
+
+    for key, value in environment['env'].items():
+        env[_to_str(key)] = _to_str(value)
+
+    if environment['hosts']:
+        env.hosts = _to_str(environment['hosts'])
+
+    options = dict((option.get_opt_string().lstrip('-'), option) for option in env_options)
+    for name, value in environment['options'].items():
+        _set_option(options[name], _to_str(value))
+
+    directory, name = os.path.split(_to_str(environment['fabfile']))
+    sys.path.insert(0, directory)
+
+    return __import__(os.path.splitext(name)[0])
+
+
+_fabfile = _load()
+
+__doc__ = _fabfile.__doc__
+
+for _name, _value in vars(_fabfile).items():
+    if not _name.startswith('_'):
+        globals()[_name] = _value
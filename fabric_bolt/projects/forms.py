@@ -4,6 +4,7 @@ from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, ButtonHolder, Submit
 
 from fabric_bolt.projects import models
+from fabric_bolt.projects.configuration_io import FORMATS, ConfigurationImport, ConfigurationImportError, load_configurations
 
 
 class ProjectCreateForm(forms.ModelForm):
@@ -95,8 +96,63 @@ class ConfigurationCreateForm(ConfigurationUpdateForm):
         self.fields['key'].validators.append(RegexValidator(r'^[a-zA-Z_]+[0-9a-zA-Z_]*$')) # valid python variable name
 
 
+class ConfigurationImportForm(forms.Form):
+    """Import many configurations at once from an export (or a file written by hand)"""
+
+    format = forms.ChoiceField(choices=FORMATS)
+    file = forms.FileField(required=False)
+    data = forms.CharField(label='Or paste it here', widget=forms.Textarea, required=False)
+    delete_missing = forms.BooleanField(required=False, help_text='Delete the configurations that are not in the import.')
+
+    def __init__(self, project, stage=None, *args, **kwargs):
+        self.project = project
+        self.stage = stage
+        self.configuration_import = None
+
+        self.helper = FormHelper()
+        self.helper.form_class = 'form-horizontal'
+        self.helper.label_class = 'col-lg-2'
+        self.helper.field_class = 'col-lg-8'
+        self.helper.layout = Layout(
+            'format',
+            'file',
+            'data',
+            'delete_missing',
+            ButtonHolder(
+                Submit('submit', 'Import Configurations', css_class='btn')
+            )
+        )
+
+        super(ConfigurationImportForm, self).__init__(*args, **kwargs)
+
+    def clean(self):
+        cleaned_data = super(ConfigurationImportForm, self).clean()
+
+        if self.errors:
+            return cleaned_data
+
+        if cleaned_data.get('file'):
+            text = cleaned_data['file'].read()
+        elif cleaned_data.get('data'):
+            text = cleaned_data['data']
+        else:
+            raise forms.ValidationError('Upload a file or paste the configurations to import.')
+
+        try:
+            rows = load_configurations(text, cleaned_data['format'])
+            self.configuration_import = ConfigurationImport(
+                self.project, rows, stage=self.stage, delete_missing=cleaned_data.get('delete_missing'))
+        except ConfigurationImportError as e:
+            raise forms.ValidationError(e.errors)
+
+        return cleaned_data
+
+
 class DeploymentForm(forms.ModelForm):
 
+    run_at_next_window = forms.BooleanField(required=False, label='Run at the next launch window',
+                                            help_text='Queue the deployment until a launch window is open.')
+
     class Meta:
         fields = ['comments']
         model = models.Deployment
@@ -108,6 +164,7 @@ class DeploymentForm(forms.ModelForm):
 
         self.helper.layout = Layout(
             'comments',
+            'run_at_next_window',
             ButtonHolder(
                 Submit('submit', 'Go!', css_class='btn btn-success')
             )
@@ -121,12 +178,16 @@ class StageCreateForm(forms.ModelForm):
         model = models.Stage
         fields = [
             'name',
+            'log_head_size',
+            'log_tail_size',
         ]
 
     def __init__(self, *args, **kwargs):
         self.helper = FormHelper()
         self.helper.layout = Layout(
             'name',
+            'log_head_size',
+            'log_tail_size',
             ButtonHolder(
                 Submit('submit', '%s Stage' % self.button_prefix, css_class='button')
             )
@@ -142,4 +203,6 @@ class StageUpdateForm(StageCreateForm):
         model = models.Stage
         fields = [
             'name',
+            'log_head_size',
+            'log_tail_size',
         ]
\ No newline at end of file
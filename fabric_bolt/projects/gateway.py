@@ -0,0 +1,218 @@
+"""
+Standalone deployment streaming gateway.
+
+A small WSGI application, served by ``manage.py rundeploymentgateway``, that runs pending deployments and streams
+their output to browsers over Server-Sent Events or WebSockets:
+
+    /deployments/<pk>/events    text/event-stream, one JSON event per message
+    /deployments/<pk>/ws        WebSocket, JSON events out and lines of input in
+    /metrics                    JSON subscriber queue depths for every deployment running in the gateway
+
+Users are authenticated with the regular Django session cookie, so the gateway can sit on another port or host of
+the same domain as the web interface. Since the cookie goes along with requests from any web page, browsers are only
+let in from the gateway's own origin and DEPLOYMENT_GATEWAY_ALLOWED_ORIGINS (which should list the web interface's).
+"""
+
+import json
+import re
+
+import gevent
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY, get_user_model
+from django.utils.importlib import import_module
+from gevent.queue import Empty
+from geventwebsocket.handler import WebSocketHandler
+
+from fabric_bolt.projects.models import Deployment
+from fabric_bolt.projects.streaming import get_channel, get_stats, run_in_thread, start_deployment
+
+
+def normalize_origin(origin):
+    """``origin`` in lower case, without a trailing slash or the scheme's default port"""
+
+    origin = origin.rstrip('/').lower()
+    for scheme, port in (('http://', ':80'), ('https://', ':443')):
+        if origin.startswith(scheme) and origin.endswith(port):
+            origin = origin[:-len(port)]
+
+    return origin
+
+
+class DeploymentGateway(object):
+
+    path_re = re.compile(r'^/deployments/(?P<pk>\d+)/(?P<transport>events|ws)/?$')
+
+    # Comment lines sent to idle SSE subscribers so proxies don't close the connection
+    keepalive_interval = 15
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        match = self.path_re.match(path)
+        if not match and path.rstrip('/') != '/metrics':
+            return self.respond(start_response, '404 Not Found')
+
+        # Before anything can start a deployment or send it input on the user's behalf
+        if not self.is_allowed_origin(environ):
+            return self.respond(start_response, '403 Forbidden')
+
+        session = run_in_thread(self.get_session, environ)
+        if session is None:
+            return self.respond(start_response, '403 Forbidden')
+
+        if not match:
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return [json.dumps(get_stats())]
+
+        try:
+            deployment = run_in_thread(Deployment.objects.select_related('stage', 'task').get, pk=match.group('pk'))
+        except Deployment.DoesNotExist:
+            return self.respond(start_response, '404 Not Found')
+
+        channel = get_channel(deployment.pk)
+        if channel is None and deployment.status == Deployment.PENDING:
+            # Only WebSocket clients can send input; a run started for an event stream aborts on prompts
+            channel = start_deployment(deployment, session.get('configuration_values', {}),
+                                       abort_on_prompts=match.group('transport') != 'ws')
+
+        if match.group('transport') == 'ws':
+            return self.serve_websocket(environ, start_response, deployment, channel)
+
+        return self.serve_events(environ, start_response, deployment, channel)
+
+    def get_session(self, environ):
+        """Return the Django session of an active, logged in user or None"""
+
+        session_key = self.get_cookies(environ).get(settings.SESSION_COOKIE_NAME)
+        if not session_key:
+            return None
+
+        engine = import_module(settings.SESSION_ENGINE)
+        session = engine.SessionStore(session_key)
+
+        user_id = session.get(SESSION_KEY)
+        if user_id is None or not get_user_model().objects.filter(pk=user_id, is_active=True).exists():
+            return None
+
+        return session
+
+    def get_cookies(self, environ):
+        cookies = {}
+        for cookie in environ.get('HTTP_COOKIE', '').split(';'):
+            if '=' in cookie:
+                name, value = cookie.split('=', 1)
+                cookies[name.strip()] = value.strip()
+
+        return cookies
+
+    def is_allowed_origin(self, environ):
+        """
+        Whether the page a request comes from may use the gateway: the gateway itself or one of
+        DEPLOYMENT_GATEWAY_ALLOWED_ORIGINS. Requests without an Origin don't come from another site's page.
+        """
+
+        origin = environ.get('HTTP_ORIGIN')
+        if not origin:
+            return True
+
+        allowed = set(normalize_origin(allowed) for allowed in
+                      getattr(settings, 'DEPLOYMENT_GATEWAY_ALLOWED_ORIGINS', ()))
+
+        host = environ.get('HTTP_HOST') or '{}:{}'.format(environ.get('SERVER_NAME'), environ.get('SERVER_PORT'))
+        allowed.add(normalize_origin('{}://{}'.format(environ.get('wsgi.url_scheme', 'http'), host)))
+
+        return normalize_origin(origin) in allowed
+
+    def cors_headers(self, environ):
+        origin = environ.get('HTTP_ORIGIN')
+        if not origin or not self.is_allowed_origin(environ):
+            return []
+
+        return [('Access-Control-Allow-Origin', origin), ('Access-Control-Allow-Credentials', 'true')]
+
+    def respond(self, start_response, status):
+        start_response(status, [('Content-Type', 'text/plain')])
+        return [status]
+
+    def iter_events(self, deployment, channel):
+        """Yield the events for a deployment, or None whenever nothing happened for ``keepalive_interval``"""
+
+        if channel is None:
+            # Not running here; the stored record is all there is to send
+            if deployment.output:
+                yield {'status': Deployment.PENDING, 'lines': deployment.output}
+            yield {'status': deployment.status}
+            return
+
+        subscriber = channel.subscribe()
+        try:
+            while True:
+                try:
+                    event = subscriber.get(timeout=self.keepalive_interval)
+                except Empty:
+                    yield None
+                    continue
+
+                yield event
+
+                if 'lines' not in event:
+                    break
+        finally:
+            channel.unsubscribe(subscriber)
+
+    def serve_events(self, environ, start_response, deployment, channel):
+        headers = [
+            ('Content-Type', 'text/event-stream'),
+            ('Cache-Control', 'no-cache'),
+            ('X-Accel-Buffering', 'no'),
+        ]
+        start_response('200 OK', headers + self.cors_headers(environ))
+
+        for event in self.iter_events(deployment, channel):
+            if event is None:
+                yield ': keepalive\n\n'
+            else:
+                yield 'data: {}\n\n'.format(json.dumps(event))
+
+    def serve_websocket(self, environ, start_response, deployment, channel):
+        websocket = environ.get('wsgi.websocket')
+        if websocket is None:
+            return self.respond(start_response, '400 Bad Request')
+
+        if channel is not None:
+            reader = gevent.spawn(self.read_input, websocket, channel)
+        else:
+            reader = None
+
+        try:
+            for event in self.iter_events(deployment, channel):
+                if event is not None:
+                    websocket.send(json.dumps(event))
+        finally:
+            if reader is not None:
+                reader.kill()
+            websocket.close()
+
+        return []
+
+    def read_input(self, websocket, channel):
+        while True:
+            text = websocket.receive()
+            if text is None:
+                break
+
+            channel.send_input(text)
+
+
+class GatewayHandler(WebSocketHandler):
+    """Turns WebSocket handshakes from pages on other origins away before the connection is upgraded"""
+
+    def upgrade_websocket(self):
+        if self.environ.get('HTTP_UPGRADE', '').lower() == 'websocket' and \
+                not self.application.is_allowed_origin(self.environ):
+            self.start_response('403 Forbidden', [('Content-Type', 'text/plain')])
+            return ['403 Forbidden']
+
+        return super(GatewayHandler, self).upgrade_websocket()
+
+
+application = DeploymentGateway()
@@ -0,0 +1,11 @@
+from django.core.management.base import NoArgsCommand
+
+from fabric_bolt.projects.models import DeploymentDailyStat
+
+
+class Command(NoArgsCommand):
+    help = 'Rebuilds the daily deployment stats the dashboard reads from all deployments.'
+
+    def handle_noargs(self, **options):
+        count = DeploymentDailyStat.rebuild()
+        self.stdout.write('Rebuilt {} daily deployment stats'.format(count))
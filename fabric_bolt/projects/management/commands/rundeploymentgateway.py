@@ -0,0 +1,36 @@
+from re import match
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.commands.runserver import naiveip_re
+from gevent.pywsgi import WSGIServer
+
+from fabric_bolt.projects.gateway import GatewayHandler, application
+
+
+DEFAULT_PORT = '8001'
+
+
+class Command(BaseCommand):
+    args = '[optional port number, or ipaddr:port]'
+    help = 'Runs the standalone gateway that executes deployments and streams their output to watchers.'
+
+    def handle(self, addrport="", *args, **options):
+
+        if not addrport:
+            self.addr = ''
+            self.port = DEFAULT_PORT
+        else:
+            m = match(naiveip_re, addrport)
+            if m is None:
+                raise CommandError('"%s" is not a valid port number '
+                                   'or address:port pair.' % addrport)
+            self.addr, _, _, _, self.port = m.groups()
+
+        bind = (self.addr, int(self.port))
+        self.stdout.write("Deployment gateway running on %s:%s" % bind)
+
+        server = WSGIServer(bind, application, handler_class=GatewayHandler)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.stop()
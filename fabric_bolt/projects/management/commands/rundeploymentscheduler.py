@@ -0,0 +1,15 @@
+from django.core.management.base import NoArgsCommand
+
+from fabric_bolt.projects.scheduler import DeploymentScheduler
+
+
+class Command(NoArgsCommand):
+    help = 'Runs the scheduler that fires deployment schedules and starts scheduled deployments when their launch window opens.'
+
+    def handle_noargs(self, **options):
+        self.stdout.write('Deployment scheduler running')
+
+        try:
+            DeploymentScheduler().run_forever()
+        except KeyboardInterrupt:
+            pass
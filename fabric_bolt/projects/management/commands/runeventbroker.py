@@ -0,0 +1,39 @@
+from re import match
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.commands.runserver import naiveip_re
+
+from fabric_bolt.projects.brokers.tcp import BrokerServer
+
+
+DEFAULT_ADDR = '127.0.0.1'
+DEFAULT_PORT = '8002'
+
+
+class Command(BaseCommand):
+    args = '[optional port number, or ipaddr:port]'
+    help = ('Runs the broker daemon used by fabric_bolt.projects.brokers.tcp.TCPBroker, on 127.0.0.1 unless told '
+            'otherwise. The daemon has no authentication: anyone who can reach it can read the output of every '
+            'deployment and inject events, so only bind it to an interface on a private network, behind a firewall.')
+
+    def handle(self, addrport="", *args, **options):
+
+        if not addrport:
+            self.addr = DEFAULT_ADDR
+            self.port = DEFAULT_PORT
+        else:
+            m = match(naiveip_re, addrport)
+            if m is None:
+                raise CommandError('"%s" is not a valid port number '
+                                   'or address:port pair.' % addrport)
+            self.addr, _, _, _, self.port = m.groups()
+            self.addr = self.addr or DEFAULT_ADDR
+
+        bind = (self.addr, int(self.port))
+        self.stdout.write("Deployment event broker running on %s:%s" % bind)
+
+        server = BrokerServer(bind)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.stop()
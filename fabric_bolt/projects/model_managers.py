@@ -1,6 +1,125 @@
-from django.db import models
+import datetime
+
+from django.db import connection, models
+from django.db.models.sql import aggregates as sql_aggregates
+
+
+class DurationSumSQL(sql_aggregates.Aggregate):
+    is_computed = True
+
+    # The seconds from start to end, on each database; Django has no portable way to subtract datetimes
+    duration_templates = {
+        'sqlite': '(julianday({end}) - julianday({start})) * 86400.0',
+        'postgresql': 'EXTRACT(EPOCH FROM {end} - {start})',
+        'mysql': 'TIMESTAMPDIFF(MICROSECOND, {start}, {end}) / 1000000.0',
+        'oracle': '(CAST({end} AS DATE) - CAST({start} AS DATE)) * 86400',
+    }
+
+    def as_sql(self, qn, connection):
+        table, end = self.col
+        duration = self.duration_templates[connection.vendor].format(
+            start='{}.{}'.format(qn(table), qn(self.extra['start'])), end='{}.{}'.format(qn(table), qn(end)))
+        return 'SUM({})'.format(duration), []
+
+
+class DurationSum(models.Aggregate):
+    """
+    The seconds from ``start`` (a datetime column of the same table) to the datetime field aggregated, added up.
+    Rows where either is NULL are left out.
+    """
+
+    name = 'DurationSum'
+
+    def add_to_query(self, query, alias, col, source, is_summary):
+        query.aggregates[alias] = DurationSumSQL(col, source=source, is_summary=is_summary, **self.extra)
 
 
 class ActiveManager(models.Manager):
     def get_query_set(self):
-        return super(ActiveManager, self).get_query_set().filter(date_deleted__isnull=True)
\ No newline at end of file
+        return super(ActiveManager, self).get_query_set().filter(date_deleted__isnull=True)
+
+
+class ProjectQuerySet(models.query.QuerySet):
+
+    def with_deployment_summary(self):
+        """
+        Annotate each project with ``deployment_count``, ``last_deployment_date`` and ``last_deployment_status`` in
+        the same query, for lists of projects
+        """
+        from fabric_bolt.projects.models import Deployment, Stage
+
+        qn = connection.ops.quote_name
+        deployment_table = qn(Deployment._meta.db_table)
+        stage_table = qn(Stage._meta.db_table)
+
+        last_status = (
+            'SELECT d.{status} FROM {deployment} d INNER JOIN {stage} s ON d.{stage_id} = s.{pk} '
+            'WHERE s.{project_id} = {project}.{pk} ORDER BY d.{date_created} DESC, d.{pk} DESC LIMIT 1'
+        ).format(
+            status=qn('status'), deployment=deployment_table, stage=stage_table, stage_id=qn('stage_id'),
+            pk=qn('id'), project_id=qn('project_id'), project=qn(self.model._meta.db_table),
+            date_created=qn('date_created'),
+        )
+
+        return self.annotate(
+            deployment_count=models.Count('stage__deployment'),
+            last_deployment_date=models.Max('stage__deployment__date_created'),
+        ).extra(select={'last_deployment_status': last_status})
+
+
+class DeploymentQuerySet(models.query.QuerySet):
+
+    # Columns only the page of a single deployment needs, and which can get very large
+    heavy_fields = ('output', 'configuration')
+
+    def lightweight(self):
+        """
+        Leave the deployments' output and configuration out, for lists and summaries. The deployments loaded are
+        for showing; load a deployment in full to change it, so its signals are sent.
+        """
+        return self.defer(*self.heavy_fields)
+
+    def count_by_day(self, *fields, **aggregates):
+        """
+        Count the deployments per day they were created (in the database's time zone, UTC) and ``fields``, in a
+        single query on any database. Yields dictionaries of the fields, ``day`` (a date), ``count`` and any further
+        ``aggregates`` of each group.
+        """
+
+        qn = connection.ops.quote_name
+        day_sql = connection.ops.date_trunc_sql('day', '{}.{}'.format(qn(self.model._meta.db_table), qn('date_created')))
+
+        counts = self.extra(select={'day': day_sql}).values('day', *fields)\
+            .annotate(count=models.Count('id'), **aggregates).order_by()
+        for item in counts:
+            # SQLite gives the day back as a string
+            day = item['day']
+            if hasattr(day, 'date'):
+                item['day'] = day.date()
+            else:
+                item['day'] = datetime.date(int(day[:4]), int(day[5:7]), int(day[8:10]))
+
+            yield item
+
+
+class ProjectManager(models.Manager):
+    def get_query_set(self):
+        return ProjectQuerySet(self.model, using=self._db)
+
+    def with_deployment_summary(self):
+        return self.get_query_set().with_deployment_summary()
+
+
+class ActiveProjectManager(ActiveManager, ProjectManager):
+    pass
+
+
+class DeploymentManager(models.Manager):
+    def get_query_set(self):
+        return DeploymentQuerySet(self.model, using=self._db)
+
+    def lightweight(self):
+        return self.get_query_set().lightweight()
+
+    def count_by_day(self, *fields, **aggregates):
+        return self.get_query_set().count_by_day(*fields, **aggregates)
@@ -1,10 +1,27 @@
+import hashlib
+import json
+import os
+import socket
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.db.models import Count, Sum
-from django.db import models
+from django.db.models import Count, F, Q, Sum
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save, pre_delete, pre_save
+from django.db import IntegrityError, models, transaction
+from django.dispatch import receiver
+from django.utils import timezone
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from croniter import croniter
 
 from fabric_bolt.core.mixins.models import TrackingFields
-from fabric_bolt.projects.model_managers import ActiveManager
+from fabric_bolt.hosts.models import Host
+from fabric_bolt.projects.model_managers import ActiveManager, ActiveProjectManager, DeploymentManager, ProjectManager
+from fabric_bolt.projects.model_managers import DurationSum
 
 
 class ProjectType(TrackingFields):
@@ -30,8 +47,8 @@ class Project(TrackingFields):
                                                                              'Enter one requirement per line.')
 
     # Managers
-    objects = models.Manager()
-    active_records = ActiveManager()
+    objects = ProjectManager()
+    active_records = ActiveProjectManager()
     # End Managers
 
     def project_configurations(self):
@@ -57,11 +74,91 @@ class Project(TrackingFields):
         return ret['total_deployments']
 
 
+class CacheVersion(models.Model):
+    """
+    Version stamps for cached data, kept in the database so a change made by any process is seen by all of them
+    straight away, whatever cache backend each one has. The cache keys include the version, so changing it is how
+    the old entries are dropped: nobody asks for them again and they expire.
+
+    A new version is random rather than the next number, so none is ever handed out twice, not even after the
+    transaction that made it is rolled back.
+    """
+
+    name = models.CharField(max_length=255, unique=True)
+    version = models.CharField(max_length=32)
+
+    def __unicode__(self):
+        return u'{} {}'.format(self.name, self.version)
+
+    @classmethod
+    def get(cls, name):
+        version = cls.objects.filter(name=name).values_list('version', flat=True).first()
+        if version is None:
+            version = cls.create(name)
+        return version
+
+    @classmethod
+    def bump(cls, names):
+        names = set(names)
+        if not names or cls.objects.filter(name__in=names).update(version=uuid.uuid4().hex) == len(names):
+            return
+
+        for name in names - set(cls.objects.filter(name__in=names).values_list('name', flat=True)):
+            cls.create(name)
+
+    @classmethod
+    def create(cls, name):
+        version = uuid.uuid4().hex
+        try:
+            with transaction.atomic():
+                cls.objects.create(name=name, version=version)
+        except IntegrityError:
+            # Another process got to create it first
+            version = cls.objects.filter(name=name).values_list('version', flat=True).first()
+        return version
+
+
+def get_stage_configurations_version_name(project_id):
+    return 'stage_configurations.{}'.format(project_id)
+
+
+def get_stage_configurations_cache_key(stage):
+    version = CacheVersion.get(get_stage_configurations_version_name(stage.project_id))
+    return 'fabric_bolt.stage_configurations.{}.{}'.format(stage.pk, version)
+
+
+def invalidate_stage_configurations(project_ids):
+    """Drop the resolved configurations of every stage of these projects, in every process"""
+
+    CacheVersion.bump(get_stage_configurations_version_name(project_id) for project_id in project_ids)
+
+
+def get_project_generation_name(project_id):
+    return 'project_generation.{}'.format(project_id)
+
+
+def get_project_generation(project_id):
+    """
+    A stamp that changes whenever anything shown on the project's pages does: the project, its stages and their
+    hosts, its configurations or its deployments. The pages' cached fragments are keyed on it.
+    """
+
+    return CacheVersion.get(get_project_generation_name(project_id))
+
+
+def invalidate_project_generations(project_ids):
+    CacheVersion.bump(get_project_generation_name(project_id) for project_id in project_ids)
+
+
 class Stage(TrackingFields):
     project = models.ForeignKey(Project)
     name = models.CharField(max_length=255)
     hosts = models.ManyToManyField('hosts.Host')
 
+    # Bytes of deployment output kept from the start and the end of a run; leave blank for the site defaults
+    log_head_size = models.PositiveIntegerField(null=True, blank=True, help_text='Bytes of output kept from the start of a deployment')
+    log_tail_size = models.PositiveIntegerField(null=True, blank=True, help_text='Bytes of output kept from the end of a deployment')
+
     # Managers
     objects = models.Manager()
     active_records = ActiveManager()
@@ -80,36 +177,53 @@ class Stage(TrackingFields):
 
         return self.project.get_absolute_url()
 
-    def get_queryset_configurations(self, **kwargs):
+    def resolve_configurations(self):
         """
-        Really we just want to do a simple SQL statement like this (but oh the ORM):
-
-        SELECT Distinct(Coalesce(stage.key, project.key)) AS key,
-        (CASE WHEN stage.key IS NOT null THEN stage.data_type ELSE project.data_type END) AS data_type,
-        (CASE WHEN stage.key IS NOT null THEN stage.value ELSE project.value END) AS value,
-        (CASE WHEN stage.key IS NOT null THEN stage.value_number ELSE project.value_number END) AS value_number,
-        (CASE WHEN stage.key IS NOT null THEN stage.value_boolean ELSE project.value_boolean END) AS value_boolean,
-        (CASE WHEN stage.key IS NOT null THEN stage.prompt_me_for_input ELSE project.prompt_me_for_input END) AS prompt_me_for_input,
-        (CASE WHEN stage.key IS NOT null THEN stage.sensitive_value ELSE project.sensitive_value END) AS sensitive_value
-        FROM projects_configuration AS project
-        LEFT JOIN projects_configuration AS stage ON stage.project_id = project.project_id
-            AND project.key = stage.key AND stage.stage_id = STAGE_ID_HERE
-        WHERE project.project_id = PROJECT_ID_HERE AND (project.stage_id is null OR project.stage_id = STAGE_ID_HERE)
+        The configurations that apply to this stage, in one query: a stage configuration takes the place of the
+        project configuration with the same key. Stage configurations come first, then the project's.
         """
-        queryset_list = []
-        current_configs = []
 
-        # Create stage specific configurations dictionary
-        for stage in self.stage_configurations().filter(**kwargs):
-            queryset_list.append(stage)
-            current_configs.append(stage.key)
+        stage_configurations = []
+        project_configurations = OrderedDict()
+
+        queryset = Configuration.objects.filter(Q(stage=self) | Q(project_id=self.project_id, stage__isnull=True))
+        for config in queryset.order_by('pk'):
+            if config.stage_id is None:
+                project_configurations.setdefault(config.key, config)
+            else:
+                stage_configurations.append(config)
+
+        resolved = []
+        keys = set()
+        for config in stage_configurations:
+            if config.key not in keys:
+                resolved.append(config)
+                keys.add(config.key)
+
+        resolved.extend(config for key, config in project_configurations.items() if key not in keys)
 
-        for project in self.project.project_configurations().filter(**kwargs):
-            if not project.key in current_configs:
-                queryset_list.append(project)
-                current_configs.append(project.key)
+        return resolved
 
-        return queryset_list
+    def get_resolved_configurations(self):
+        """``resolve_configurations``, cached until a configuration of the project or the stage itself changes"""
+
+        key = get_stage_configurations_cache_key(self)
+
+        configurations = cache.get(key)
+        if configurations is None:
+            configurations = self.resolve_configurations()
+            cache.set(key, configurations, getattr(settings, 'STAGE_CONFIGURATIONS_CACHE_TIMEOUT', 60 * 60 * 24))
+
+        return configurations
+
+    def get_queryset_configurations(self, **kwargs):
+        """
+        The resolved configurations of the stage, optionally only those whose fields match ``kwargs``, like
+        ``prompt_me_for_input=True``.
+        """
+
+        return [config for config in self.get_resolved_configurations()
+                if all(getattr(config, name) == value for name, value in kwargs.items())]
 
     def get_configurations(self):
         """
@@ -117,25 +231,30 @@ class Stage(TrackingFields):
         Any configurations on a project that are duplicated on a stage, the stage configuration will take precedence.
         """
 
-        project_configurations_dictionary = {}
-        project_configurations = self.project.project_configurations()
+        return dict((config.key, config.get_value()) for config in self.get_resolved_configurations())
+
+    def get_sensitive_values(self, configuration_values=None):
+        """
+        The values of the configurations marked sensitive, as they may show up in deployment output. Values the user
+        was prompted for are taken from ``configuration_values``.
+        """
 
-        # Create project specific configurations dictionary
-        for config in project_configurations:
-            project_configurations_dictionary[config.key] = config.get_value()
+        configuration_values = configuration_values or {}
 
-        stage_configurations_dictionary = {}
-        stage_configurations = self.stage_configurations()
+        values = set()
+        for config in self.get_queryset_configurations(sensitive_value=True):
+            value = configuration_values.get(config.key, config.get_value())
+            if value is None or isinstance(value, bool):
+                continue
 
-        # Create stage specific configurations dictionary
-        for s in stage_configurations:
-            stage_configurations_dictionary[s.key] = s.get_value()
+            # Output is bytes, so match the encoded value
+            value = value.encode('utf-8') if isinstance(value, unicode) else str(value)
+            values.add(value)
 
-        # override project specific configuration with the ones in the stage if they are there
-        project_configurations_dictionary.update(stage_configurations_dictionary)
+            # The way it is quoted on the fab command line
+            values.add(value.replace('"', '\\"'))
 
-        # Return the updated configurations
-        return project_configurations_dictionary
+        return values
 
 
 class Configuration(TrackingFields):
@@ -204,6 +323,70 @@ class Configuration(TrackingFields):
         return self.get_value()
 
 
+class ConfigurationSnapshot(models.Model):
+    """
+    A resolved configuration a deployment ran with, stored as canonical JSON.
+
+    Snapshots are addressed by the hash of their JSON, so every deployment that ran with the same configuration
+    shares one row. Sensitive values are never stored, only the fact that they were set.
+    """
+
+    SENSITIVE_VALUE = '******'
+
+    hash = models.CharField(max_length=64, unique=True)
+    configuration = models.TextField()
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return self.hash[:12]
+
+    @classmethod
+    def for_configuration(cls, configuration):
+        """Return the snapshot of a {key: value} configuration, creating it if nobody ran with it before"""
+
+        data = json.dumps(configuration, sort_keys=True, separators=(',', ':'))
+        digest = hashlib.sha256(data).hexdigest()
+
+        try:
+            return cls.objects.get(hash=digest)
+        except cls.DoesNotExist:
+            pass
+
+        try:
+            with transaction.atomic():
+                return cls.objects.create(hash=digest, configuration=data)
+        except IntegrityError:
+            # Somebody stored the same configuration in the meantime
+            return cls.objects.get(hash=digest)
+
+    def get_configuration(self):
+        return json.loads(self.configuration)
+
+    def diff(self, other):
+        """
+        What changed from this snapshot to ``other``, as a list of {'key', 'old', 'new', 'change'} dictionaries sorted
+        by key. ``change`` is 'added', 'removed' or 'changed'.
+        """
+
+        old = self.get_configuration()
+        new = other.get_configuration()
+
+        changes = []
+        for key in sorted(set(old) | set(new)):
+            if key not in old:
+                change = 'added'
+            elif key not in new:
+                change = 'removed'
+            elif old[key] != new[key]:
+                change = 'changed'
+            else:
+                continue
+
+            changes.append({'key': key, 'old': old.get(key), 'new': new.get(key), 'change': change})
+
+        return changes
+
+
 class Deployment(TrackingFields):
     """Archival record of an actual deployment, tracks:
 
@@ -219,8 +402,9 @@ class Deployment(TrackingFields):
     PENDING = 'pending'
     FAILED = 'failed'
     SUCCESS = 'success'
+    SCHEDULED = 'scheduled'
 
-    STATUS = [(PENDING, 'Pending'), (FAILED, 'Failed'), (SUCCESS, 'Success')]
+    STATUS = [(PENDING, 'Pending'), (FAILED, 'Failed'), (SUCCESS, 'Success'), (SCHEDULED, 'Scheduled')]
 
     user = models.ForeignKey(get_user_model())
     stage = models.ForeignKey(Stage)
@@ -230,8 +414,27 @@ class Deployment(TrackingFields):
     task = models.ForeignKey('projects.Task')
     configuration = models.TextField(null=True, blank=True)
 
+    configuration_snapshot = models.ForeignKey(ConfigurationSnapshot, null=True, blank=True, related_name='deployments',
+                                               on_delete=models.PROTECT)
+
+    # host:pid of the process running the deployment, so no other process or web node runs it as well
+    claimed_by = models.CharField(max_length=255, null=True, blank=True)
+
+    # Bytes the deployment wrote in total; output beyond the stage's log limits is left out of ``output``
+    output_size = models.BigIntegerField(default=0)
+
+    # When the deployment stopped being pending
+    date_finished = models.DateTimeField(null=True, blank=True)
+
+    # A scheduled deployment is run by the deployment scheduler at the first launch window from this time on
+    scheduled_for = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    # The recurring schedule that started it, if any
+    schedule = models.ForeignKey('projects.DeploymentSchedule', null=True, blank=True, related_name='deployments',
+                                 on_delete=models.SET_NULL)
+
     # Managers
-    objects = models.Manager()
+    objects = DeploymentManager()
     active_records = ActiveManager()
     # End Managers
 
@@ -241,6 +444,311 @@ class Deployment(TrackingFields):
     def __unicode__(self):
         return u'Deployment at {} status: {}'.format(self.date_created, self.get_status_display())
 
+    def claim(self):
+        """Claim a pending deployment for this process. Returns False if somebody else already has it."""
+
+        claimed_by = '{}:{}'.format(socket.gethostname(), os.getpid())
+        claimed = Deployment.objects.filter(pk=self.pk, status=self.PENDING, claimed_by__isnull=True).update(claimed_by=claimed_by)
+
+        if claimed:
+            self.claimed_by = claimed_by
+
+        return bool(claimed)
+
+    def release(self):
+        """Make a scheduled deployment pending, ready to run. Returns False if somebody else released it first."""
+
+        released = Deployment.objects.filter(pk=self.pk, status=self.SCHEDULED).update(status=self.PENDING)
+
+        if released:
+            # update() sends no signals, so move it in the daily stats here
+            DeploymentDailyStat.record(self, self.SCHEDULED, -1)
+            DeploymentDailyStat.record(self, self.PENDING, 1)
+            self.status = self._counted_status = self.PENDING
+            invalidate_project_generations([self.stage.project_id])
+
+        return bool(released)
+
+    def snapshot_configuration(self, configuration_values=None):
+        """
+        Record the configuration this deployment runs with. ``configuration_values`` are the values the user was
+        prompted for. Sensitive values are left out.
+        """
+
+        configuration_values = configuration_values or {}
+
+        configuration = {}
+        for config in self.stage.get_resolved_configurations():
+            if config.sensitive_value:
+                configuration[config.key] = ConfigurationSnapshot.SENSITIVE_VALUE
+            else:
+                configuration[config.key] = configuration_values.get(config.key, config.get_value())
+
+        self.configuration_snapshot = ConfigurationSnapshot.for_configuration(configuration)
+
+    def get_previous_deployment(self):
+        """The deployment on the same stage before this one that recorded its configuration"""
+
+        return Deployment.objects.lightweight() \
+            .filter(stage_id=self.stage_id, pk__lt=self.pk, configuration_snapshot__isnull=False).order_by('-pk').first()
+
+    def save_host_logs(self, demultiplexer):
+        """Replace the per-host records of this deployment with what ``demultiplexer`` has indexed so far"""
+
+        hosts = [
+            DeploymentHost(
+                deployment=self,
+                host=log.host,
+                status=log.status,
+                first_seen=log.first_seen,
+                last_seen=log.last_seen,
+                line_count=log.line_count,
+                line_index=json.dumps(demultiplexer.get_index(log)),
+            )
+            for log in demultiplexer.hosts.values()
+        ]
+
+        with transaction.atomic():
+            DeploymentHost.objects.filter(deployment=self).delete()
+            DeploymentHost.objects.bulk_create(hosts)
+
+
+class DeploymentPlan(models.Model):
+    """
+    What a deployment runs with, resolved once when it is created: the task, hosts, fabfile and configuration.
+
+    Sensitive configuration values are not stored, only their keys; they are looked up when fab is started.
+    ``configuration_hash`` is the hash of the deployment's configuration snapshot.
+    """
+
+    deployment = models.OneToOneField(Deployment, related_name='plan')
+    task_name = models.CharField(max_length=255)
+    hosts = models.TextField(default='[]')
+    fabfile_path = models.CharField(max_length=500)
+    env = models.TextField(default='{}')
+    sensitive_keys = models.TextField(default='[]')
+    configuration_hash = models.CharField(max_length=64)
+
+    # Seconds it took to work all of this out
+    planning_duration = models.FloatField(default=0)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return u'Plan for deployment {}'.format(self.deployment_id)
+
+    def get_hosts(self):
+        return json.loads(self.hosts)
+
+    def get_env(self):
+        return json.loads(self.env)
+
+    def get_sensitive_keys(self):
+        return json.loads(self.sensitive_keys)
+
+
+class DeploymentHost(models.Model):
+    """The part of a deployment that ran on one host, indexed into the deployment's output"""
+
+    deployment = models.ForeignKey(Deployment, related_name='hosts')
+    host = models.CharField(max_length=255)
+    status = models.CharField(choices=Deployment.STATUS, max_length=10, default=Deployment.PENDING)
+    first_seen = models.DateTimeField()
+    last_seen = models.DateTimeField()
+
+    # Lines the host wrote in total, and [position, length] pairs of those still in the deployment's stored output
+    line_count = models.PositiveIntegerField(default=0)
+    line_index = models.TextField(default='[]')
+
+    class Meta:
+        ordering = ['host']
+        unique_together = ('deployment', 'host')
+
+    def __unicode__(self):
+        return u'{} status: {}'.format(self.host, self.get_status_display())
+
+    def get_absolute_url(self):
+        return reverse('projects_deployment_host_detail', kwargs={'pk': self.deployment_id, 'host': self.host})
+
+    def get_output(self, output=None):
+        """This host's lines of the deployment output. Pass ``output`` if the deployment is already loaded."""
+
+        if output is None:
+            output = self.deployment.output
+
+        # The index is in bytes of the output stream, and the output comes back from the database as text
+        output = output or ''
+        if isinstance(output, unicode):
+            output = output.encode('utf-8')
+
+        lines = ''.join(output[position:position + length] for position, length in json.loads(self.line_index))
+        return lines.decode('utf-8', 'replace')
+
+
+class DeploymentDailyStat(models.Model):
+    """
+    The number of deployments per stage, day (UTC) and status, kept up to date as deployments are created and
+    finish so the dashboard never has to go through the deployments themselves. ``total_duration`` adds up the
+    seconds the finished deployments took.
+
+    ``manage.py backfilldeploymentstats`` builds them again from the deployments.
+    """
+
+    project = models.ForeignKey(Project, related_name='daily_stats')
+    stage = models.ForeignKey(Stage, related_name='daily_stats')
+    day = models.DateField(db_index=True)
+    status = models.CharField(choices=Deployment.STATUS, max_length=10)
+    count = models.IntegerField(default=0)
+    total_duration = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = ('stage', 'day', 'status')
+
+    def __unicode__(self):
+        return u'{} {} {}: {}'.format(self.stage_id, self.day, self.status, self.count)
+
+    @classmethod
+    def get_day(cls, date):
+        if timezone.is_aware(date):
+            date = date.astimezone(timezone.utc)
+        return date.date()
+
+    @classmethod
+    def get_duration(cls, deployment):
+        if not deployment.date_finished:
+            return 0
+        return (deployment.date_finished - deployment.date_created).total_seconds()
+
+    @classmethod
+    def record(cls, deployment, status, count=1, duration=0):
+        """Add ``count`` deployments in ``status`` (and the seconds they took) to the deployment's stage and day"""
+
+        stats = cls.objects.filter(stage_id=deployment.stage_id, day=cls.get_day(deployment.date_created), status=status)
+        if stats.update(count=F('count') + count, total_duration=F('total_duration') + duration) or count < 0:
+            return
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(project_id=deployment.stage.project_id, stage_id=deployment.stage_id,
+                                   day=cls.get_day(deployment.date_created), status=status, count=count,
+                                   total_duration=duration)
+        except IntegrityError:
+            # Another process got to create it first
+            stats.update(count=F('count') + count, total_duration=F('total_duration') + duration)
+
+    @classmethod
+    def rebuild(cls):
+        """Throw the stats away and count them again from the deployments. Returns the number of stats."""
+
+        totals = Deployment.objects.count_by_day('stage_id', 'stage__project_id', 'status',
+                                                 total_duration=DurationSum('date_finished', start='date_created'))
+        stats = [cls(project_id=item['stage__project_id'], stage_id=item['stage_id'], day=item['day'],
+                     status=item['status'], count=item['count'], total_duration=item['total_duration'] or 0)
+                 for item in totals]
+
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(stats, batch_size=500)
+
+        return len(stats)
+
+
+class DeploymentSchedule(TrackingFields):
+    """
+    A task run on a stage over and over, whenever its cron format matches (the same format launch windows use).
+
+    ``next_fire_at`` is the next time it runs; the deployment scheduler fires it then by creating a scheduled
+    deployment, which runs at the first launch window from that time on.
+
+    A run more than DEPLOYMENT_SCHEDULE_MISFIRE_GRACE_TIME seconds late (the scheduler was down, say) was missed.
+    However many runs were missed, the ``run_once`` policy makes up for them with a single run straight away and
+    ``skip`` drops them; either way the schedule carries on with its first run after that. What happens only
+    depends on ``next_fire_at`` and the time the scheduler gets to it.
+    """
+
+    RUN_ONCE = 'run_once'
+    SKIP = 'skip'
+
+    MISFIRE_POLICIES = [(RUN_ONCE, 'Run once'), (SKIP, 'Skip')]
+
+    stage = models.ForeignKey(Stage, related_name='schedules')
+    task_name = models.CharField(max_length=255)
+    cron_format = models.CharField(max_length=255, help_text='For example \'0 3 * * *\' runs it every night at 3AM.')
+    user = models.ForeignKey(get_user_model(), help_text='The deployments are run as this user.')
+    misfire_policy = models.CharField(choices=MISFIRE_POLICIES, max_length=10, default=RUN_ONCE,
+                                      help_text='What to do about runs missed while the scheduler was down.')
+    enabled = models.BooleanField(default=True)
+
+    next_fire_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    last_fired_at = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return u'{} on {} at {}'.format(self.task_name, self.stage, self.cron_format)
+
+    def clean(self):
+        try:
+            croniter(self.cron_format)
+        except Exception:
+            raise ValidationError('"{}" is not a valid cron format.'.format(self.cron_format))
+
+    def get_next_fire_time(self, after):
+        """The first time the cron format matches after ``after``"""
+
+        # croniter can only localize its results with pytz, so this works on naive times
+        naive = timezone.make_naive(after, timezone.utc) if timezone.is_aware(after) else after
+        return timezone.make_aware(croniter(self.cron_format, naive).get_next(datetime), timezone.utc)
+
+    def get_run(self, now):
+        """
+        For a schedule due at ``now``: (the time of the run to start or None, the next time the schedule fires)
+        """
+
+        grace_time = getattr(settings, 'DEPLOYMENT_SCHEDULE_MISFIRE_GRACE_TIME', 60)
+
+        if (now - self.next_fire_at).total_seconds() <= grace_time:
+            run_at = self.next_fire_at
+        elif self.misfire_policy == self.RUN_ONCE:
+            run_at = now
+        else:
+            run_at = None
+
+        return run_at, self.get_next_fire_time(now)
+
+    def fire(self, now):
+        """
+        Move a due schedule on to its next fire time. Returns the time of the run to start, or None when there is
+        nothing to run: a missed run skipped, or another scheduler fired it first.
+        """
+
+        run_at, next_fire_at = self.get_run(now)
+
+        changes = {'next_fire_at': next_fire_at}
+        if run_at:
+            changes['last_fired_at'] = run_at
+
+        fired = DeploymentSchedule.objects.filter(pk=self.pk, next_fire_at=self.next_fire_at).update(**changes)
+        if not fired:
+            return None
+
+        for name, value in changes.items():
+            setattr(self, name, value)
+
+        return run_at
+
+    def create_deployment(self, scheduled_for):
+        """Create the scheduled deployment for a run. Configurations that prompt for input use their stored value."""
+
+        task, created = Task.objects.get_or_create(name=self.task_name)
+        if not created:
+            Task.objects.filter(pk=task.pk).update(times_used=F('times_used') + 1)
+
+        deployment = Deployment(user_id=self.user_id, stage=self.stage, task=task, schedule=self,
+                                comments=u'Run by schedule {}'.format(self.cron_format),
+                                status=Deployment.SCHEDULED, scheduled_for=scheduled_for)
+        deployment.snapshot_configuration()
+        deployment.save()
+
+        return deployment
+
 
 class Task(models.Model):
     name = models.CharField(max_length=255)
@@ -249,3 +757,108 @@ class Task(models.Model):
 
     def __unicode__(self):
         return u'{} ({})'.format(self.name, self.times_used)
+
+
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+def invalidate_sidebar_projects(sender, instance, **kwargs):
+    from fabric_bolt.core.sidebar import invalidate_sidebar_lists
+    invalidate_sidebar_lists()
+
+
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+@receiver(post_save, sender=Stage)
+@receiver(post_delete, sender=Stage)
+@receiver(post_save, sender=Configuration)
+@receiver(post_delete, sender=Configuration)
+def invalidate_project_fragments(sender, instance, **kwargs):
+    invalidate_project_generations([instance.pk if sender is Project else instance.project_id])
+
+
+@receiver(post_save, sender=Deployment)
+@receiver(post_delete, sender=Deployment)
+def invalidate_deployment_fragments(sender, instance, **kwargs):
+    invalidate_project_generations([instance.stage.project_id])
+
+
+@receiver(m2m_changed, sender=Stage.hosts.through)
+def invalidate_stage_host_fragments(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if not reverse:
+        invalidate_project_generations([instance.project_id])
+    elif action == 'pre_clear':
+        invalidate_project_generations(instance.stage_set.values_list('project_id', flat=True))
+    else:
+        invalidate_project_generations(Stage.objects.filter(pk__in=pk_set).values_list('project_id', flat=True))
+
+
+@receiver(post_save, sender=Host)
+@receiver(pre_delete, sender=Host)
+def invalidate_host_fragments(sender, instance, **kwargs):
+    # Before a delete, while the host is still mapped to its stages
+    invalidate_project_generations(Stage.objects.filter(hosts=instance).values_list('project_id', flat=True))
+
+
+@receiver(post_save, sender=Stage)
+@receiver(post_delete, sender=Stage)
+@receiver(post_save, sender=Configuration)
+@receiver(post_delete, sender=Configuration)
+def invalidate_project_configurations(sender, instance, **kwargs):
+    # A project configuration applies to every stage of the project
+    invalidate_stage_configurations([instance.project_id])
+
+
+@receiver(post_init, sender=Deployment)
+def remember_deployment_status(sender, instance, **kwargs):
+    # The status the deployment is counted under in the daily stats
+    instance._counted_status = instance.status if instance.pk else None
+
+
+@receiver(pre_save, sender=Deployment)
+def finish_deployment(sender, instance, **kwargs):
+    if instance.status not in (Deployment.PENDING, Deployment.SCHEDULED) and instance.date_finished is None:
+        instance.date_finished = timezone.now()
+
+
+@receiver(post_save, sender=Deployment)
+def count_deployment(sender, instance, created, **kwargs):
+    previous = None if created else instance._counted_status
+    if previous == instance.status:
+        return
+
+    duration = DeploymentDailyStat.get_duration(instance)
+    if previous is not None:
+        DeploymentDailyStat.record(instance, previous, -1, 0 if previous == Deployment.PENDING else -duration)
+    DeploymentDailyStat.record(instance, instance.status, 1, duration)
+
+    instance._counted_status = instance.status
+
+
+@receiver(post_delete, sender=Deployment)
+def uncount_deployment(sender, instance, **kwargs):
+    if instance._counted_status is not None:
+        DeploymentDailyStat.record(instance, instance._counted_status, -1, -DeploymentDailyStat.get_duration(instance))
+
+
+@receiver(post_init, sender=DeploymentSchedule)
+def remember_schedule_timing(sender, instance, **kwargs):
+    instance._saved_timing = (instance.cron_format, instance.enabled) if instance.pk else None
+
+
+@receiver(pre_save, sender=DeploymentSchedule)
+def plan_schedule(sender, instance, **kwargs):
+    # Start over from now when the schedule is new, changed or turned back on, rather than make up for the past
+    if instance.next_fire_at is None or instance._saved_timing != (instance.cron_format, instance.enabled):
+        instance.next_fire_at = instance.get_next_fire_time(timezone.now())
+
+
+@receiver(post_save, sender=DeploymentSchedule)
+@receiver(post_delete, sender=DeploymentSchedule)
+def notify_schedule_changed(sender, instance, **kwargs):
+    from fabric_bolt.projects.scheduler import notify_scheduler
+    notify_scheduler(instance)
+
+    instance._saved_timing = (instance.cron_format, instance.enabled)
@@ -0,0 +1,444 @@
+"""Helpers for reading and processing the output of a running deployment"""
+
+import os
+import re
+import time
+from collections import OrderedDict, deque
+
+from django.conf import settings
+from django.utils import timezone
+from gevent.socket import wait_read
+
+
+def iter_process_output(process, chunk_size=4096):
+    """Yield chunks of a process's stdout as soon as they are written.
+
+    The calling greenlet sleeps in the gevent hub until the pipe is readable, so an idle deployment costs no CPU.
+    The generator ends at EOF, which happens when the child exits and closes its end of the pipe.
+    """
+
+    fd = process.stdout.fileno()
+    while True:
+        wait_read(fd)
+
+        chunk = os.read(fd, chunk_size)
+        if not chunk:
+            break
+
+        yield chunk
+
+
+class OutputRetention(object):
+    """
+    Keeps a bounded copy of a deployment's output: the first ``head_size`` bytes and a rolling last ``tail_size``.
+
+    Whatever falls in between is dropped and replaced by a marker saying how many bytes went missing, so a task stuck
+    in a loop can't fill up memory or the ``Deployment.output`` column. ``size`` counts every byte ever appended.
+    """
+
+    marker = '\n\n... {} bytes of output truncated ...\n\n'
+
+    def __init__(self, head_size=None, tail_size=None):
+        self.head_size = head_size if head_size is not None else getattr(settings, 'DEPLOYMENT_OUTPUT_HEAD_SIZE', 2 * 1024 * 1024)
+        self.tail_size = tail_size if tail_size is not None else getattr(settings, 'DEPLOYMENT_OUTPUT_TAIL_SIZE', 2 * 1024 * 1024)
+
+        self.head = []
+        self.head_bytes = 0
+        self.tail = deque()
+        self.tail_bytes = 0
+        self.size = 0
+
+    @classmethod
+    def for_stage(cls, stage):
+        return cls(stage.log_head_size, stage.log_tail_size)
+
+    @property
+    def dropped(self):
+        return self.size - self.head_bytes - self.tail_bytes
+
+    def append(self, data):
+        if not data:
+            return
+
+        self.size += len(data)
+
+        if self.head_bytes < self.head_size:
+            head = data[:self.head_size - self.head_bytes]
+            self.head.append(head)
+            self.head_bytes += len(head)
+            data = data[len(head):]
+
+        if not data or not self.tail_size:
+            return
+
+        self.tail.append(data)
+        self.tail_bytes += len(data)
+
+        while self.tail_bytes > self.tail_size:
+            excess = self.tail_bytes - self.tail_size
+            oldest = self.tail.popleft()
+            if len(oldest) > excess:
+                self.tail.appendleft(oldest[excess:])
+                self.tail_bytes -= excess
+            else:
+                self.tail_bytes -= len(oldest)
+
+    def locate(self, offset, length):
+        """Return where ``length`` bytes written at stream ``offset`` are in ``getvalue()``, or None if dropped"""
+
+        if offset + length <= self.head_bytes:
+            return offset
+
+        if offset < self.size - self.tail_bytes:
+            return None
+
+        retained = self.head_bytes + self.tail_bytes
+        if self.dropped:
+            retained += len(self.marker.format(self.dropped))
+
+        return retained - (self.size - offset)
+
+    def chunks(self):
+        """The retained output as a list of chunks, with the truncation marker where output was dropped"""
+
+        if self.dropped:
+            return self.head + [self.marker.format(self.dropped)] + list(self.tail)
+
+        return self.head + list(self.tail)
+
+    def getvalue(self):
+        return ''.join(self.chunks())
+
+
+class OutputRateLimiter(object):
+    """
+    Caps the rate at which output is streamed to watchers, in bytes per second.
+
+    Output over the limit is not sent live (it is still kept by ``OutputRetention``). Once the deployment calms down,
+    or when it finishes, watchers get a note saying how much they missed. A ``rate`` of None disables the limit.
+    """
+
+    note = '\n... {} bytes of output not streamed, over the rate limit ...\n'
+
+    def __init__(self, rate=None, burst=None, clock=time.time):
+        self.rate = rate
+        self.burst = burst or rate
+        self.clock = clock
+
+        self.tokens = self.burst
+        self.updated = clock()
+        self.suppressed = 0
+        self.total_suppressed = 0
+
+    @classmethod
+    def from_settings(cls):
+        return cls(getattr(settings, 'DEPLOYMENT_OUTPUT_RATE_LIMIT', None))
+
+    def allow(self, data):
+        """Return whether ``data`` may be streamed now. Call ``flush`` first for the note about anything held back."""
+
+        if self.rate is None:
+            return True
+
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens <= 0:
+            self.suppressed += len(data)
+            self.total_suppressed += len(data)
+            return False
+
+        # Let a chunk through as long as there is any allowance left; the debt is paid off before the next one
+        self.tokens -= len(data)
+
+        return True
+
+    def flush(self):
+        """Return the note for output suppressed since the last chunk that was let through, if any"""
+
+        if not self.suppressed:
+            return ''
+
+        note = self.note.format(self.suppressed)
+        self.suppressed = 0
+
+        return note
+
+
+class HostLog(object):
+    """What one host did during a deployment: its status, when it was seen and where its lines are in the output"""
+
+    def __init__(self, host, now):
+        self.host = host
+        self.status = 'pending'
+        self.first_seen = self.last_seen = now
+        self.line_count = 0
+        self.lines = []
+
+
+class HostDemultiplexer(object):
+    """
+    Splits deployment output into per-host line indexes as it streams.
+
+    Fabric prefixes what it does on a host with ``[host] run:``, ``[host] out:`` and so on. Every such line is
+    recorded against its host as an (offset, length) pair in bytes of the output stream, so showing one host's log only
+    touches that host's lines. Lines ``retention`` drops are forgotten as well, so the indexes stay as bounded as the
+    stored output. The ``Fatal error`` block Fabric prints when a command fails isn't prefixed; it goes
+    to the host that was last active, which is the failing one when hosts run one after the other.
+    """
+
+    prefix_re = re.compile(r'^\[(?P<host>[^\]]+)\] ')
+    failure_prefixes = ('Fatal error:', 'Aborting.')
+
+    # Indexed lines between checks for lines the retention has dropped
+    prune_interval = 10000
+
+    def __init__(self, retention, clock=timezone.now):
+        self.retention = retention
+        self.clock = clock
+        self.unpruned = 0
+        self.hosts = OrderedDict()
+        self.current = None
+        self.in_failure = False
+
+        self.partial = ''
+        self.partial_offset = 0
+
+    def feed(self, data, offset):
+        """Index a chunk of output written at stream ``offset``. Chunks don't need to end on a line boundary."""
+
+        if self.partial:
+            data = self.partial + data
+            offset = self.partial_offset
+
+        lines = data.splitlines(True)
+        if lines and not lines[-1].endswith('\n'):
+            last = lines.pop()
+            self.partial = last
+            self.partial_offset = offset + len(data) - len(last)
+        else:
+            self.partial = ''
+
+        now = self.clock()
+        for line in lines:
+            self.add_line(line, offset, now)
+            offset += len(line)
+
+    def add_line(self, line, offset, now):
+        match = self.prefix_re.match(line)
+
+        if match:
+            host = match.group('host')
+            self.in_failure = 'Fatal error:' in line
+        elif line.startswith(self.failure_prefixes) and self.current is not None:
+            host = self.current
+            self.in_failure = True
+        elif self.in_failure and self.current is not None and line.strip():
+            # The rest of the error block: what was requested and executed
+            host = self.current
+        else:
+            return
+
+        log = self.hosts.get(host)
+        if log is None:
+            log = self.hosts[host] = HostLog(host, now)
+
+        if self.in_failure:
+            log.status = 'failed'
+
+        log.last_seen = now
+        log.line_count += 1
+        log.lines.append((offset, len(line)))
+
+        self.current = host
+
+        self.unpruned += 1
+        if self.unpruned >= self.prune_interval:
+            self.prune()
+
+    def finish(self, status):
+        """Flush the last partial line and settle the status of every host given the deployment's ``status``"""
+
+        if self.partial:
+            self.add_line(self.partial, self.partial_offset, self.clock())
+            self.partial = ''
+
+        for log in self.hosts.values():
+            if log.status != 'pending':
+                continue
+
+            # Hosts run one after the other, so a failed run failed on the last one it got to
+            log.status = status if log.host == self.current else 'success'
+
+    def prune(self):
+        for log in self.hosts.values():
+            log.lines = [(offset, length) for offset, length in log.lines
+                         if self.retention.locate(offset, length) is not None]
+
+        self.unpruned = 0
+
+    def get_index(self, log):
+        """``log``'s lines as (position, length) pairs into the retained output"""
+
+        index = []
+        for offset, length in log.lines:
+            position = self.retention.locate(offset, length)
+            if position is not None:
+                index.append((position, length))
+
+        return index
+
+
+class Redactor(object):
+    """
+    Scrubs secrets out of deployment output as it streams.
+
+    An Aho-Corasick automaton over all the secrets finds every occurrence in a single pass, so the cost per byte
+    doesn't grow with the number of secrets. A secret may be split across chunks: text that could still turn out to
+    be part of a secret is held back until the next chunk (or ``flush``) settles it. Each run of secret text is
+    replaced with ``mask``, which doesn't give away how long the secret was.
+    """
+
+    mask = '********'
+
+    def __init__(self, secrets, mask=None):
+        if mask is not None:
+            self.mask = mask
+
+        # goto[state] maps a character to the next state, depth[state] is the length of the text the state stands
+        # for and match[state] the length of the longest secret ending there (following the failure links)
+        self.goto = [{}]
+        self.fail = [0]
+        self.depth = [0]
+        self.match = [0]
+
+        for secret in set(secrets):
+            if secret:
+                self.add(secret)
+
+        self.build()
+
+        # Characters that can start a secret. From the root state we can skip straight to the next one of them.
+        first_chars = ''.join(re.escape(char) for char in self.goto[0])
+        self.start_re = re.compile('[{}]'.format(first_chars)) if first_chars else None
+
+        self.state = 0
+        # Text not sent on yet, which starts at ``released`` in the output
+        self.pending = ''
+        self.released = 0
+        # Secret runs in the pending text as [start, end) positions in the output
+        self.ranges = []
+        # End of the last mask sent on, so a secret running on from it doesn't get a second mask
+        self.masked_to = -1
+
+    @classmethod
+    def for_stage(cls, stage, configuration_values=None):
+        return cls(stage.get_sensitive_values(configuration_values))
+
+    def add(self, secret):
+        state = 0
+        for char in secret:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.depth.append(self.depth[state] + 1)
+                self.match.append(0)
+                self.goto[state][char] = next_state
+            state = next_state
+
+        self.match[state] = len(secret)
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                if state:
+                    fail = self.goto[fail].get(char, 0)
+
+                self.fail[next_state] = fail
+                self.match[next_state] = max(self.match[next_state], self.match[fail])
+
+    def scan(self, text, index):
+        goto, fail, match, ranges = self.goto, self.fail, self.match, self.ranges
+
+        state = self.state
+        length = len(text)
+        while index < length:
+            if not state:
+                found = self.start_re.search(text, index)
+                if found is None:
+                    break
+                index = found.start()
+
+            char = text[index]
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            index += 1
+
+            if match[state]:
+                end = self.released + index
+                start = end - match[state]
+
+                # A longer secret can swallow runs found before it
+                while ranges and start <= ranges[-1][1]:
+                    start = min(start, ranges.pop()[0])
+                ranges.append([start, end])
+
+        self.state = state
+
+    def release(self, text, upto):
+        """Send on ``text`` (starting at ``released``) up to output position ``upto``, masking the secrets in it"""
+
+        output = []
+        position = self.released
+        while self.ranges and self.ranges[0][0] < upto:
+            start, end = self.ranges.pop(0)
+            if start > self.masked_to:
+                output.append(text[position - self.released:start - self.released])
+                output.append(self.mask)
+            position = max(position, end)
+            self.masked_to = end
+
+        if position < upto:
+            output.append(text[position - self.released:upto - self.released])
+            position = upto
+
+        self.pending = text[position - self.released:]
+        self.released = position
+
+        return ''.join(output)
+
+    def feed(self, data):
+        """Redact a chunk of output; returns the part of it that is safe to send on now"""
+
+        if self.start_re is None:
+            return data
+
+        text = self.pending + data
+        self.scan(text, len(self.pending))
+
+        # Text the automaton is still in the middle of could turn out to be a secret; everything before it can't.
+        # A secret running into that text is masked and sent on whole, and a longer match joins its mask later.
+        safe = self.released + len(text) - self.depth[self.state]
+        if self.ranges and self.ranges[-1][0] < safe < self.ranges[-1][1]:
+            safe = self.ranges[-1][1]
+
+        return self.release(text, safe)
+
+    def flush(self):
+        """Return whatever is still held back, at the end of the output"""
+
+        text = self.pending
+        self.state = 0
+
+        return self.release(text, self.released + len(text))
@@ -0,0 +1,245 @@
+"""
+Planning a deployment: everything that has to be worked out before fab can run.
+
+``get_deployment_plan`` resolves the hosts, configuration and fabfile of a deployment once and stores them as a
+``DeploymentPlan``. Every executor (the plain streaming view, the socket.io namespace, the gateway) builds its fab
+command from that plan with ``build_fab_command``, so they all run exactly the same thing and none of them repeats
+the work.
+"""
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+
+from django.conf import settings
+from django.utils.text import slugify
+from git import Repo
+
+from fabric_bolt.projects.models import DeploymentPlan
+
+
+logger = logging.getLogger('fabric_bolt.planning')
+
+# These options are passed to Fabric as: fab task --abort-on-prompts=True --user=root ...
+fabric_special_options = ['no_agent', 'forward-agent', 'config', 'disable-known-hosts', 'keepalive',
+                          'password', 'parallel', 'no-pty', 'reject-unknown-hosts', 'skip-bad-hosts', 'timeout',
+                          'command-timeout', 'user', 'warn-only', 'pool-size']
+
+FAB_LOADER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fab_loader', 'fabric_bolt_loader.py')
+
+
+def get_fabfile_path(project):
+    if project.use_repo_fabfile:
+        repo_dir = os.path.join(settings.PUBLIC_DIR, '.repo_caches', slugify(project.name))
+        if not os.path.exists(repo_dir):
+            os.makedirs(repo_dir)
+            Repo.clone_from(project.repo_url, repo_dir) # we may want to do a git pull if it already exists?
+
+        install_fabfile_requirements(project, repo_dir)
+
+        fabfile_path = os.path.join(repo_dir, 'fabfile.py')
+    else:
+        fabfile_path = settings.FABFILE_PATH
+
+    return fabfile_path
+
+
+def install_fabfile_requirements(project, repo_dir):
+    """pip install the project's fabfile requirements, unless they were already installed as they are now"""
+
+    requirements = project.fabfile_requirements or ''
+    if not requirements.strip():
+        return
+
+    marker_path = os.path.join(repo_dir, '.fabfile_requirements')
+    digest = hashlib.sha1(requirements.encode('utf-8')).hexdigest()
+
+    if os.path.exists(marker_path):
+        with open(marker_path) as marker:
+            if marker.read() == digest:
+                return
+
+    pip_installs = ' '.join(requirements.splitlines())
+    if subprocess.call(['pip install {}'.format(pip_installs), '--target {}'.format(repo_dir)], shell=True) == 0:
+        with open(marker_path, 'w') as marker:
+            marker.write(digest)
+
+
+def get_fab_environment_path(deployment):
+    directory = getattr(settings, 'DEPLOYMENT_ENVIRONMENT_DIR', None) or \
+        os.path.join(tempfile.gettempdir(), 'fabric_bolt_environments')
+
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    return os.path.join(directory, '{}.json'.format(deployment.pk))
+
+
+def write_fab_environment(deployment, environment):
+    """Write the environment file for a deployment, readable by this user only, and return its path"""
+
+    path = get_fab_environment_path(deployment)
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as environment_file:
+        json.dump(environment, environment_file)
+
+    return path
+
+
+def remove_fab_environment(deployment):
+    """The fabfile loader removes the file once it has read it; this covers a fab that never got that far"""
+
+    try:
+        os.unlink(get_fab_environment_path(deployment))
+    except OSError:
+        pass
+
+
+def plan_deployment(deployment, configuration_values=None):
+    """
+    Resolve what a deployment runs with and store it as its ``DeploymentPlan``. ``configuration_values`` are the
+    values the user was prompted for. Sensitive values are only noted by key and looked up again at run time.
+    """
+
+    started = time.time()
+    configuration_values = configuration_values or {}
+    stage = deployment.stage
+
+    env = {}
+    sensitive_keys = []
+    for config in stage.get_resolved_configurations():
+        if config.sensitive_value:
+            sensitive_keys.append(config.key)
+        else:
+            env[config.key] = configuration_values.get(config.key, config.get_value())
+
+    if deployment.configuration_snapshot is None:
+        deployment.snapshot_configuration(configuration_values)
+        deployment.save()
+
+    plan = DeploymentPlan(
+        deployment=deployment,
+        task_name=deployment.task.name,
+        hosts=json.dumps(list(stage.hosts.values_list('name', flat=True))),
+        fabfile_path=get_fabfile_path(stage.project),
+        env=json.dumps(env),
+        sensitive_keys=json.dumps(sensitive_keys),
+        configuration_hash=deployment.configuration_snapshot.hash,
+    )
+    plan.planning_duration = time.time() - started
+    plan.save()
+
+    logger.info('Planned deployment %s in %.1f ms', deployment.pk, plan.planning_duration * 1000)
+
+    return plan
+
+
+def get_deployment_plan(deployment, configuration_values=None):
+    """Return the plan of a deployment, planning it now if that didn't happen when it was created"""
+
+    try:
+        return DeploymentPlan.objects.get(deployment=deployment)
+    except DeploymentPlan.DoesNotExist:
+        return plan_deployment(deployment, configuration_values)
+
+
+def build_fab_command(deployment, configuration_values, abort_on_prompts=True, delivery=None):
+    """
+    Build the fab command (as a list of arguments) that runs a deployment's task against its stage
+
+    Executors that can forward the user's input to the process pass abort_on_prompts=False.
+
+    With the 'file' delivery (DEPLOYMENT_CONFIG_DELIVERY) the hosts and configurations are written to a file the
+    fab_loader fabfile reads, and the command line stays the same size however big the stage is. The
+    'command_line' delivery passes everything as --hosts and --set arguments instead.
+    """
+    delivery = delivery or getattr(settings, 'DEPLOYMENT_CONFIG_DELIVERY', 'file')
+
+    plan = get_deployment_plan(deployment, configuration_values)
+
+    command = [getattr(settings, 'VENV_PATH', '') + 'fab', plan.task_name]
+
+    if abort_on_prompts:
+        command.append('--abort-on-prompts')
+
+    hosts = plan.get_hosts()
+
+    # The plan has everything but the secrets, which are never stored with it
+    config = plan.get_env()
+
+    sensitive_keys = plan.get_sensitive_keys()
+    if sensitive_keys:
+        for stage_config in deployment.stage.get_resolved_configurations():
+            if stage_config.key in sensitive_keys:
+                config[stage_config.key] = stage_config.get_value()
+
+    config.update(configuration_values)
+
+    command_to_config = {x.replace('-', '_'): x for x in fabric_special_options}
+
+    # Take the special env variables out
+    normal_options = list(set(config.keys()) - set(command_to_config.keys()))
+
+    # Special ones get set a different way
+    special_options = list(set(config.keys()) & set(command_to_config.keys()))
+
+    def get_key_value_string(key, value):
+        if isinstance(value, bool):
+            return key + ('' if value else '=')
+        elif isinstance(value, float):
+            return key + '=' + str(value)
+        else:
+            return '{}={}'.format(key, value.replace('"', '\\"'))
+
+    def get_env_value(value):
+        # What the fabfile would have got from --set
+        if isinstance(value, bool):
+            return True if value else ''
+        elif isinstance(value, float):
+            return str(value)
+        else:
+            return value
+
+    if delivery == 'file':
+        # The rc file is read before any fabfile is loaded, so it has to stay a flag
+        if 'config' in special_options:
+            special_options.remove('config')
+            command.append('--' + get_key_value_string('config', config['config']))
+
+        path = write_fab_environment(deployment, {
+            'fabfile': plan.fabfile_path,
+            'hosts': hosts,
+            'env': dict((key, get_env_value(config[key])) for key in normal_options),
+            'options': dict((command_to_config[key], config[key]) for key in special_options),
+        })
+
+        command.append('--set')
+        command.append('fabric_bolt_environment=' + path)
+        command.append('--fabfile={}'.format(FAB_LOADER_PATH))
+
+        return command
+
+    if hosts:
+        command.append('--hosts=' + ','.join(hosts))
+
+    if normal_options:
+        command.append('--set')
+        command.append(','.join(get_key_value_string(key, config[key]) for key in normal_options))
+
+    if special_options:
+        for key in special_options:
+            command.append('--' + get_key_value_string(command_to_config[key], config[key]))
+
+    command.append('--fabfile={}'.format(plan.fabfile_path))
+
+    return command
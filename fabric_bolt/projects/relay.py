@@ -0,0 +1,456 @@
+"""
+Cross-process relay for live deployment output.
+
+The process running a deployment writes its output into a memory-mapped ring buffer file, one per deployment, in
+DEPLOYMENT_RELAY_DIR. Any other process on the host (another uWSGI or gunicorn worker, the socket.io server, the
+gateway) can attach to that file and stream the live tail without talking to the process that owns the deployment.
+
+File layout: a fixed header followed by ``capacity`` bytes of ring buffer.
+
+    magic     4s   'FBR2'
+    pid       i    process writing the relay
+    capacity  Q    size of the ring buffer
+    position  Q    total number of bytes ever written, the ring offset is position % capacity
+    state     i    RUNNING, SUCCESS or FAILED
+    started   Q    when the writing process started (see get_process_start), so a reused pid isn't taken for it
+
+Creating the file is also how a process claims a deployment: it is linked into place atomically, so exactly one
+process on the host gets to run it and everybody else follows along.
+
+Readers don't poll. Each one binds a Unix datagram socket next to the relay and registers it with the writer's
+``.wake`` socket; after every write (and when the run ends) the writer sends each registered reader a datagram, and
+the reader blocks in select() until one arrives. Where the sockets can't be set up readers fall back to polling.
+"""
+
+import errno
+import itertools
+import mmap
+import os
+import select
+import socket
+import struct
+import time
+
+from django.conf import settings
+
+
+MAGIC = 'FBR2'
+
+HEADER = struct.Struct('=4siQQiQ')
+POSITION = struct.Struct('=Q')
+POSITION_OFFSET = 16
+STATE = struct.Struct('=i')
+STATE_OFFSET = 24
+
+RUNNING = 0
+SUCCESS = 1
+FAILED = 2
+
+STATUSES = {SUCCESS: 'success', FAILED: 'failed'}
+
+# Seconds after which a takeover marker is stale even if the process that made it still seems to be there; a takeover
+# only takes a few system calls
+TAKEOVER_TIMEOUT = 30
+
+_reader_numbers = itertools.count()
+
+
+class RelayInUse(Exception):
+    """Another process is already running (and relaying) this deployment"""
+
+
+class RelayNotFound(Exception):
+    """Nobody on this host is relaying this deployment"""
+
+
+def get_relay_dir():
+    return getattr(settings, 'DEPLOYMENT_RELAY_DIR', None) or os.path.join(settings.PUBLIC_DIR, '.deployment_relay')
+
+
+def get_relay_path(deployment_id):
+    return os.path.join(get_relay_dir(), '{}.relay'.format(int(deployment_id)))
+
+
+def get_process_start(pid):
+    """When process ``pid`` started, in clock ticks after boot (from /proc), or 0 where that can't be found out"""
+
+    try:
+        with open('/proc/{}/stat'.format(pid)) as stat_file:
+            stat = stat_file.read()
+    except IOError:
+        return 0
+
+    # Field 22; the command name before it is in parentheses and can hold spaces
+    return int(stat[stat.rindex(')') + 2:].split()[19])
+
+
+def process_alive(pid, started=0):
+    """Whether ``pid`` is running and, when ``started`` is known, is the same process rather than one given its pid"""
+
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno != errno.EPERM:
+            return False
+
+    current = get_process_start(pid)
+    return not (started and current and current != started)
+
+
+def get_wake_path(path):
+    return path + '.wake'
+
+
+def is_missing_socket_error(error):
+    return error.errno in (errno.ENOENT, errno.ECONNREFUSED, errno.ENOTSOCK)
+
+
+class RelayWriter(object):
+    """Claims a deployment for this process and publishes its output to other processes"""
+
+    def __init__(self, deployment_id, capacity=None):
+        self.path = get_relay_path(deployment_id)
+        self.capacity = capacity or getattr(settings, 'DEPLOYMENT_RELAY_CAPACITY', 1024 * 1024)
+        self.position = 0
+
+        relay_dir = get_relay_dir()
+        if not os.path.exists(relay_dir):
+            try:
+                os.makedirs(relay_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        # Build the file under a private name, then link it into place so readers never see a half written header
+        temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        fd = os.open(temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, HEADER.size + self.capacity)
+            self.map = mmap.mmap(fd, HEADER.size + self.capacity)
+        finally:
+            os.close(fd)
+
+        HEADER.pack_into(self.map, 0, MAGIC, os.getpid(), self.capacity, 0, RUNNING, get_process_start(os.getpid()))
+
+        try:
+            self.claim(temp_path, deployment_id)
+        except:
+            self.map.close()
+            raise
+        finally:
+            os.unlink(temp_path)
+
+        self.readers = set()
+        self.wake_socket = None
+        try:
+            self.wake_socket = self.bind_wake_socket()
+        except socket.error:
+            # Readers poll instead
+            pass
+
+    def bind_wake_socket(self):
+        wake_path = get_wake_path(self.path)
+        try:
+            # Left behind by a process that died
+            os.unlink(wake_path)
+        except OSError:
+            pass
+
+        wake_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            wake_socket.bind(wake_path)
+            wake_socket.setblocking(False)
+        except socket.error:
+            wake_socket.close()
+            raise
+        return wake_socket
+
+    def claim(self, temp_path, deployment_id):
+        try:
+            os.link(temp_path, self.path)
+            return
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Left behind by a process that died mid deployment? Then it's ours to take over.
+        stale_pid = self.get_stale_pid(deployment_id)
+        if stale_pid is None:
+            raise RelayInUse(deployment_id)
+
+        # Several processes can find the same dead relay; only the one that creates its takeover marker replaces it
+        number = self.lock_takeover(deployment_id, stale_pid)
+        try:
+            # Somebody may have finished taking it over before we got the marker
+            if self.get_stale_pid(deployment_id) != stale_pid:
+                raise RelayInUse(deployment_id)
+
+            os.unlink(self.path)
+            try:
+                os.link(temp_path, self.path)
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    raise RelayInUse(deployment_id)
+                raise
+        finally:
+            # Ours, and any stale ones before it
+            for marker_number in range(number + 1):
+                try:
+                    os.unlink(self.get_marker_path(stale_pid, marker_number))
+                except OSError:
+                    pass
+
+    def get_marker_path(self, stale_pid, number):
+        return '{}.{}.takeover.{}'.format(self.path, stale_pid, number)
+
+    def lock_takeover(self, deployment_id, stale_pid):
+        """
+        Create the marker that lets this process, alone, replace the relay ``stale_pid`` left behind, and return its
+        number. A marker records who made it and when; one whose process died (or that is older than
+        TAKEOVER_TIMEOUT) is passed over for the next number, which again only one process can create.
+        """
+
+        for number in itertools.count():
+            marker_path = self.get_marker_path(stale_pid, number)
+            try:
+                fd = os.open(marker_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                if not self.is_stale_marker(marker_path):
+                    raise RelayInUse(deployment_id)
+                continue
+
+            try:
+                os.write(fd, '{} {} {}'.format(os.getpid(), get_process_start(os.getpid()), time.time()))
+            finally:
+                os.close(fd)
+            return number
+
+    def is_stale_marker(self, marker_path):
+        try:
+            with open(marker_path) as marker_file:
+                fields = marker_file.read().split()
+            modified = os.path.getmtime(marker_path)
+        except (IOError, OSError):
+            # Gone already: its takeover is over
+            return True
+
+        if len(fields) != 3:
+            # Only just created, or its process died before it could say who it is
+            return time.time() - modified > TAKEOVER_TIMEOUT
+
+        pid, started, created = int(fields[0]), int(fields[1]), float(fields[2])
+        return time.time() - created > TAKEOVER_TIMEOUT or not process_alive(pid, started)
+
+    def get_stale_pid(self, deployment_id):
+        """The pid of the dead process that left this deployment's relay behind, None if its writer is alive"""
+
+        try:
+            reader = RelayReader(deployment_id)
+        except RelayNotFound:
+            return None
+
+        try:
+            return None if reader.writer_alive() else reader.pid
+        finally:
+            reader.map.close()
+
+    def write(self, data):
+        if not data:
+            return
+
+        end = self.position + len(data)
+
+        # Only the newest ``capacity`` bytes can ever be read back
+        data = data[-self.capacity:]
+        start = end - len(data)
+
+        offset = start % self.capacity
+        first = min(len(data), self.capacity - offset)
+        self.map[HEADER.size + offset:HEADER.size + offset + first] = data[:first]
+        if first < len(data):
+            self.map[HEADER.size:HEADER.size + len(data) - first] = data[first:]
+
+        # Publish the new position only after the bytes are in place
+        self.position = end
+        POSITION.pack_into(self.map, POSITION_OFFSET, self.position)
+
+        self.wake_readers()
+
+    def wake_readers(self):
+        if self.wake_socket is None:
+            return
+
+        # Take in the readers that registered since the last write
+        while True:
+            try:
+                self.readers.add(self.wake_socket.recvfrom(64)[1])
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+        for address in list(self.readers):
+            try:
+                self.wake_socket.sendto('.', address)
+            except socket.error as e:
+                if is_missing_socket_error(e):
+                    self.readers.discard(address)
+                # Otherwise its buffer is full of wake ups it hasn't got to yet
+
+    def close(self, status):
+        """Mark the run as finished and remove the relay; attached readers still drain what is left"""
+
+        STATE.pack_into(self.map, STATE_OFFSET, SUCCESS if status == STATUSES[SUCCESS] else FAILED)
+        self.wake_readers()
+        self.map.close()
+        self.discard()
+
+    def discard(self):
+        for path in (self.path, get_wake_path(self.path)):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+        if self.wake_socket is not None:
+            self.wake_socket.close()
+            self.wake_socket = None
+
+
+class RelayReader(object):
+    """Follows the output another process is writing to a deployment's relay"""
+
+    def __init__(self, deployment_id):
+        self.path = path = get_relay_path(deployment_id)
+
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise RelayNotFound(deployment_id)
+            raise
+
+        try:
+            self.map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+
+        magic, self.pid, self.capacity, position, state, self.started = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.map.close()
+            raise RelayNotFound(deployment_id)
+
+        self.cursor = 0
+        self.final_status = None
+
+    @property
+    def position(self):
+        return POSITION.unpack_from(self.map, POSITION_OFFSET)[0]
+
+    @property
+    def state(self):
+        return STATE.unpack_from(self.map, STATE_OFFSET)[0]
+
+    def writer_alive(self):
+        return process_alive(self.pid, self.started)
+
+    def read(self):
+        """Return (data, skipped_bytes) written since the last read"""
+
+        position = self.position
+        skipped = 0
+        if position - self.cursor > self.capacity:
+            skipped = position - self.capacity - self.cursor
+            self.cursor = position - self.capacity
+
+        start = self.cursor % self.capacity
+        length = position - self.cursor
+        first = min(length, self.capacity - start)
+        data = self.map[HEADER.size + start:HEADER.size + start + first]
+        if first < length:
+            data += self.map[HEADER.size:HEADER.size + length - first]
+
+        # The writer may have lapped us while we copied; throw away whatever it overwrote
+        overwritten = self.position - self.capacity - self.cursor
+        if overwritten > 0:
+            data = data[overwritten:]
+            skipped += overwritten
+
+        self.cursor = position
+
+        return data, skipped
+
+    def iter_chunks(self, select=select.select, check_interval=1, min_interval=0.01, max_interval=0.25):
+        """
+        Yield output chunks until the writer finishes, then close the relay.
+
+        Between chunks the reader blocks until the writer wakes it, checking every ``check_interval`` seconds that
+        the writer is still alive. ``select`` should be ``gevent.select.select`` inside an unpatched gevent process.
+        Without a wake socket it polls instead, backing off while the deployment is quiet. Afterwards
+        ``final_status`` holds the deployment status the writer reported, or None if the writing process died
+        without finishing.
+        """
+
+        wake_socket = self.register()
+        interval = min_interval
+        try:
+            while True:
+                state = self.state
+                data, skipped = self.read()
+
+                if skipped:
+                    yield '\n... {} bytes skipped ...\n'.format(skipped)
+                if data:
+                    yield data
+                    interval = min_interval
+                    continue
+
+                if state != RUNNING or not self.writer_alive():
+                    self.final_status = STATUSES.get(state)
+                    break
+
+                if wake_socket is not None:
+                    select([wake_socket], [], [], check_interval)
+                    self.drain(wake_socket)
+                else:
+                    select([], [], [], interval)
+                    interval = min(interval * 2, max_interval)
+                    # The writer may not have bound its socket yet when we attached
+                    wake_socket = self.register()
+        finally:
+            self.map.close()
+            if wake_socket is not None:
+                address = wake_socket.getsockname()
+                wake_socket.close()
+                try:
+                    os.unlink(address)
+                except OSError:
+                    pass
+
+    def register(self):
+        """Ask the writer to wake us after each write. Returns the socket the wake ups arrive on, or None."""
+
+        address = '{}.{}.{}.reader'.format(self.path, os.getpid(), next(_reader_numbers))
+        wake_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            wake_socket.bind(address)
+            wake_socket.setblocking(False)
+            wake_socket.sendto('.', get_wake_path(self.path))
+        except socket.error:
+            wake_socket.close()
+            try:
+                os.unlink(address)
+            except OSError:
+                pass
+            return None
+
+        return wake_socket
+
+    def drain(self, wake_socket):
+        while True:
+            try:
+                wake_socket.recv(64)
+            except socket.error:
+                break
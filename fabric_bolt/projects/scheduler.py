@@ -0,0 +1,247 @@
+"""
+Run scheduled deployments when their launch window opens, and fire recurring deployment schedules.
+
+``manage.py rundeploymentscheduler`` keeps two heaps:
+
+- every scheduled deployment, ordered by the time it may run: the first moment a launch window is open from its
+  ``scheduled_for`` on. Whatever is due is released into the executor (``streaming.start_deployment``) in batches
+  of DEPLOYMENT_SCHEDULER_BATCH_SIZE.
+- every enabled deployment schedule, ordered by ``next_fire_at``. Firing one creates a scheduled deployment, which
+  goes onto the first heap, and puts the schedule back with its next fire time: a couple of heap operations and
+  queries, however many schedules there are.
+
+It sleeps until the first of those is due, or until it is told through the event broker about a newly scheduled
+deployment or a changed schedule. Everything is loaded again every DEPLOYMENT_SCHEDULER_RECHECK_INTERVAL seconds.
+"""
+
+import heapq
+import logging
+
+import gevent
+from gevent.queue import Empty
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from fabric_bolt.launch_window.schedule import get_launch_window_schedule
+from fabric_bolt.projects.brokers import get_broker
+from fabric_bolt.projects.models import Deployment, DeploymentSchedule
+from fabric_bolt.projects.streaming import run_in_thread, start_deployment
+
+
+logger = logging.getLogger('fabric_bolt.scheduler')
+
+# Deployment ids start at 1, which leaves broker channel 0 to the scheduler
+SCHEDULER_CHANNEL = 0
+
+
+def notify_scheduler(instance):
+    """
+    Let a running scheduler know a deployment was scheduled or a deployment schedule changed, so it doesn't sleep
+    past it
+    """
+
+    get_broker().publish(SCHEDULER_CHANNEL, {instance._meta.model_name: instance.pk})
+
+
+def fire_schedule(schedule_id, fire_at, now):
+    """
+    Fire a deployment schedule due at ``fire_at``. Returns (the scheduled deployment or None, the schedule's next
+    fire time or None if it no longer fires).
+    """
+
+    with transaction.atomic():
+        schedule = DeploymentSchedule.objects.select_related('stage').filter(pk=schedule_id, enabled=True).first()
+        if schedule is None:
+            return None, None
+
+        if schedule.next_fire_at != fire_at:
+            # Changed since, or another scheduler fired it
+            return None, schedule.next_fire_at
+
+        run_at = schedule.fire(now)
+        if run_at is None:
+            logger.info('Skipped the runs of schedule %s missed since %s', schedule.pk, fire_at)
+            return None, schedule.next_fire_at
+
+        return schedule.create_deployment(run_at), schedule.next_fire_at
+
+
+def get_next_fire_at(schedule_id):
+    return DeploymentSchedule.objects.filter(pk=schedule_id, enabled=True).values_list('next_fire_at', flat=True).first()
+
+
+def get_scheduled_for(deployment_id):
+    return Deployment.objects.filter(pk=deployment_id, status=Deployment.SCHEDULED) \
+        .values_list('scheduled_for', flat=True).first()
+
+
+class DeploymentScheduler(object):
+
+    def __init__(self, batch_size=None, batch_interval=None, recheck_interval=None, call=run_in_thread,
+                 start=start_deployment):
+        self.batch_size = batch_size or getattr(settings, 'DEPLOYMENT_SCHEDULER_BATCH_SIZE', 20)
+        self.batch_interval = batch_interval or getattr(settings, 'DEPLOYMENT_SCHEDULER_BATCH_INTERVAL', 1)
+
+        # Longest sleep, in case a notification got lost (or the memory broker can't reach us) or a window changed
+        self.recheck_interval = recheck_interval or getattr(settings, 'DEPLOYMENT_SCHEDULER_RECHECK_INTERVAL', 300)
+
+        self.call = call
+        self.start = start
+
+        self.heap = []
+        self.schedule_heap = []
+
+        # The fire time of each schedule that counts; entries on the heap for any other time are out of date
+        self.fire_times = {}
+
+        self.loaded_at = None
+
+    def load(self, now=None):
+        """Build the heaps of (run at, deployment id) for every scheduled deployment and (fire at, schedule id)"""
+
+        now = now or timezone.now()
+        schedule = self.call(get_launch_window_schedule, now)
+
+        deployments = self.call(list, Deployment.objects.filter(status=Deployment.SCHEDULED)
+                                .values_list('pk', 'scheduled_for'))
+
+        self.heap = [(self.get_run_at(schedule, scheduled_for, now), pk) for pk, scheduled_for in deployments]
+        heapq.heapify(self.heap)
+
+        schedules = self.call(list, DeploymentSchedule.objects.filter(enabled=True, next_fire_at__isnull=False)
+                              .values_list('pk', 'next_fire_at'))
+
+        self.fire_times = dict(schedules)
+        self.schedule_heap = [(fire_at, pk) for pk, fire_at in schedules]
+        heapq.heapify(self.schedule_heap)
+
+        self.loaded_at = now
+
+    def get_run_at(self, schedule, scheduled_for, now):
+        run_at = schedule.get_open_time(max(scheduled_for or now, now))
+
+        # Nothing open within the schedule: look again once it has been extended
+        return run_at or schedule.refresh_at
+
+    def add_deployment(self, deployment_id, scheduled_for, now=None):
+        now = now or timezone.now()
+        schedule = self.call(get_launch_window_schedule, now)
+
+        heapq.heappush(self.heap, (self.get_run_at(schedule, scheduled_for, now), deployment_id))
+
+    def add_schedule(self, schedule_id, fire_at):
+        """Put a schedule on the heap for ``fire_at``, or take it off with None"""
+
+        if fire_at is None:
+            self.fire_times.pop(schedule_id, None)
+        elif self.fire_times.get(schedule_id) != fire_at:
+            self.fire_times[schedule_id] = fire_at
+            heapq.heappush(self.schedule_heap, (fire_at, schedule_id))
+
+    def fire_due(self, now=None):
+        """Fire every deployment schedule that is due. Returns the deployments created."""
+
+        now = now or timezone.now()
+
+        deployments = []
+        while self.schedule_heap and self.schedule_heap[0][0] <= now:
+            fire_at, schedule_id = heapq.heappop(self.schedule_heap)
+            if self.fire_times.get(schedule_id) != fire_at:
+                continue
+
+            del self.fire_times[schedule_id]
+            deployment, next_fire_at = self.call(fire_schedule, schedule_id, fire_at, now)
+            self.add_schedule(schedule_id, next_fire_at)
+
+            if deployment is not None:
+                self.add_deployment(deployment.pk, deployment.scheduled_for, now)
+                deployments.append(deployment)
+
+        return deployments
+
+    def get_due(self, now=None):
+        """Pop the next batch of deployments due to run"""
+
+        now = now or timezone.now()
+
+        due = []
+        while self.heap and self.heap[0][0] <= now and len(due) < self.batch_size:
+            due.append(heapq.heappop(self.heap)[1])
+        return due
+
+    def release(self, deployment_ids):
+        """Start the given scheduled deployments. Returns the ones started."""
+
+        deployments = self.call(list, Deployment.objects.select_related('stage', 'task').filter(pk__in=deployment_ids))
+
+        started = []
+        for deployment in deployments:
+            # Another scheduler may have got to it first
+            if self.call(deployment.release):
+                self.start(deployment, {})
+                started.append(deployment)
+
+        logger.info('Released %s scheduled deployments', len(started))
+
+        return started
+
+    def get_timeout(self, now=None):
+        """Seconds to sleep until the next deployment or schedule is due, or it is time to load everything again"""
+
+        now = now or timezone.now()
+
+        timeout = self.recheck_interval
+        if self.loaded_at is not None:
+            timeout -= (now - self.loaded_at).total_seconds()
+
+        for heap in (self.heap, self.schedule_heap):
+            if heap:
+                timeout = min(timeout, (heap[0][0] - now).total_seconds())
+
+        return max(0, timeout)
+
+    def handle(self, message):
+        """Take in a notification from ``notify_scheduler``"""
+
+        if 'deployment' in message:
+            scheduled_for = self.call(get_scheduled_for, message['deployment'])
+            if scheduled_for is not None:
+                self.add_deployment(message['deployment'], scheduled_for)
+
+        if 'deploymentschedule' in message:
+            schedule_id = message['deploymentschedule']
+            self.add_schedule(schedule_id, self.call(get_next_fire_at, schedule_id))
+
+    def run_forever(self):
+        broker = get_broker()
+        subscriber = broker.subscribe(SCHEDULER_CHANNEL)
+        try:
+            self.load()
+            while True:
+                if (timezone.now() - self.loaded_at).total_seconds() >= self.recheck_interval:
+                    self.load()
+
+                self.fire_due()
+
+                due = self.get_due()
+                while due:
+                    self.release(due)
+                    due = self.get_due()
+                    if due:
+                        # Spread a storm of due deployments out a little
+                        gevent.sleep(self.batch_interval)
+
+                try:
+                    message = subscriber.get(timeout=self.get_timeout())
+                except Empty:
+                    continue
+
+                # Take in everything that piled up
+                while True:
+                    self.handle(message)
+                    if not subscriber.depth:
+                        break
+                    message = subscriber.get_nowait()
+        finally:
+            broker.unsubscribe(SCHEDULER_CHANNEL, subscriber)
@@ -0,0 +1,50 @@
+$(function(){
+    if(deployment_pending){
+
+        var base_url = gateway_url.replace(/\/$/, '') + '/deployments/' + deployment_id;
+        var socket = null;
+        var source = null;
+
+        function on_event(data) {
+            if(data.status == 'pending'){
+                $('#deployment_output pre').append(document.createTextNode(data.lines)).scrollTop($('#deployment_output pre')[0].scrollHeight);
+            }else{
+                if(socket){ socket.close(); }
+                if(source){ source.close(); }
+                if(data.status == 'failed'){
+                    $('#status_section legend').html('Status: Failed!');
+                    $('#status_section .glyphicon').attr('class', '').addClass('glyphicon').addClass('glyphicon-warning-sign').addClass('text-danger');
+                }else if(data.status == 'success') {
+                    $('#status_section legend').html('Status: Success!');
+                    $('#status_section .glyphicon').attr('class', '').addClass('glyphicon').addClass('glyphicon-ok').addClass('text-success');
+                }
+            }
+        }
+
+        if(window.WebSocket){
+            socket = new WebSocket(base_url.replace(/^http/, 'ws') + '/ws');
+            socket.onmessage = function (message) {
+                on_event(JSON.parse(message.data));
+            };
+
+            $('#deployment_input').keyup(function(e){
+                if(e.which == 13){
+                    var text = $(this).val();
+                    $(this).val('');
+                    socket.send(text);
+                    $('#deployment_output pre').append('\n');
+                }
+            });
+        }else{
+            // Output only; input needs a WebSocket
+            $('#deployment_input').hide();
+            source = new EventSource(base_url + '/events', {withCredentials: true});
+            source.onmessage = function (message) {
+                on_event(JSON.parse(message.data));
+            };
+        }
+
+    }else{
+        $('#deployment_output pre').scrollTop($('#deployment_output pre')[0].scrollHeight);
+    }
+});
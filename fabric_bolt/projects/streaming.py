@@ -0,0 +1,544 @@
+"""
+Run deployments inside a gevent process and fan their output out to any number of live subscribers.
+
+Every subscriber is a greenlet blocked on its own bounded queue, so idle watchers cost a few KB of memory and no
+CPU, and a stalled watcher can never make the server buffer more than its queue limit. All ORM work is pushed to the
+gevent hub's thread pool so slow queries never stall the event loop.
+"""
+
+import logging
+from collections import deque
+
+import gevent
+import gevent.select
+from gevent import subprocess
+from gevent.event import Event
+from gevent.queue import Empty
+from django.conf import settings
+
+from fabric_bolt.projects.models import Deployment
+from fabric_bolt.projects.output import HostDemultiplexer, OutputRateLimiter, OutputRetention, Redactor, iter_process_output
+from fabric_bolt.projects.planning import build_fab_command, remove_fab_environment
+from fabric_bolt.projects.relay import RelayInUse, RelayNotFound, RelayReader, RelayWriter
+
+
+logger = logging.getLogger('fabric_bolt.streaming')
+
+_channels = {}
+
+
+def run_in_thread(func, *args, **kwargs):
+    """Run a blocking call (usually the ORM) in the hub's thread pool and wait for it cooperatively"""
+
+    return gevent.get_hub().threadpool.apply(func, args, kwargs)
+
+
+class Subscriber(object):
+    """
+    A bounded queue of deployment events for one watcher.
+
+    When the watcher falls further behind than ``max_events`` or ``max_bytes`` the subscriber applies its overflow
+    policy:
+
+    - ``coalesce``: merge the queued output into a single event, dropping the oldest lines if it is still too big
+    - ``skip``: drop the queued output and jump to the live tail, leaving a "N lines skipped" marker behind
+    - ``disconnect``: drop everything and end the stream with a ``disconnected`` status
+
+    The final status event is always delivered, so every stream ends.
+    """
+
+    COALESCE = 'coalesce'
+    SKIP = 'skip'
+    DISCONNECT = 'disconnect'
+
+    POLICIES = (COALESCE, SKIP, DISCONNECT)
+
+    def __init__(self, backlog=None, policy=None, max_events=None, max_bytes=None):
+        self.policy = policy or getattr(settings, 'DEPLOYMENT_SUBSCRIBER_POLICY', self.SKIP)
+        self.max_events = max_events or getattr(settings, 'DEPLOYMENT_SUBSCRIBER_MAX_EVENTS', 200)
+        self.max_bytes = max_bytes or getattr(settings, 'DEPLOYMENT_SUBSCRIBER_MAX_BYTES', 256 * 1024)
+
+        if self.policy not in self.POLICIES:
+            raise ValueError('Unknown subscriber policy "{}"'.format(self.policy))
+
+        # Output published before we subscribed. These are references to the channel's chunks, not copies.
+        self.backlog = deque(backlog or [])
+
+        self.events = deque()
+        self.queued_bytes = 0
+        self.ready = Event()
+
+        # Set once the event that ends the stream (a final status, or our own disconnect) is queued
+        self.finished = False
+        self.disconnected = False
+        self.skipped_lines = 0
+        self.overflows = 0
+
+    @property
+    def depth(self):
+        return len(self.events)
+
+    def put(self, event):
+        if self.disconnected:
+            return
+
+        if 'lines' in event:
+            if self.depth + 1 > self.max_events or self.queued_bytes + len(event['lines']) > self.max_bytes:
+                self.overflows += 1
+                self.overflow(event)
+            else:
+                self.append(event)
+        else:
+            self.append(event)
+            self.finished = True
+
+        self.ready.set()
+
+    def append(self, event):
+        self.events.append(event)
+        self.queued_bytes += len(event.get('lines', ''))
+
+    def clear(self):
+        """Drop all queued output. Returns (lines dropped, lines already reported by dropped skip markers)."""
+
+        dropped = sum(event['lines'].count('\n') for event in self.events if 'lines' in event and 'skipped' not in event)
+        dropped += sum(chunk.count('\n') for chunk in self.backlog)
+        reported = sum(event.get('skipped', 0) for event in self.events)
+
+        self.events.clear()
+        self.backlog.clear()
+        self.queued_bytes = 0
+
+        return dropped, reported
+
+    def overflow(self, event):
+        if self.policy == self.DISCONNECT:
+            self.clear()
+            self.disconnected = True
+            self.finished = True
+            self.events.append({'status': 'disconnected', 'reason': 'Could not keep up with the deployment output'})
+
+        elif self.policy == self.COALESCE:
+            reported = sum(queued.get('skipped', 0) for queued in self.events)
+            lines = ''.join(queued['lines'] for queued in self.events if 'skipped' not in queued) + event['lines']
+            self.events.clear()
+            self.queued_bytes = 0
+
+            dropped = 0
+            if len(lines) > self.max_bytes:
+                # Cut at a line boundary inside the newest max_bytes
+                cut = lines.find('\n', len(lines) - self.max_bytes)
+                cut = len(lines) - self.max_bytes if cut == -1 else cut + 1
+                dropped = lines.count('\n', 0, cut)
+                lines = lines[cut:]
+
+            self.skipped_lines += dropped
+            if dropped + reported:
+                self.append(self.skip_marker(dropped + reported))
+            self.append({'status': event['status'], 'lines': lines})
+
+        else:
+            dropped, reported = self.clear()
+
+            self.skipped_lines += dropped
+            self.append(self.skip_marker(dropped + reported))
+            self.append(event)
+
+    def skip_marker(self, skipped):
+        lines = '\n... {} lines skipped ...\n'.format(skipped)
+        return {'status': Deployment.PENDING, 'lines': lines, 'skipped': skipped}
+
+    def get(self, timeout=None):
+        """Return the next event, waiting up to ``timeout`` seconds. Raises ``gevent.queue.Empty`` on timeout."""
+
+        if self.backlog:
+            return self.next_backlog_event()
+
+        if not self.events:
+            self.ready.clear()
+            if not self.ready.wait(timeout):
+                raise Empty
+
+        event = self.events.popleft()
+        self.queued_bytes -= len(event.get('lines', ''))
+
+        return event
+
+    def get_nowait(self):
+        return self.get(timeout=0)
+
+    def wait(self, timeout=None):
+        """
+        Wait up to ``timeout`` seconds for another event to be queued, whether or not the earlier ones were taken.
+        Returns straight away once the stream has finished, as nothing else will arrive.
+        """
+
+        if self.finished:
+            return True
+
+        self.ready.clear()
+        return self.ready.wait(timeout)
+
+    def next_backlog_event(self):
+        chunks = []
+        size = 0
+        while self.backlog and (not chunks or size + len(self.backlog[0]) <= self.max_bytes):
+            chunk = self.backlog.popleft()
+            chunks.append(chunk)
+            size += len(chunk)
+
+        return {'status': Deployment.PENDING, 'lines': ''.join(chunks)}
+
+    def stats(self):
+        return {
+            'policy': self.policy,
+            'depth': self.depth,
+            'queued_bytes': self.queued_bytes,
+            'backlog_chunks': len(self.backlog),
+            'overflows': self.overflows,
+            'skipped_lines': self.skipped_lines,
+            'disconnected': self.disconnected,
+        }
+
+
+class DeploymentChannel(object):
+    """
+    Fans the events of one running deployment out to its subscribers.
+
+    Events are dictionaries in the same shape the socket.io path emits: ``{'status': 'pending', 'lines': '...'}``
+    while running and ``{'status': 'success'}`` or ``{'status': 'failed'}`` once the deployment finishes. Output
+    published before a subscriber joined is replayed to it first, so watchers can show up at any time.
+    """
+
+    def __init__(self, deployment_id):
+        self.deployment_id = deployment_id
+        self.subscribers = set()
+        self.history = OutputRetention()
+        self.final_event = None
+        self.process = None
+
+    @property
+    def finished(self):
+        return self.final_event is not None
+
+    def subscribe(self, **kwargs):
+        subscriber = Subscriber(backlog=self.history.chunks(), **kwargs)
+
+        if self.finished:
+            subscriber.put(self.final_event)
+        else:
+            self.subscribers.add(subscriber)
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    def publish(self, event):
+        if 'lines' in event:
+            self.history.append(event['lines'])
+        else:
+            self.final_event = event
+
+        for subscriber in list(self.subscribers):
+            subscriber.put(event)
+
+            if subscriber.disconnected:
+                self.subscribers.discard(subscriber)
+
+        if self.finished:
+            self.subscribers.clear()
+
+    def send_input(self, text):
+        if self.process is not None and self.process.stdin is not None and self.process.returncode is None:
+            self.process.stdin.write(text + '\n')
+
+    def stats(self):
+        subscribers = [subscriber.stats() for subscriber in self.subscribers]
+
+        return {
+            'deployment_id': self.deployment_id,
+            'subscribers': len(subscribers),
+            'max_depth': max([stats['depth'] for stats in subscribers] or [0]),
+            'queued_bytes': sum(stats['queued_bytes'] for stats in subscribers),
+            'skipped_lines': sum(stats['skipped_lines'] for stats in subscribers),
+        }
+
+
+def get_stats():
+    """Queue depth and overflow numbers for every deployment running in this process"""
+
+    channels = [channel.stats() for channel in _channels.values()]
+
+    return {
+        'channels': len(channels),
+        'subscribers': sum(stats['subscribers'] for stats in channels),
+        'max_depth': max([stats['max_depth'] for stats in channels] or [0]),
+        'queued_bytes': sum(stats['queued_bytes'] for stats in channels),
+        'deployments': channels,
+    }
+
+
+def get_channel(deployment_id):
+    """Return the channel of a deployment running in this process, or None"""
+
+    return _channels.get(int(deployment_id))
+
+
+def start_deployment(deployment, configuration_values, abort_on_prompts=True):
+    """
+    Start running a pending deployment and return its channel.
+
+    If the deployment is already running in this process the existing channel is returned. If another process has
+    claimed it, the channel follows that run instead: through the relay file when it runs on this host, through the
+    event broker otherwise. Any number of watchers can call this safely.
+
+    Fab aborts on prompts unless ``abort_on_prompts`` is False, which only executors that can forward the user's
+    input (``DeploymentChannel.send_input``) should pass.
+    """
+
+    channel = get_channel(deployment.pk)
+    if channel is None:
+        channel = _channels[deployment.pk] = DeploymentChannel(deployment.pk)
+        gevent.spawn(_start, channel, deployment, configuration_values, abort_on_prompts)
+
+    return channel
+
+
+def run_deployment(deployment, configuration_values):
+    """
+    Run a pending deployment (or follow the process already running it) in the calling thread, yielding its events.
+
+    For servers that don't run a gevent loop of their own: nothing else drives this thread's hub, so if the caller
+    stops reading, closing the generator still sees the run through. Fab aborts on prompts, there's no way to answer
+    them from here.
+    """
+
+    # Private to this thread's hub, so watchers in other threads never wait on it
+    channel = DeploymentChannel(deployment.pk)
+    subscriber = channel.subscribe()
+    runner = gevent.spawn(_start, channel, deployment, configuration_values, True)
+    try:
+        while True:
+            event = subscriber.get()
+            yield event
+
+            if 'lines' not in event:
+                break
+    finally:
+        channel.unsubscribe(subscriber)
+        runner.join()
+
+
+def _forget(channel):
+    if _channels.get(channel.deployment_id) is channel:
+        del _channels[channel.deployment_id]
+
+
+def _start(channel, deployment, configuration_values, abort_on_prompts):
+    if run_in_thread(deployment.claim):
+        try:
+            relay = RelayWriter(deployment.pk)
+        except RelayInUse:
+            # Still being run by an older process that didn't claim it; just watch that
+            pass
+        else:
+            return _run_deployment(channel, deployment, configuration_values, relay, abort_on_prompts)
+
+    try:
+        reader = RelayReader(deployment.pk)
+    except RelayNotFound:
+        return _follow_broker(channel, deployment.pk)
+
+    _follow_relay(channel, reader)
+
+
+def call_directly(func, *args, **kwargs):
+    return func(*args, **kwargs)
+
+
+def iter_broker_events(deployment_id, call=call_directly, check_interval=30):
+    """
+    Yield the events of a deployment another host is running: the output it has stored so far, then its live
+    events from the event broker, ending with the final status event.
+
+    ``call`` runs the ORM queries; pass ``run_in_thread`` inside gevent. Output events carry their ``offset`` in
+    the deployment's output stream (``Deployment.output_size`` is where the stored output ends), which is how the
+    stored output and the live events are stitched together without gaps or repeats. If nothing arrives for ``check_interval`` seconds the stored record is checked again, so a run that
+    finished while the broker was unreachable still ends the stream.
+    """
+
+    from fabric_bolt.projects.brokers import get_broker
+
+    broker = get_broker()
+
+    # Subscribe before reading the stored output, so nothing falls in between
+    subscriber = broker.subscribe(deployment_id)
+    try:
+        deployment = call(Deployment.objects.get, pk=deployment_id)
+        offset = 0
+
+        while True:
+            # Offsets count bytes of the output stream, and the output comes back from the database as text
+            output = (deployment.output or u'').encode('utf-8')
+            size = deployment.output_size or len(output)
+            if size > offset:
+                # The stored output ends at ``size``; only its tail is new if we've already sent some of it
+                yield {'status': Deployment.PENDING, 'lines': output[-(size - offset):], 'offset': offset}
+                offset = size
+
+            if deployment.status != Deployment.PENDING:
+                yield {'status': deployment.status}
+                return
+
+            try:
+                event = subscriber.get(timeout=check_interval)
+            except Empty:
+                deployment = call(Deployment.objects.get, pk=deployment_id)
+                continue
+
+            if 'lines' not in event:
+                yield event
+                return
+
+            if 'offset' in event:
+                if isinstance(event['lines'], unicode):
+                    # Decoded from JSON by the broker
+                    event = dict(event, lines=event['lines'].encode('utf-8'))
+
+                end = event['offset'] + len(event['lines'])
+                if end <= offset:
+                    continue
+
+                event = dict(event, lines=event['lines'][max(0, offset - event['offset']):])
+                offset = end
+
+            yield event
+    finally:
+        broker.unsubscribe(deployment_id, subscriber)
+
+
+def _follow_broker(channel, deployment_id):
+    status = Deployment.FAILED
+    try:
+        for event in iter_broker_events(deployment_id, call=run_in_thread):
+            if 'lines' in event:
+                channel.publish(event)
+            else:
+                status = event['status']
+    finally:
+        _forget(channel)
+        channel.publish({'status': status})
+
+
+def _follow_relay(channel, reader):
+    try:
+        for chunk in reader.iter_chunks(select=gevent.select.select):
+            channel.publish({'status': Deployment.PENDING, 'lines': chunk})
+    finally:
+        _forget(channel)
+        channel.publish({'status': reader.final_status or Deployment.FAILED})
+
+
+def _save_output(deployment, output, hosts):
+    Deployment.objects.filter(pk=deployment.pk).update(output=output.getvalue(), output_size=output.size)
+    deployment.save_host_logs(hosts)
+
+
+def _finish_deployment(deployment, status, output, hosts):
+    hosts.finish(status)
+
+    deployment.status = status
+    deployment.output = output.getvalue()
+    deployment.output_size = output.size
+    deployment.save()
+    deployment.save_host_logs(hosts)
+
+
+def _run_deployment(channel, deployment, configuration_values, relay, abort_on_prompts):
+    from fabric_bolt.projects.brokers import get_broker
+
+    broker = get_broker()
+    flush_interval = getattr(settings, 'DEPLOYMENT_OUTPUT_FLUSH_INTERVAL', 5)
+
+    output = OutputRetention.for_stage(deployment.stage)
+    limiter = OutputRateLimiter.from_settings()
+    hosts = HostDemultiplexer(output)
+    redactor = Redactor(())
+    status = Deployment.FAILED
+
+    def publish_output(lines, offset=None):
+        event = {'status': Deployment.PENDING, 'lines': lines}
+        if offset is not None:
+            event['offset'] = offset
+
+        relay.write(lines)
+        channel.publish(event)
+        broker.publish(deployment.pk, event)
+
+    def stream(lines):
+        if not lines:
+            return
+
+        offset = output.size
+        hosts.feed(lines, offset)
+        output.append(lines)
+
+        if limiter.allow(lines):
+            note = limiter.flush()
+            if note:
+                publish_output(note)
+            publish_output(lines, offset)
+
+    try:
+        redactor = run_in_thread(Redactor.for_stage, deployment.stage, configuration_values)
+        command = run_in_thread(build_fab_command, deployment, configuration_values, abort_on_prompts=abort_on_prompts)
+
+        # Only a run that can be answered gets a pipe to write the user's input to
+        channel.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                           stdin=None if abort_on_prompts else subprocess.PIPE)
+
+        # Write progress back every few seconds so a reload of the detail page shows how far along we are
+        last_flush = gevent.get_hub().loop.now()
+        for chunk in iter_process_output(channel.process):
+            # Secrets are scrubbed before anything is stored or sent anywhere
+            stream(redactor.feed(chunk))
+
+            if gevent.get_hub().loop.now() - last_flush > flush_interval:
+                run_in_thread(_save_output, deployment, output, hosts)
+                last_flush = gevent.get_hub().loop.now()
+
+        channel.process.wait()
+
+        if channel.process.returncode == 0:
+            status = Deployment.SUCCESS
+
+    except Exception as e:
+        logger.exception('Deployment %s failed to run', deployment.pk)
+
+        # Don't leave fab running with nobody reading its output
+        if channel.process is not None and channel.process.poll() is None:
+            channel.process.kill()
+            channel.process.wait()
+
+        # Always let the error through, whatever the rate limit says
+        message = redactor.feed('An error occurred: {}\n'.format(e)) + redactor.flush()
+        offset = output.size
+        output.append(message)
+        publish_output(message, offset)
+
+    finally:
+        stream(redactor.flush())
+
+        note = limiter.flush()
+        if note:
+            publish_output(note)
+
+        try:
+            remove_fab_environment(deployment)
+            run_in_thread(_finish_deployment, deployment, status, output, hosts)
+        finally:
+            relay.close(status)
+            _forget(channel)
+            channel.publish({'status': status})
+            broker.publish(deployment.pk, {'status': status})
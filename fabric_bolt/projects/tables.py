@@ -20,7 +20,13 @@ class ProjectTable(PaginateTable):
     ], delimiter='&#160;&#160;&#160;')
 
     name = tables.LinkColumn('projects_project_view', kwargs={'pk': tables.A('pk')})
-    deployments = tables.Column(accessor='get_deployment_count', verbose_name='# Deployments', orderable=False)
+
+    # Read from the annotations of Project.objects.with_deployment_summary()
+    deployments = tables.Column(accessor='deployment_count', verbose_name='# Deployments', order_by='deployment_count')
+    last_deployment = tables.DateTimeColumn(accessor='last_deployment_date', verbose_name='Last Deployment',
+                                            order_by='last_deployment_date')
+    last_status = tables.TemplateColumn('{% if record.last_deployment_status %}<span style="font-size:13px;" class="label label-{% if record.last_deployment_status == "success" %}success{% elif record.last_deployment_status == "failed" %}danger{% else %}info{% endif %}">{{ record.last_deployment_status|capfirst }}</span>{% endif %}',
+                                        verbose_name='Last Status', orderable=False)
 
     class Meta:
         model = models.Project
@@ -29,6 +35,8 @@ class ProjectTable(PaginateTable):
             'name',
             'type',
             'deployments',
+            'last_deployment',
+            'last_status',
         )
 
 
@@ -95,6 +103,9 @@ class DeploymentTable(PaginateTable):
 
     Also provides actions to view individual deployment"""
 
+    # Newest first, a page at a time however long the history gets
+    keyset_ordering = ('-date_created', '-pk')
+
     actions = ActionsColumn([
         {'title': '<i class="glyphicon glyphicon-file"></i>', 'url': 'projects_deployment_detail', 'args': [tables.A('pk')],
          'attrs':{'data-toggle': 'tooltip', 'title': 'View Deployment Details', 'data-delay': '{ "show": 300, "hide": 0 }'}},
@@ -117,6 +128,29 @@ class DeploymentTable(PaginateTable):
         )
 
 
+class DeploymentHostTable(PaginateTable):
+    """Table used to show what happened on each host of a deployment
+
+    Links to the host's own slice of the output"""
+
+    host = tables.LinkColumn('projects_deployment_host_detail', kwargs={'pk': tables.A('deployment_id'), 'host': tables.A('host')})
+    line_count = tables.Column(verbose_name='Lines')
+
+    #Prettify the status
+    status = tables.TemplateColumn('<span style="font-size:13px;" class="label label-{% if record.status == "success" %}success{% elif record.status == "failed" %}danger{% else %}info{% endif %}"><i class="glyphicon glyphicon-{% if record.status == "success" %}ok{% elif record.status == "failed" %}warning-sign{% else %}time{% endif %}"></i> &#160;{{ record.get_status_display }}</span>')
+
+    class Meta:
+        model = models.DeploymentHost
+        attrs = {"class": "table table-striped"}
+        sequence = fields = (
+            'host',
+            'status',
+            'first_seen',
+            'last_seen',
+            'line_count',
+        )
+
+
 class StageHostTable(PaginateTable):
     """This table lists the Stage->Host through table records
 
@@ -4,11 +4,44 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+import datetime
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+import gevent
+import gevent.select
 from django.core.urlresolvers import reverse
 from django.test import TestCase
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.utils.timezone import utc
 
-from fabric_bolt.projects import models
+from fabric_bolt.core.mixins.tables import reverse_link
+from fabric_bolt.core.paginator import KeysetPaginator
+from fabric_bolt.core.views import Dashboard
+from fabric_bolt.hosts.models import Host
+from fabric_bolt.launch_window.models import LaunchWindow
+from fabric_bolt.projects import models, tables
+from fabric_bolt.projects.brokers import get_broker
+from fabric_bolt.projects.brokers.base import split_event
+from fabric_bolt.projects.brokers.tcp import TCPBroker
+from fabric_bolt.projects.configuration_io import ConfigurationImport, ConfigurationImportError, export_configurations
+from fabric_bolt.projects.gateway import application
+from fabric_bolt.projects.output import HostDemultiplexer, OutputRateLimiter, OutputRetention, Redactor
+from fabric_bolt.projects import relay
+from fabric_bolt.projects.relay import HEADER, MAGIC, RUNNING, RelayInUse, RelayReader, RelayWriter, get_process_start
+from fabric_bolt.projects.scheduler import DeploymentScheduler
+from fabric_bolt.projects.sockets import ChatNamespace
+from fabric_bolt.projects.streaming import DeploymentChannel, Subscriber, call_directly, iter_broker_events
+from fabric_bolt.projects.planning import build_fab_command, get_deployment_plan, get_fab_environment_path, remove_fab_environment
 
 User = get_user_model()
 
@@ -86,6 +119,597 @@ class SimpleTest(TestCase):
 
         self.project = project
 
+    def test_deployment_claim(self):
+        self.assertTrue(self.deployment.claim())
+
+        # Whoever comes second follows along instead
+        other = models.Deployment.objects.get(pk=self.deployment.pk)
+        self.assertFalse(other.claim())
+
+    def test_broker_events_follow_stored_output(self):
+        events = iter_broker_events(self.deployment.pk)
+
+        self.assertEqual(next(events), {'status': 'pending', 'lines': 'OUTPUT', 'offset': 0})
+
+        broker = get_broker()
+        broker.publish(self.deployment.pk, {'status': 'pending', 'lines': 'OUTPUT', 'offset': 0})
+        broker.publish(self.deployment.pk, {'status': 'pending', 'lines': 'more\n', 'offset': 6})
+        broker.publish(self.deployment.pk, {'status': 'success'})
+
+        self.assertEqual(list(events), [
+            {'status': 'pending', 'lines': 'more\n', 'offset': 6},
+            {'status': 'success'},
+        ])
+        self.assertEqual(broker.subscriptions, {})
+
+        # Offsets are in bytes, the stored output is text and broker events arrive decoded from JSON
+        models.Deployment.objects.filter(pk=self.deployment.pk).update(output=u'd\xe9ploy\n', output_size=8)
+        events = iter_broker_events(self.deployment.pk)
+        self.assertEqual(next(events)['lines'].decode('utf-8'), u'd\xe9ploy\n')
+
+        broker.publish(self.deployment.pk, {'status': 'pending', 'lines': u'\xe9ploy\nnext\n', 'offset': 1})
+        broker.publish(self.deployment.pk, {'status': 'success'})
+        self.assertEqual([event.get('lines') for event in events], ['next\n', None])
+
+    def test_resolved_configurations_are_cached(self):
+        project_config = models.Configuration.objects.create(project=self.project, key='PROJECT', value='project')
+        models.Configuration.objects.create(project=self.project, key='KEY', value='project value')
+
+        # The version, then the configurations
+        with self.assertNumQueries(2):
+            configurations = self.stage.get_configurations()
+        self.assertEqual(configurations, {'KEY': 'VALUE', 'PROJECT': 'project'})
+
+        with self.assertNumQueries(1):
+            self.stage.get_configurations()
+
+        # Changing a project configuration clears the cache of every stage
+        project_config.value = 'changed'
+        project_config.save()
+        self.assertEqual(self.stage.get_configurations()['PROJECT'], 'changed')
+
+        self.configuration.delete()
+        self.assertEqual(self.stage.get_configurations()['KEY'], 'project value')
+
+    def test_configuration_snapshots(self):
+        models.Configuration.objects.create(project=self.project, key='SECRET', value='hunter2', sensitive_value=True)
+
+        self.deployment.snapshot_configuration({'KEY': 'prompted'})
+        self.deployment.save()
+
+        snapshot = self.deployment.configuration_snapshot
+        self.assertEqual(snapshot.get_configuration(), {'KEY': 'prompted', 'SECRET': '******'})
+
+        # Same configuration, same row
+        other = models.Deployment.objects.create(user=self.user, stage=self.stage, task=self.task, comments='again')
+        other.snapshot_configuration({'KEY': 'prompted'})
+        self.assertEqual(other.configuration_snapshot.pk, snapshot.pk)
+
+        other.snapshot_configuration({'KEY': 'different'})
+        other.save()
+        self.assertEqual(snapshot.diff(other.configuration_snapshot), [
+            {'key': 'KEY', 'old': 'prompted', 'new': 'different', 'change': 'changed'},
+        ])
+
+        self.assertEqual(other.get_previous_deployment().pk, self.deployment.pk)
+
+        result = self.client.get(reverse('projects_deployment_configuration_diff', args=(other.pk, self.deployment.pk)))
+        self.assertContains(result, 'different')
+
+    def test_fab_command_with_environment_file(self):
+        environment_dir = tempfile.mkdtemp()
+        try:
+            with self.settings(DEPLOYMENT_ENVIRONMENT_DIR=environment_dir):
+                command = build_fab_command(self.deployment, {'KEY': 'a,b=c'}, delivery='file')
+
+                with open(get_fab_environment_path(self.deployment)) as environment_file:
+                    environment = json.load(environment_file)
+
+                self.assertIn('fabric_bolt_environment=' + get_fab_environment_path(self.deployment), command)
+
+                remove_fab_environment(self.deployment)
+                self.assertEqual(os.listdir(environment_dir), [])
+        finally:
+            shutil.rmtree(environment_dir)
+
+        self.assertEqual(environment['env'], {'KEY': 'a,b=c'})
+        self.assertNotIn('a,b=c', ' '.join(command))
+
+    def test_deployment_plan(self):
+        self.configuration.sensitive_value = True
+        self.configuration.save()
+
+        plan = get_deployment_plan(self.deployment, {})
+        self.assertEqual(plan.task_name, 'TASK_NAME')
+        self.assertEqual(plan.get_env(), {})
+        self.assertEqual(plan.get_sensitive_keys(), ['KEY'])
+        self.assertEqual(plan.configuration_hash, self.deployment.configuration_snapshot.hash)
+        self.assertGreaterEqual(plan.planning_duration, 0)
+
+        # Planned once, after that every executor reads the same plan
+        with self.assertNumQueries(1):
+            self.assertEqual(get_deployment_plan(self.deployment, {}).pk, plan.pk)
+
+        command = build_fab_command(self.deployment, {}, delivery='command_line')
+        self.assertIn('KEY=VALUE', command)
+        self.assertIn('--fabfile={}'.format(plan.fabfile_path), command)
+
+    def test_project_list_queries(self):
+        def get_project_list():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('projects_project_list'))
+            self.assertEqual(response.status_code, 200)
+            return response, len(queries)
+
+        # The first request loads the sidebar and keeps the user's groups in the session
+        get_project_list()
+        response, query_count = get_project_list()
+
+        project = response.context['table'].data.queryset.get(pk=self.project.pk)
+        self.assertEqual(project.deployment_count, 1)
+        self.assertEqual(project.last_deployment_date, self.deployment.date_created)
+        self.assertEqual(project.last_deployment_status, models.Deployment.PENDING)
+
+        for i in range(10):
+            project = models.Project.objects.create(name='PROJECT_{}'.format(i), type=self.project.type)
+            stage = models.Stage.objects.create(project=project, name='Production')
+            for status in (models.Deployment.FAILED, models.Deployment.SUCCESS):
+                models.Deployment.objects.create(user=self.user, stage=stage, task=self.task, status=status)
+
+        # The same queries however many projects there are
+        get_project_list()
+        response, more_projects_query_count = get_project_list()
+        self.assertEqual(more_projects_query_count, query_count)
+
+        project = response.context['table'].data.queryset.get(name='PROJECT_0')
+        self.assertEqual((project.deployment_count, project.last_deployment_status), (2, models.Deployment.SUCCESS))
+
+    def test_resolved_configurations_cache(self):
+        cache.clear()
+        self.assertEqual([config.value for config in self.stage.get_resolved_configurations()], ['VALUE'])
+
+        # Changed behind this process's back: the cached copy stays until the version in the database moves
+        models.Configuration.objects.filter(pk=self.configuration.pk).update(value='ROTATED')
+        self.assertEqual([config.value for config in self.stage.get_resolved_configurations()], ['VALUE'])
+
+        models.invalidate_stage_configurations([self.project.pk])
+        with self.assertNumQueries(2):
+            self.assertEqual([config.value for config in self.stage.get_resolved_configurations()], ['ROTATED'])
+
+        self.configuration.value = 'SAVED'
+        self.configuration.save()
+        self.assertEqual([config.value for config in self.stage.get_resolved_configurations()], ['SAVED'])
+
+    def test_deployment_history_pages(self):
+        cache.clear()
+        for i in range(24):
+            models.Deployment.objects.create(user=self.user, stage=self.stage, task=self.task)
+        newest_first = list(models.Deployment.objects.order_by('-date_created', '-pk').values_list('pk', flat=True))
+
+        paginator = KeysetPaginator(models.Deployment.objects.lightweight(), 10)
+        self.assertEqual((paginator.count, paginator.count_is_approximate), (25, False))
+
+        pages = [paginator.page()]
+        while pages[-1].has_next():
+            with self.assertNumQueries(1):
+                pages.append(paginator.page(pages[-1].next_cursor))
+
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual([deployment.pk for page in pages for deployment in page], newest_first)
+
+        # Back again, and a deployment created meanwhile doesn't shift the pages
+        models.Deployment.objects.create(user=self.user, stage=self.stage, task=self.task)
+        previous = paginator.page(pages[2].previous_cursor)
+        self.assertEqual([deployment.pk for deployment in previous], newest_first[10:20])
+        self.assertEqual([deployment.pk for deployment in paginator.page(previous.previous_cursor)], newest_first[:10])
+
+        # The count comes from the cache for a while
+        self.assertEqual((paginator.count, KeysetPaginator(models.Deployment.objects.all(), 10).count), (25, 25))
+
+        url = reverse('projects_stage_view', args=(self.project.pk, self.stage.pk))
+        response = self.client.get(url, {'deploy_per_page': 10, 'deploy_cursor': pages[1].next_cursor})
+        self.assertEqual([row.record.pk for row in response.context['deployment_table']().page.object_list],
+                         newest_first[20:])
+        self.assertContains(response, 'Showing 5 of 26')
+
+        # Not a cursor: the first page
+        response = self.client.get(url, {'deploy_per_page': 10, 'deploy_cursor': 'nonsense'})
+        self.assertEqual(len(response.context['deployment_table']().page), 10)
+
+        # Sorted by a column it pages by number
+        response = self.client.get(url, {'deploy_sort': 'status'})
+        self.assertFalse(response.context['deployment_table']().keyset)
+        self.assertEqual(response.context['deployment_table']().page.number, 1)
+
+    def test_actions_column_links(self):
+        self.assertEqual(reverse_link('projects_stage_view', [self.project.pk, str(self.stage.pk)]),
+                         reverse('projects_stage_view', args=(self.project.pk, self.stage.pk)))
+        self.assertEqual(reverse_link('projects_deployment_host_detail', [self.deployment.pk, 'web1']),
+                         reverse('projects_deployment_host_detail', args=(self.deployment.pk, 'web1')))
+        self.assertEqual(reverse_link('#', None), '#')
+
+        html = tables.StageTable.base_columns['actions'].render(None, self.stage, None)
+        for name in ('projects_stage_view', 'projects_stage_update', 'projects_stage_delete'):
+            self.assertIn('href="{}"'.format(reverse(name, args=(self.project.pk, self.stage.pk))), html)
+        self.assertIn('title="Edit Stage"', html)
+
+    @override_settings(SIDEBAR_LIST_LIMIT=5)
+    def test_sidebar_lists(self):
+        cache.clear()
+        url = reverse('projects_project_view', args=(self.project.pk,))
+
+        def get_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            return response, [query['sql'] for query in queries]
+
+        get_queries()
+        response, queries = get_queries()
+        self.assertFalse([sql for sql in queries if 'hosts_host' in sql])
+        self.assertContains(response, '>TEST_PROJECT</a>')
+
+        # Cached until a project changes, and only the first few are listed
+        for i in range(10):
+            models.Project.objects.create(name='PROJECT_{}'.format(i))
+        get_queries()
+        response, more_projects_queries = get_queries()
+        self.assertEqual(len(more_projects_queries), len(queries))
+        self.assertContains(response, '>PROJECT_3</a>')
+        self.assertNotContains(response, '>PROJECT_4</a>')
+        self.assertContains(response, 'and 6 more')
+
+        response = self.client.get(reverse('sidebar'))
+        self.assertContains(response, 'and 6 more')
+        self.assertEqual(self.client.get(reverse('sidebar'), HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        Host.objects.create(name='web1.example.com')
+        self.assertEqual(self.client.get(reverse('sidebar'), HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+        # Another process's change reaches us through the version in the database
+        models.Project.objects.filter(name='PROJECT_0').update(name='RENAMED')
+        models.CacheVersion.objects.filter(name='sidebar_lists').update(version='other')
+        self.assertContains(self.client.get(reverse('sidebar')), '>RENAMED</a>')
+
+    def test_project_fragment_cache(self):
+        cache.clear()
+        project_url = reverse('projects_project_view', args=(self.project.pk,))
+        stage_url = reverse('projects_stage_view', args=(self.project.pk, self.stage.pk))
+
+        def get_table_queries(url, data=None):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, data or {})
+            self.assertEqual(response.status_code, 200)
+            return response, [query['sql'] for query in queries
+                              if 'projects_configuration' in query['sql'] or 'projects_deployment' in query['sql']]
+
+        get_table_queries(project_url)
+        response, table_queries = get_table_queries(project_url)
+        self.assertEqual(table_queries, [])
+        self.assertContains(response, 'TASK_NAME')
+
+        # A new sort order is another fragment
+        self.assertNotEqual(get_table_queries(project_url, {'deploy_sort': 'status'})[1], [])
+
+        models.Configuration.objects.create(project=self.project, key='NEW_KEY', value='new value')
+        self.assertContains(get_table_queries(project_url)[0], 'NEW_KEY')
+
+        self.deployment.status = models.Deployment.FAILED
+        self.deployment.save()
+        self.assertContains(get_table_queries(project_url)[0], 'Failed')
+
+        host = Host.objects.create(name='web1.example.com')
+        self.stage.hosts.add(host)
+        get_table_queries(stage_url)
+        self.assertContains(get_table_queries(stage_url)[0], 'web1.example.com')
+
+        host.name = 'web2.example.com'
+        host.save()
+        self.assertContains(get_table_queries(stage_url)[0], 'web2.example.com')
+
+        # The generation is kept in the database, so a change another process made counts as much as our own
+        models.Configuration.objects.filter(project=self.project, key='NEW_KEY').update(key='RENAMED_KEY')
+        models.CacheVersion.objects.filter(name='project_generation.{}'.format(self.project.pk)).update(version='other')
+        self.assertContains(get_table_queries(project_url)[0], 'RENAMED_KEY')
+
+    def test_group_membership_cache(self):
+        url = reverse('projects_project_update', args=(self.project.pk,))
+
+        def get_group_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            return response, [query['sql'] for query in queries if 'auth_group' in query['sql']]
+
+        response, group_queries = get_group_queries()
+        self.assertEqual(response.status_code, 302)
+
+        # Changing the user's groups makes the session look them up again, once
+        self.user.groups.add(Group.objects.create(name='Admin'))
+        response, group_queries = get_group_queries()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(group_queries), 1)
+
+        response, group_queries = get_group_queries()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(group_queries, [])
+
+        self.user.groups.clear()
+        self.assertEqual(get_group_queries()[0].status_code, 302)
+
+        # The version is kept on the user's row, so a change made anywhere reaches every worker's sessions
+        admin = Group.objects.get(name='Admin')
+        admin.user_set.add(self.user)
+        self.assertEqual(get_group_queries()[0].status_code, 200)
+
+        stale_user = get_user_model().objects.get(pk=self.user.pk)
+        admin.delete()
+        self.assertEqual(get_group_queries()[0].status_code, 302)
+
+        # Saving an instance loaded before the change doesn't take the version back
+        stale_user.first_name = 'Stale'
+        stale_user.save()
+        self.assertGreater(get_user_model().objects.get(pk=self.user.pk).groups_version, stale_user.groups_version)
+
+    def test_configuration_import(self):
+        rows = [{'key': 'KEY_{}'.format(i), 'value': 'value {}'.format(i)} for i in range(500)]
+        generation = models.get_project_generation(self.project.pk)
+
+        with CaptureQueriesContext(connection) as queries:
+            ConfigurationImport(self.project, rows, stage=self.stage).apply()
+        # SQLite takes a few INSERTs for 500 rows, other databases just the one; then an UPDATE for each cache version
+        self.assertLess(len(queries), 13)
+        self.assertEqual(self.stage.get_configurations()['KEY_499'], 'value 499')
+
+        # The cached tables of the project's pages go as well
+        self.assertNotEqual(models.get_project_generation(self.project.pk), generation)
+
+        rows = [{'key': 'KEY_{}'.format(i), 'data_type': 'number', 'value': i} for i in range(500)]
+        with CaptureQueriesContext(connection) as queries:
+            configuration_import = ConfigurationImport(self.project, rows, stage=self.stage, delete_missing=True)
+            configuration_import.apply()
+        self.assertLess(len(queries), 20)
+        self.assertEqual((len(configuration_import.updated), len(configuration_import.deleted)), (500, 1))
+        self.assertEqual(self.stage.get_configurations()['KEY_499'], 499)
+
+        with self.assertRaises(ConfigurationImportError) as error:
+            ConfigurationImport(self.project, [{'key': 'not valid'}, {'key': 'KEY_1', 'data_type': 'boolean', 'value': 'x'}])
+        self.assertEqual(len(error.exception.errors), 2)
+
+        # Flags written as text mean what they say, and anything that isn't clearly true or false is refused
+        rows = [{'key': 'KEY_1', 'prompt_me_for_input': 'false', 'sensitive_value': '1'},
+                {'key': 'KEY_2', 'prompt_me_for_input': 'Yes', 'sensitive_value': 0}]
+        ConfigurationImport(self.project, rows, stage=self.stage).apply()
+        flags = dict((config.key, (config.prompt_me_for_input, config.sensitive_value))
+                     for config in models.Configuration.objects.filter(stage=self.stage, key__in=['KEY_1', 'KEY_2']))
+        self.assertEqual(flags, {'KEY_1': (False, True), 'KEY_2': (True, False)})
+
+        with self.assertRaises(ConfigurationImportError) as error:
+            ConfigurationImport(self.project, [{'key': 'KEY_1', 'prompt_me_for_input': 'nope'},
+                                               {'key': 'KEY_2', 'sensitive_value': 2}])
+        self.assertEqual(len(error.exception.errors), 2)
+
+    def test_configuration_export_keeps_sensitive_values(self):
+        self.user.groups.add(Group.objects.create(name='Admin'))
+        self.configuration.sensitive_value = True
+        self.configuration.save()
+
+        result = self.client.get(reverse('projects_configuration_stage_export', args=(self.project.pk, self.stage.pk)))
+        self.assertEqual(json.loads(result.content), export_configurations(self.project, self.stage))
+        self.assertNotIn('VALUE', result.content)
+
+        export_url = reverse('projects_configuration_stage_export', args=(self.project.pk, self.stage.pk))
+        self.assertEqual(self.client.get(export_url, {'format': 'json"; x="'}).status_code, 400)
+
+        import_url = reverse('projects_configuration_stage_import', args=(self.project.pk, self.stage.pk))
+        self.assertEqual(self.client.get(import_url).status_code, 200)
+
+        result = self.client.post(import_url, {
+            'format': 'json',
+            'data': result.content,
+        })
+        self.assertRedirects(result, reverse('projects_stage_view', args=(self.project.pk, self.stage.pk)))
+        self.assertEqual(models.Configuration.objects.get(pk=self.configuration.pk).value, 'VALUE')
+
+    def test_dashboard_chart_data(self):
+        other_project = models.Project.objects.create(name='OTHER', type=self.project.type)
+        other_stage = models.Stage.objects.create(project=other_project, name='Staging')
+
+        for days_ago, stage in [(2, self.stage), (2, other_stage), (2, other_stage), (1, self.stage)]:
+            deployment = models.Deployment.objects.create(user=self.user, stage=stage, task=self.task)
+            models.Deployment.objects.filter(pk=deployment.pk).update(
+                date_created=self.deployment.date_created - datetime.timedelta(days=days_ago))
+
+        models.DeploymentDailyStat.rebuild()
+
+        def label(days_ago):
+            return (self.deployment.date_created - datetime.timedelta(days=days_ago)).strftime('%m/%d')
+
+        with self.assertNumQueries(1):
+            chart_data = Dashboard().get_chart_data([self.project, other_project])
+
+        self.assertEqual(chart_data, [
+            ['Day', 'TEST_PROJECT', 'OTHER'],
+            [label(2), 1, 2],
+            [label(1), 1, 0],
+            [label(0), 1, 0],
+        ])
+
+        result = self.client.get(reverse('index'))
+        self.assertEqual(json.loads(result.context['chart_data']), chart_data)
+
+        # Scheduled deployments haven't run yet, so they aren't part of the status breakdown
+        models.Deployment.objects.create(user=self.user, stage=self.stage, task=self.task,
+                                         status=models.Deployment.SCHEDULED, scheduled_for=self.deployment.date_created)
+
+        result = self.client.get(reverse('index'))
+        self.assertEqual(json.loads(result.context['pie_chart_data']), [['pending', 5]])
+
+    def test_deployment_daily_stats(self):
+        def counts():
+            return dict(models.DeploymentDailyStat.objects.filter(count__gt=0).values_list('status', 'count'))
+
+        self.assertEqual(counts(), {'pending': 1})
+
+        deployment = models.Deployment.objects.create(user=self.user, stage=self.stage, task=self.task)
+        self.assertEqual(counts(), {'pending': 2})
+
+        deployment = models.Deployment.objects.get(pk=deployment.pk)
+        deployment.status = deployment.SUCCESS
+        deployment.save()
+        deployment.save()
+        self.assertEqual(counts(), {'pending': 1, 'success': 1})
+
+        self.deployment.delete()
+        self.assertEqual(counts(), {'success': 1})
+
+        fields = ('stage', 'day', 'status', 'count', 'total_duration')
+        stats = list(models.DeploymentDailyStat.objects.filter(count__gt=0).values(*fields))
+        models.DeploymentDailyStat.rebuild()
+        rebuilt = list(models.DeploymentDailyStat.objects.values(*fields))
+
+        # The database adds the durations up; SQLite only keeps milliseconds of them
+        self.assertAlmostEqual(rebuilt[0].pop('total_duration'), stats[0].pop('total_duration'), places=2)
+        self.assertEqual(rebuilt, stats)
+
+    def test_lightweight_deployments(self):
+        deployment = models.Deployment.objects.lightweight().get(pk=self.deployment.pk)
+        self.assertNotIn('output', deployment.__dict__)
+        self.assertNotIn('configuration', deployment.__dict__)
+        self.assertEqual(deployment.status, self.deployment.status)
+
+        result = self.client.get(reverse('projects_project_view', args=(self.project.pk,)))
+        for deployment in result.context['deployment_table']().data:
+            self.assertNotIn('output', deployment.__dict__)
+
+        result = self.client.get(reverse('accounts_user_view', args=(self.user.pk,)))
+        self.assertContains(result, 'TEST_PROJECT - Production')
+        with self.assertNumQueries(0):
+            for deployment in result.context['recent_deployments']:
+                self.assertNotIn('output', deployment.__dict__)
+                unicode(deployment.stage.project)
+
+    def test_deployment_scheduler(self):
+        cache.clear()
+        LaunchWindow.objects.create(name='Nights', description='', cron_format='* 3 * * *')
+
+        now = datetime.datetime(2014, 3, 3, 1, 30, tzinfo=utc)
+        deployments = [models.Deployment.objects.create(user=self.user, stage=self.stage, task=self.task,
+                                                        status=models.Deployment.SCHEDULED, scheduled_for=now)
+                       for i in range(3)]
+
+        started = []
+        scheduler = DeploymentScheduler(batch_size=2, call=call_directly,
+                                        start=lambda deployment, values: started.append(deployment.pk))
+        scheduler.load(now)
+
+        # Sleeps until the window opens at 03:00
+        self.assertEqual(scheduler.get_due(now), [])
+        self.assertEqual(scheduler.get_timeout(now), min(90 * 60, scheduler.recheck_interval))
+
+        opens = datetime.datetime(2014, 3, 3, 3, tzinfo=utc)
+        due = scheduler.get_due(opens)
+        self.assertEqual(len(due), 2)
+        scheduler.release(due)
+        self.assertEqual(len(scheduler.get_due(opens)), 1)
+
+        self.assertEqual(sorted(started), sorted(due))
+        self.assertEqual(models.Deployment.objects.filter(status=models.Deployment.PENDING).count(), 3)
+
+        # Released once only
+        self.assertFalse(models.Deployment.objects.get(pk=due[0]).release())
+        self.assertEqual(dict(models.DeploymentDailyStat.objects.filter(count__gt=0).values_list('status', 'count')),
+                         {'pending': 3, 'scheduled': 1})
+
+    def test_deployment_schedules(self):
+        cache.clear()
+
+        schedule = models.DeploymentSchedule.objects.create(stage=self.stage, task_name='warm_caches', user=self.user,
+                                                            cron_format='0 * * * *')
+        self.assertTrue(schedule.next_fire_at > datetime.datetime.now(utc))
+        self.assertEqual(schedule.next_fire_at.minute, 0)
+
+        missed = models.DeploymentSchedule.objects.create(stage=self.stage, task_name='renew_certs', user=self.user,
+                                                          cron_format='30 * * * *',
+                                                          misfire_policy=models.DeploymentSchedule.SKIP)
+
+        now = datetime.datetime(2014, 3, 3, 1, 0, 20, tzinfo=utc)
+        models.DeploymentSchedule.objects.filter(pk=schedule.pk).update(next_fire_at=now.replace(second=0))
+        models.DeploymentSchedule.objects.filter(pk=missed.pk).update(
+            next_fire_at=datetime.datetime(2014, 3, 2, 12, 30, tzinfo=utc))
+
+        scheduler = DeploymentScheduler(call=call_directly, start=lambda deployment, values: None)
+        scheduler.load(now)
+
+        # On time: runs the one due, then carries on hourly. Missed with the skip policy: runs nothing.
+        deployments = scheduler.fire_due(now)
+        self.assertEqual([(deployment.task.name, deployment.schedule_id) for deployment in deployments],
+                         [('warm_caches', schedule.pk)])
+        self.assertEqual(deployments[0].status, models.Deployment.SCHEDULED)
+        self.assertEqual(deployments[0].scheduled_for, now.replace(second=0))
+
+        self.assertEqual(scheduler.fire_times, {
+            schedule.pk: datetime.datetime(2014, 3, 3, 2, tzinfo=utc),
+            missed.pk: datetime.datetime(2014, 3, 3, 1, 30, tzinfo=utc),
+        })
+        self.assertEqual(models.DeploymentSchedule.objects.get(pk=missed.pk).last_fired_at, None)
+
+        # No launch windows, so the deployment it created is due straight away
+        self.assertEqual(scheduler.get_due(now), [deployments[0].pk])
+        self.assertEqual(scheduler.fire_due(now), [])
+
+        # A run missed with the run once policy is made up for once, however many were missed
+        later = datetime.datetime(2014, 3, 3, 9, 10, tzinfo=utc)
+        models.DeploymentSchedule.objects.filter(pk=missed.pk).update(misfire_policy=models.DeploymentSchedule.RUN_ONCE)
+        self.assertEqual([deployment.scheduled_for for deployment in scheduler.fire_due(later)], [later, later])
+        self.assertEqual(scheduler.fire_times[missed.pk], datetime.datetime(2014, 3, 3, 9, 30, tzinfo=utc))
+
+        # A changed schedule starts over from now, and the entry it had is dropped
+        missed.enabled = False
+        missed.save()
+        scheduler.handle({'deploymentschedule': missed.pk})
+        self.assertNotIn(missed.pk, scheduler.fire_times)
+        self.assertEqual(len(scheduler.fire_due(datetime.datetime(2014, 3, 3, 9, 40, tzinfo=utc))), 0)
+
+        self.assertEqual(models.Task.objects.get(name='warm_caches').times_used, 2)
+
+    def test_sensitive_values(self):
+        self.configuration.sensitive_value = True
+        self.configuration.save()
+
+        self.assertEqual(self.stage.get_sensitive_values(), set(['VALUE']))
+        self.assertEqual(self.stage.get_sensitive_values({'KEY': 'prompted'}), set(['prompted']))
+
+    def test_deployment_hosts(self):
+        # The index counts bytes of the stream; the output is stored as text
+        stream = u'[web1] out: d\xe9ploy\u2713\nlocal\n[web2] run: uptime\n'.encode('utf-8')
+        self.deployment.output = stream
+        self.deployment.save()
+
+        output = OutputRetention()
+        hosts = HostDemultiplexer(output)
+        hosts.feed(stream, 0)
+        output.append(stream)
+        hosts.finish('success')
+        self.deployment.save_host_logs(hosts)
+
+        web1 = self.deployment.hosts.get(host='web1')
+        self.assertEqual(web1.get_output(), u'[web1] out: d\xe9ploy\u2713\n')
+
+        web2 = self.deployment.hosts.get(host='web2')
+        self.assertEqual(web2.get_output(), '[web2] run: uptime\n')
+
+        result = self.client.get(reverse('projects_deployment_hosts', args=(self.deployment.pk,)))
+        self.assertEqual([host['host'] for host in json.loads(result.content)['hosts']], ['web1', 'web2'])
+
+        result = self.client.get(web2.get_absolute_url(), {'format': 'json'})
+        self.assertEqual(json.loads(result.content)['output'], '[web2] run: uptime\n')
+
+        result = self.client.get(web2.get_absolute_url())
+        self.assertEqual(result.status_code, 200)
+
+        result = self.client.get(reverse('projects_deployment_detail', args=(self.deployment.pk,)))
+        self.assertContains(result, web2.get_absolute_url())
+
     def test_project_crud_urls(self):
         """
         Tests that all views return status code of 200
@@ -134,6 +758,14 @@ class SimpleTest(TestCase):
         # result = c.get(reverse('projects_deployment_output', args=(self.deployment.pk,)))
         # self.assertIn(result.status_code, [200, 302])
 
+    def test_deployment_output_fails_unknown_task(self):
+        task = models.Task.objects.create(name='not_in_the_fabfile')
+        deployment = models.Deployment.objects.create(user=self.user, stage=self.stage, task=task)
+
+        result = self.client.get(reverse('projects_deployment_output', args=(deployment.pk,)))
+        self.assertIn('failed', ''.join(result.streaming_content))
+        self.assertEqual(models.Deployment.objects.get(pk=deployment.pk).status, models.Deployment.FAILED)
+
     def test_project_stage_urls(self):
         """
         Tests that all views return status code of 200
@@ -196,4 +828,377 @@ class SimpleTest(TestCase):
         self.assertEqual(configurations['number4'], '3')
 
 
+class DeploymentChannelTest(TestCase):
+
+    def test_late_subscribers_get_history(self):
+        channel = DeploymentChannel(1)
+
+        early = channel.subscribe()
+        channel.publish({'status': 'pending', 'lines': 'one\n'})
+        channel.publish({'status': 'pending', 'lines': 'two\n'})
+
+        late = channel.subscribe()
+
+        self.assertEqual(early.get_nowait()['lines'], 'one\n')
+        self.assertEqual(early.get_nowait()['lines'], 'two\n')
+        self.assertEqual(late.get_nowait()['lines'], 'one\ntwo\n')
+
+    def test_finished_channel(self):
+        channel = DeploymentChannel(1)
+
+        queue = channel.subscribe()
+        channel.publish({'status': 'success'})
+
+        self.assertEqual(queue.get_nowait(), {'status': 'success'})
+        self.assertEqual(len(channel.subscribers), 0)
+
+        # Anyone showing up after the fact just gets the final status
+        self.assertEqual(channel.subscribe().get_nowait(), {'status': 'success'})
+
+    def test_skip_policy(self):
+        subscriber = Subscriber(policy=Subscriber.SKIP, max_events=3, max_bytes=1024)
+
+        for x in range(10):
+            subscriber.put({'status': 'pending', 'lines': 'line {}\n'.format(x)})
+
+        self.assertLessEqual(subscriber.depth, 3)
+        self.assertEqual(subscriber.skipped_lines, 9)
+
+        lines = ''
+        while subscriber.depth:
+            lines += subscriber.get_nowait()['lines']
+        self.assertIn('9 lines skipped', lines)
+        self.assertTrue(lines.endswith('line 9\n'))
+
+    def test_coalesce_policy(self):
+        subscriber = Subscriber(policy=Subscriber.COALESCE, max_events=2, max_bytes=1024)
+
+        for x in range(10):
+            subscriber.put({'status': 'pending', 'lines': '{}\n'.format(x)})
+
+        lines = ''
+        while subscriber.depth:
+            lines += subscriber.get_nowait()['lines']
+        self.assertEqual(lines, ''.join('{}\n'.format(x) for x in range(10)))
+        self.assertEqual(subscriber.skipped_lines, 0)
+
+    def test_subscriber_wait(self):
+        subscriber = Subscriber()
+        subscriber.put({'status': 'pending', 'lines': 'queued\n'})
+
+        # Only events queued after we started waiting wake us up
+        self.assertFalse(subscriber.wait(0.01))
+        gevent.spawn_later(0.01, subscriber.put, {'status': 'success'})
+        self.assertTrue(subscriber.wait(1))
+
+        # Nothing can follow the final status, so there is nothing left to wait for
+        self.assertTrue(subscriber.finished)
+        self.assertTrue(subscriber.wait(60))
+
+        self.assertEqual(subscriber.get_nowait()['lines'], 'queued\n')
+        self.assertEqual(subscriber.get_nowait(), {'status': 'success'})
+
+    def test_socket_stream_ends_while_browser_is_behind(self):
+        channel = DeploymentChannel(1)
+        channel.publish({'status': 'pending', 'lines': 'one\n'})
+
+        class BehindSocket(object):
+            connected = True
+
+            class client_queue(object):
+                @staticmethod
+                def qsize():
+                    return ChatNamespace.max_client_queue + 1
+
+        emitted = []
+        stream = ChatNamespace.__new__(ChatNamespace)
+        stream.socket = BehindSocket()
+        stream.channel = channel
+        stream.emit = lambda name, event: emitted.append(event)
+        stream.disconnect = lambda: emitted.append('disconnect')
+
+        gevent.spawn_later(0.05, channel.publish, {'status': 'success'})
+        started = time.time()
+        with gevent.Timeout(stream.wait_timeout):
+            stream.output_stream_generator()
+
+        # The finish is noticed as soon as it's published, and the queued output is still handed over before it
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(emitted, [{'status': 'pending', 'lines': 'one\n'}, {'status': 'success'}, 'disconnect'])
+
+    def test_disconnect_policy(self):
+        channel = DeploymentChannel(1)
+        subscriber = channel.subscribe(policy=Subscriber.DISCONNECT, max_events=2)
+
+        for x in range(3):
+            channel.publish({'status': 'pending', 'lines': '{}\n'.format(x)})
+
+        self.assertEqual(subscriber.get_nowait()['status'], 'disconnected')
+        self.assertNotIn(subscriber, channel.subscribers)
+
+    def test_gateway_requires_session(self):
+        responses = []
+
+        body = application({'PATH_INFO': '/deployments/1/events'}, lambda status, headers: responses.append(status))
+
+        self.assertEqual(responses, ['403 Forbidden'])
+        self.assertEqual(list(body), ['403 Forbidden'])
+
+    def test_gateway_checks_origin(self):
+        def get_environ(origin):
+            return {'PATH_INFO': '/deployments/1/ws', 'HTTP_HOST': 'bolt.example.com:8001', 'HTTP_ORIGIN': origin}
+
+        environ = get_environ('http://bolt.example.com:8001')
+        self.assertTrue(application.is_allowed_origin(environ))
+        self.assertEqual(application.cors_headers(environ), [
+            ('Access-Control-Allow-Origin', 'http://bolt.example.com:8001'),
+            ('Access-Control-Allow-Credentials', 'true'),
+        ])
+
+        # Turned away before the session is even looked at
+        environ = get_environ('http://evil.example.com')
+        responses = []
+        body = application(environ, lambda status, headers: responses.append(status))
+        self.assertEqual((responses, list(body)), (['403 Forbidden'], ['403 Forbidden']))
+        self.assertEqual(application.cors_headers(environ), [])
+
+        with self.settings(DEPLOYMENT_GATEWAY_ALLOWED_ORIGINS=('http://bolt.example.com',)):
+            self.assertTrue(application.is_allowed_origin(get_environ('http://bolt.example.com')))
+            self.assertFalse(application.is_allowed_origin(get_environ('http://bolt.example.com.evil.com')))
+
+        # Default ports are the same origin
+        self.assertTrue(application.is_allowed_origin(dict(get_environ('https://bolt.example.com'),
+                                                           HTTP_HOST='bolt.example.com:443', **{'wsgi.url_scheme': 'https'})))
+
+
+class OutputTest(TestCase):
+
+    def test_retention_keeps_head_and_tail(self):
+        output = OutputRetention(head_size=10, tail_size=10)
+
+        for x in range(100):
+            output.append('{:02d}\n'.format(x))
+
+        self.assertEqual(output.size, 300)
+        self.assertEqual(output.dropped, 280)
+
+        value = output.getvalue()
+        self.assertTrue(value.startswith('00\n01\n02\n0'))
+        self.assertIn('280 bytes of output truncated', value)
+        self.assertTrue(value.endswith('7\n98\n99\n'))
+
+    def test_tcp_broker_backs_off(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+
+        broker = TCPBroker(port=port, reconnect_delay=60)
+        self.assertFalse(broker.send({'op': 'publish', 'channel': 'test', 'event': {'status': 'success'}}))
+        retry_at = broker.retry_at
+        self.assertGreater(retry_at, time.time())
+
+        # Nobody tries to connect again until the delay is over
+        self.assertFalse(broker.send({'op': 'publish', 'channel': 'test', 'event': {'status': 'success'}}))
+        self.assertEqual((broker.retry_at, broker.retry_delay), (retry_at, 60))
+
+    def test_split_broker_events(self):
+        lines = u'd\xe9ploy \u2713\n'.encode('utf-8') * 2000 + '\xff\n'
+        parts = split_event({'status': 'pending', 'lines': lines, 'offset': 10}, max_size=7900)
+
+        self.assertTrue(len(parts) > 1)
+        self.assertTrue(all(len(json.dumps(part)) <= 7900 for part in parts))
+        self.assertEqual([part['offset'] for part in parts[1:]],
+                         [parts[0]['offset'] + len(u''.join(part['lines'] for part in parts[:index]).encode('utf-8'))
+                          for index in range(1, len(parts))])
+
+        # Nothing cut inside a character, and bytes that aren't UTF-8 don't stop the event
+        text = u''.join(part['lines'] for part in parts)
+        self.assertEqual(text, lines[:-2].decode('utf-8') + u'\ufffd\n')
+
+    def test_retention_under_the_limits(self):
+        output = OutputRetention(head_size=10, tail_size=10)
+        output.append('hello\n')
+        output.append('world\n')
+
+        self.assertEqual(output.getvalue(), 'hello\nworld\n')
+
+    def test_host_demultiplexer(self):
+        output = OutputRetention()
+        hosts = HostDemultiplexer(output)
+
+        text = (
+            '[web1] Executing task \'deploy\'\n'
+            '[web1] run: uptime\n'
+            '[web1] out: up 3 days\n'
+            '[web2] Executing task \'deploy\'\n'
+            '[web2] run: false\n'
+            '\n'
+            'Fatal error: run() received nonzero return code 1 while executing!\n'
+            '\n'
+            'Aborting.\n'
+        )
+
+        # Chunks don't line up with lines
+        for start in range(0, len(text), 7):
+            hosts.feed(text[start:start + 7], start)
+            output.append(text[start:start + 7])
+        hosts.finish('failed')
+
+        self.assertEqual(hosts.hosts.keys(), ['web1', 'web2'])
+        self.assertEqual(hosts.hosts['web1'].status, 'success')
+        self.assertEqual(hosts.hosts['web2'].status, 'failed')
+
+        web1 = ''.join(output.getvalue()[position:position + length] for position, length in hosts.get_index(hosts.hosts['web1']))
+        self.assertEqual(web1, '[web1] Executing task \'deploy\'\n[web1] run: uptime\n[web1] out: up 3 days\n')
+
+        web2 = ''.join(output.getvalue()[position:position + length] for position, length in hosts.get_index(hosts.hosts['web2']))
+        self.assertIn('Fatal error', web2)
+        self.assertNotIn('web1', web2)
+
+    def test_redactor(self):
+        redactor = Redactor(['hunter2', 'hunt', 'swordfish'])
+
+        text = 'password is hunter2, also swordfish and huntress\n'
+        self.assertEqual(redactor.feed(text) + redactor.flush(), 'password is ********, also ******** and ********ress\n')
+
+    def test_redactor_across_chunks(self):
+        redactor = Redactor(['hunter2'])
+
+        output = ''
+        for char in 'x hunter2 y hunter':
+            output += redactor.feed(char)
+
+        # The trailing "hunter" could still have become the secret
+        self.assertEqual(output, 'x ******** y ')
+        self.assertEqual(redactor.flush(), 'hunter')
+
+    def test_rate_limiter(self):
+        now = [0]
+        limiter = OutputRateLimiter(rate=10, clock=lambda: now[0])
+
+        self.assertTrue(limiter.allow('x' * 15))
+        self.assertFalse(limiter.allow('x' * 5))
+        self.assertFalse(limiter.allow('x' * 5))
+
+        now[0] = 1
+        self.assertTrue(limiter.allow('x'))
+        self.assertIn('10 bytes of output not streamed', limiter.flush())
+        self.assertEqual(limiter.flush(), '')
+
+
+class RelayTest(TestCase):
+
+    def setUp(self):
+        self.relay_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(DEPLOYMENT_RELAY_DIR=self.relay_dir)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.relay_dir)
+
+    def test_relay_round_trip(self):
+        writer = RelayWriter(1, capacity=64)
+        reader = RelayReader(1)
+
+        writer.write('hello\n')
+        self.assertEqual(reader.read(), ('hello\n', 0))
+
+        writer.write('world\n')
+        writer.close('success')
+
+        self.assertEqual(''.join(reader.iter_chunks()), 'world\n')
+        self.assertEqual(reader.final_status, 'success')
+
+    def test_relay_wraps_and_reports_skipped(self):
+        writer = RelayWriter(1, capacity=16)
+        reader = RelayReader(1)
+
+        writer.write('0123456789')
+        writer.write('abcdefghij')
+
+        data, skipped = reader.read()
+        self.assertEqual(skipped, 4)
+        self.assertEqual(data, '456789abcdefghij')
+
+        writer.close('failed')
+
+    def test_only_one_process_runs_a_deployment(self):
+        writer = RelayWriter(1)
+
+        self.assertRaises(RelayInUse, RelayWriter, 1)
+
+        writer.close('success')
+
+        # Once it's done the deployment can be claimed again
+        RelayWriter(1).discard()
+
+    def test_stale_relay_is_taken_over_once(self):
+        child = subprocess.Popen(['true'])
+        child.wait()
+
+        stale = RelayWriter(1)
+        HEADER.pack_into(stale.map, 0, MAGIC, child.pid, stale.capacity, 0, RUNNING, 0)
+        stale.map.close()
+        stale.wake_socket.close()
+
+        # Another process is already in the middle of replacing the dead relay
+        marker_path = '{}.{}.takeover.0'.format(stale.path, child.pid)
+        with open(marker_path, 'w') as marker_file:
+            marker_file.write('{} {} {}'.format(os.getpid(), get_process_start(os.getpid()), time.time()))
+        self.assertRaises(RelayInUse, RelayWriter, 1)
+
+        # ...until it turns out to have died half way through
+        with open(marker_path, 'w') as marker_file:
+            marker_file.write('{} 0 {}'.format(child.pid, time.time()))
+
+        writer = RelayWriter(1)
+        self.assertEqual(RelayReader(1).pid, os.getpid())
+        self.assertFalse(os.path.exists(marker_path))
+        self.assertFalse(os.path.exists('{}.{}.takeover.1'.format(stale.path, child.pid)))
+        self.assertRaises(RelayInUse, RelayWriter, 1)
+        writer.close('success')
+
+    def test_stale_takeover_markers(self):
+        stale = RelayWriter(1)
+        HEADER.pack_into(stale.map, 0, MAGIC, os.getpid(), stale.capacity, 0, RUNNING, 1)
+        stale.map.close()
+        stale.wake_socket.close()
+
+        # Our pid, but a process that started at another time: both the relay and the marker were left by a process
+        # whose pid has been reused
+        self.assertFalse(RelayReader(1).writer_alive())
+        marker_path = '{}.{}.takeover.0'.format(stale.path, os.getpid())
+        with open(marker_path, 'w') as marker_file:
+            marker_file.write('{} 1 {}'.format(os.getpid(), time.time()))
+
+        # A marker its process never got to write to counts once it's old
+        empty_marker_path = '{}.{}.takeover.1'.format(stale.path, os.getpid())
+        open(empty_marker_path, 'w').close()
+        self.assertRaises(RelayInUse, RelayWriter, 1)
+        old = time.time() - relay.TAKEOVER_TIMEOUT - 1
+        os.utime(empty_marker_path, (old, old))
+
+        writer = RelayWriter(1)
+        self.assertTrue(RelayReader(1).writer_alive())
+        self.assertEqual(os.listdir(self.relay_dir), ['1.relay', '1.relay.wake'])
+        writer.close('success')
+
+    def test_relay_reader_is_woken(self):
+        writer = RelayWriter(1)
+        reader = RelayReader(1)
+        chunks = reader.iter_chunks(select=gevent.select.select, check_interval=60)
+
+        def write():
+            writer.write('hello\n')
+            gevent.sleep(0.05)
+            writer.close('success')
 
+        gevent.spawn_later(0.05, write)
+        started = time.time()
+        with gevent.Timeout(5):
+            self.assertEqual(list(chunks), ['hello\n'])
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(reader.final_status, 'success')
+        self.assertEqual(os.listdir(self.relay_dir), [])
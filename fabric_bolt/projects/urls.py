@@ -13,12 +13,19 @@ urlpatterns = patterns('',
 
     url(r'^(?P<project_id>\w+)/configuration/create/$', views.ProjectConfigurationCreate.as_view(), name='projects_configuration_create'),
     url(r'^(?P<project_id>\w+)/configuration/stage/(?P<stage_id>\d+)/create/$', views.ProjectConfigurationCreate.as_view(), name='projects_configuration_stage_create'),
+    url(r'^(?P<project_id>\w+)/configuration/import/$', views.ProjectConfigurationImport.as_view(), name='projects_configuration_import'),
+    url(r'^(?P<project_id>\w+)/configuration/stage/(?P<stage_id>\d+)/import/$', views.ProjectConfigurationImport.as_view(), name='projects_configuration_stage_import'),
+    url(r'^(?P<project_id>\w+)/configuration/export/$', views.ProjectConfigurationExport.as_view(), name='projects_configuration_export'),
+    url(r'^(?P<project_id>\w+)/configuration/stage/(?P<stage_id>\d+)/export/$', views.ProjectConfigurationExport.as_view(), name='projects_configuration_stage_export'),
     url(r'^configuration/update/(?P<pk>\w+)/$', views.ProjectConfigurationUpdate.as_view(), name='projects_configuration_update'),
     url(r'^configuration/delete/(?P<pk>\w+)/$', views.ProjectConfigurationDelete.as_view(), name='projects_configuration_delete'),
 
     url(r'^stage/(?P<pk>\d+)/deployment/(?P<task_name>\w+)/$', views.DeploymentCreate.as_view(), name='projects_deployment_create'),
+    url(r'^deployment/view/(?P<pk>\d+)/diff/(?P<other_pk>\d+)/$', views.DeploymentConfigurationDiff.as_view(), name='projects_deployment_configuration_diff'),
     url(r'^deployment/view/(?P<pk>\d+)', views.DeploymentDetail.as_view(), name='projects_deployment_detail'),
     url(r'^deployment/output/(?P<pk>\d+)', views.DeploymentOutputStream.as_view(), name='projects_deployment_output'),
+    url(r'^deployment/hosts/(?P<pk>\d+)/$', views.DeploymentHostList.as_view(), name='projects_deployment_hosts'),
+    url(r'^deployment/hosts/(?P<pk>\d+)/(?P<host>[^/]+)/$', views.DeploymentHostDetail.as_view(), name='projects_deployment_host_detail'),
 
     url(r'^(?P<project_id>\w+)/stage/create/$', views.ProjectStageCreate.as_view(), name='projects_stage_create'),
     url(r'^(?P<project_id>\w+)/stage/update/(?P<pk>\w+)/$', views.ProjectStageUpdate.as_view(), name='projects_stage_update'),
@@ -3,54 +3,36 @@ Views for the Projects App
 """
 
 import datetime
+import json
 import subprocess
-import os
 import re
-import sys
 
-from django.http import HttpResponseRedirect, StreamingHttpResponse
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.db.models.aggregates import Count
 from django.contrib import messages
-from django.views.generic import CreateView, UpdateView, DetailView, DeleteView, RedirectView, View
+from django.views.generic import CreateView, UpdateView, DetailView, DeleteView, RedirectView, View, FormView
 from django.core.urlresolvers import reverse_lazy, reverse
 from django.shortcuts import get_object_or_404
 from django.forms import CharField, PasswordInput, Select, FloatField, BooleanField
 from django.conf import settings
+from django.utils import timezone
 from django.utils.text import slugify
-from git import Repo
-from django_tables2 import RequestConfig, SingleTableView
+from django_tables2 import SingleTableView
 
-from fabric_bolt.core.mixins.views import MultipleGroupRequiredMixin
+from fabric_bolt.core.mixins.tables import RequestConfig
+from fabric_bolt.core.mixins.views import FragmentCacheMixin, MultipleGroupRequiredMixin, lazy_context
 from fabric_bolt.hosts.models import Host
 from fabric_bolt.projects import forms, tables, models
+from fabric_bolt.projects.configuration_io import FORMATS, ConfigurationImportError
+from fabric_bolt.projects.configuration_io import dump_configurations, export_configurations
+from fabric_bolt.projects.planning import get_deployment_plan, get_fabfile_path
+from fabric_bolt.projects.scheduler import notify_scheduler
+from fabric_bolt.projects.streaming import run_deployment
 
 
 
 
 
-# These options are passed to Fabric as: fab task --abort-on-prompts=True --user=root ...
-fabric_special_options = ['no_agent', 'forward-agent', 'config', 'disable-known-hosts', 'keepalive',
-                          'password', 'parallel', 'no-pty', 'reject-unknown-hosts', 'skip-bad-hosts', 'timeout',
-                          'command-timeout', 'user', 'warn-only', 'pool-size']
-
-
-def get_fabfile_path(project):
-    if project.use_repo_fabfile:
-        repo_dir = os.path.join(settings.PUBLIC_DIR, '.repo_caches', slugify(project.name))
-        if not os.path.exists(repo_dir):
-            os.makedirs(repo_dir)
-            Repo.clone_from(project.repo_url, repo_dir) # we may want to do a git pull if it already exists?
-
-        pip_installs = ' '.join(project.fabfile_requirements.splitlines())
-        subprocess.call(['pip install {}'.format(pip_installs), '--target {}'.format(repo_dir)], shell=True)
-
-        fabfile_path = os.path.join(repo_dir, 'fabfile.py')
-    else:
-        fabfile_path = settings.FABFILE_PATH
-
-    return fabfile_path
-
-
 def get_fabric_tasks(request, project):
     """
     Generate a list of fabric tasks that are available
@@ -99,7 +81,7 @@ class ProjectList(SingleTableView):
 
     table_class = tables.ProjectTable
     model = models.Project
-    queryset = models.Project.active_records.all()
+    queryset = models.Project.active_records.with_deployment_summary().select_related('type')
 
 
 class ProjectCreate(MultipleGroupRequiredMixin, CreateView):
@@ -122,7 +104,7 @@ class ProjectCreate(MultipleGroupRequiredMixin, CreateView):
         return ret
 
 
-class ProjectDetail(DetailView):
+class ProjectDetail(FragmentCacheMixin, DetailView):
     """
     Display the Project Detail/Summary page: Configurations, Stages, and Deployments
     """
@@ -135,23 +117,36 @@ class ProjectDetail(DetailView):
 
         return super(ProjectDetail, self).dispatch(request, *args, **kwargs)
 
+    def get_fragment_generation(self):
+        return models.get_project_generation(self.object.pk)
+
     def get_context_data(self, **kwargs):
         context = super(ProjectDetail, self).get_context_data(**kwargs)
 
-        configuration_table = tables.ConfigurationTable(self.object.project_configurations(), prefix='config_')
-        RequestConfig(self.request).configure(configuration_table)
-        context['configurations'] = configuration_table
+        # The tables are only built for fragments that aren't cached
+        def get_configuration_table():
+            configuration_table = tables.ConfigurationTable(self.object.project_configurations(), prefix='config_')
+            RequestConfig(self.request).configure(configuration_table)
+            return configuration_table
+
+        context['configurations'] = lazy_context(get_configuration_table)
 
         stages = self.object.get_stages().annotate(deployment_count=Count('deployment'))
         context['stages'] = stages
 
-        stage_table = tables.StageTable(stages, prefix='stage_')
-        RequestConfig(self.request).configure(stage_table)
-        context['stage_table'] = stage_table
+        def get_stage_table():
+            stage_table = tables.StageTable(stages, prefix='stage_')
+            RequestConfig(self.request).configure(stage_table)
+            return stage_table
 
-        deployment_table = tables.DeploymentTable(models.Deployment.objects.filter(stage__in=stages).select_related('stage', 'task'), prefix='deploy_')
-        RequestConfig(self.request).configure(deployment_table)
-        context['deployment_table'] = deployment_table
+        context['stage_table'] = lazy_context(get_stage_table)
+
+        def get_deployment_table():
+            deployment_table = tables.DeploymentTable(models.Deployment.objects.lightweight().filter(stage__in=stages).select_related('stage', 'task'), prefix='deploy_')
+            RequestConfig(self.request).configure(deployment_table)
+            return deployment_table
+
+        context['deployment_table'] = lazy_context(get_deployment_table)
 
         return context
 
@@ -261,6 +256,81 @@ class ProjectConfigurationDelete(MultipleGroupRequiredMixin, DeleteView):
         return super(ProjectConfigurationDelete, self).delete(self, request, *args, **kwargs)
 
 
+class ProjectConfigurationImport(MultipleGroupRequiredMixin, FormView):
+    """
+    Import the configurations of a project or stage in one go
+    """
+    group_required = ['Admin', ]
+    form_class = forms.ConfigurationImportForm
+    template_name = 'projects/configuration_import.html'
+
+    def dispatch(self, request, *args, **kwargs):
+        self.project = get_object_or_404(models.Project, pk=kwargs.get('project_id'))
+        self.stage = None
+        if kwargs.get('stage_id'):
+            self.stage = get_object_or_404(models.Stage, pk=kwargs.get('stage_id'), project=self.project)
+
+        return super(ProjectConfigurationImport, self).dispatch(request, *args, **kwargs)
+
+    def get_form_kwargs(self):
+        kwargs = super(ProjectConfigurationImport, self).get_form_kwargs()
+        kwargs['project'] = self.project
+        kwargs['stage'] = self.stage
+        return kwargs
+
+    def form_valid(self, form):
+        configuration_import = form.configuration_import
+        configuration_import.apply()
+
+        messages.success(self.request, 'Configurations imported: {} created, {} updated, {} deleted, {} unchanged'.format(
+            len(configuration_import.created),
+            len(configuration_import.updated),
+            len(configuration_import.deleted),
+            len(configuration_import.unchanged),
+        ))
+
+        return super(ProjectConfigurationImport, self).form_valid(form)
+
+    def get_context_data(self, **kwargs):
+        context = super(ProjectConfigurationImport, self).get_context_data(**kwargs)
+        context['project'] = self.project
+        context['stage'] = self.stage
+        return context
+
+    def get_success_url(self):
+        if self.stage:
+            return reverse('projects_stage_view', args=(self.project.pk, self.stage.pk))
+        return self.project.get_absolute_url()
+
+
+class ProjectConfigurationExport(MultipleGroupRequiredMixin, View):
+    """
+    Download the configurations of a project or stage, as JSON or (?format=yaml) YAML. Sensitive values are left out.
+    """
+    group_required = ['Admin', ]
+
+    def get(self, request, *args, **kwargs):
+        project = get_object_or_404(models.Project, pk=kwargs.get('project_id'))
+        stage = None
+        if kwargs.get('stage_id'):
+            stage = get_object_or_404(models.Stage, pk=kwargs.get('stage_id'), project=project)
+
+        # It ends up in the file name, so only the formats we write get through
+        format = request.GET.get('format', 'json')
+        if format not in dict(FORMATS):
+            return HttpResponse('Unsupported format', status=400, content_type='text/plain')
+
+        try:
+            content = dump_configurations(export_configurations(project, stage), format)
+        except ConfigurationImportError as e:
+            return HttpResponse(str(e), status=400, content_type='text/plain')
+
+        name = slugify(u'{} {}'.format(project.name, stage.name if stage else 'project'))
+        response = HttpResponse(content, content_type='application/x-yaml' if format == 'yaml' else 'application/json')
+        response['Content-Disposition'] = 'attachment; filename="{}-configuration.{}"'.format(name, format)
+        return response
+
+
 class DeploymentCreate(MultipleGroupRequiredMixin, CreateView):
     """
     Form to create a new Deployment for a Project Stage. POST will kick off the DeploymentOutputStream view.
@@ -318,14 +388,34 @@ class DeploymentCreate(MultipleGroupRequiredMixin, CreateView):
             self.object.task.description = self.task_description
             self.object.task.save()
 
-        self.object.user = self.request.user
-        self.object.save()
-
         configuration_values = {}
         for key, value in form.cleaned_data.iteritems():
             if key.startswith('configuration_value_for_'):
                 configuration_values[key.replace('configuration_value_for_', '')] = value
 
+        if form.cleaned_data.get('run_at_next_window'):
+            # Nobody will be around to type the secrets in when it runs
+            sensitive = [config.key for config in self.stage.get_queryset_configurations(prompt_me_for_input=True)
+                         if config.sensitive_value]
+            if sensitive:
+                messages.error(self.request, "Deployments that prompt for sensitive values ({}) can't be scheduled.".format(
+                    ', '.join(sensitive)))
+                return self.form_invalid(form)
+
+            self.object.status = self.object.SCHEDULED
+            self.object.scheduled_for = timezone.now()
+
+        self.object.user = self.request.user
+        self.object.snapshot_configuration(configuration_values)
+        self.object.save()
+
+        # Work out the command, hosts and fabfile now, so running it doesn't have to
+        get_deployment_plan(self.object, configuration_values)
+
+        if self.object.status == self.object.SCHEDULED:
+            notify_scheduler(self.object)
+            messages.info(self.request, 'The deployment will run at the next launch window.')
+
         self.request.session['configuration_values'] = configuration_values
 
         return super(DeploymentCreate, self).form_valid(form)
@@ -350,93 +440,135 @@ class DeploymentDetail(DetailView):
     model = models.Deployment
 
     def get_template_names(self):
-        if getattr(settings, 'SOCKETIO_ENABLED', False):
+        if getattr(settings, 'DEPLOYMENT_GATEWAY_URL', None):
+            return ['projects/deployment_detail_gateway.html']
+        elif getattr(settings, 'SOCKETIO_ENABLED', False):
             return ['projects/deployment_detail_socketio.html']
         else:
             return ['projects/deployment_detail.html']
 
+    def get_context_data(self, **kwargs):
+        context = super(DeploymentDetail, self).get_context_data(**kwargs)
 
-class DeploymentOutputStream(View):
+        context['gateway_url'] = getattr(settings, 'DEPLOYMENT_GATEWAY_URL', None)
+
+        host_table = tables.DeploymentHostTable(self.object.hosts.all(), prefix='host_')
+        RequestConfig(self.request).configure(host_table)
+        context['host_table'] = host_table
+
+        if self.object.configuration_snapshot:
+            context['configuration'] = sorted(self.object.configuration_snapshot.get_configuration().items())
+            context['previous_deployment'] = self.object.get_previous_deployment()
+
+        return context
+
+
+class DeploymentConfigurationDiff(DetailView):
     """
-    Deployment view does the heavy lifting of calling Fabric Task for a Project Stage
+    What changed in the configuration between another deployment and this one
     """
+    queryset = models.Deployment.objects.lightweight()
+    template_name = 'projects/deployment_configuration_diff.html'
 
-    def build_command(self):
-        command = [getattr(settings, 'VENV_PATH', '') + 'fab ' + '-f {} '.format(
-            settings.FABFILE_PATH
-        ) + self.object.task.name + ' --abort-on-prompts']
+    def get_context_data(self, **kwargs):
+        context = super(DeploymentConfigurationDiff, self).get_context_data(**kwargs)
 
-        hosts = self.object.stage.hosts.values_list('name', flat=True)
-        if hosts:
-            command.append('--hosts=' + ','.join(hosts))
+        other = get_object_or_404(models.Deployment.objects.lightweight(), pk=int(self.kwargs['other_pk']))
+        context['other'] = other
 
-        # Get the dictionary of configurations for this stage
-        config = self.object.stage.get_configurations()
+        if other.configuration_snapshot and self.object.configuration_snapshot:
+            context['changes'] = other.configuration_snapshot.diff(self.object.configuration_snapshot)
 
-        config.update(self.request.session.get('configuration_values', {}))
+        return context
 
-        command_to_config = {x.replace('-', '_'): x for x in fabric_special_options}
 
-        # Take the special env variables out
-        normal_options = list(set(config.keys()) - set(command_to_config.keys()))
+def serialize_deployment_host(host):
+    return {
+        'host': host.host,
+        'status': host.status,
+        'first_seen': host.first_seen.isoformat(),
+        'last_seen': host.last_seen.isoformat(),
+        'line_count': host.line_count,
+        'url': host.get_absolute_url(),
+    }
 
-        # Special ones get set a different way
-        special_options = list(set(config.keys()) & set(command_to_config.keys()))
 
-        def get_key_value_string(key, value):
-            if isinstance(value, bool):
-                return key + ('' if value else '=')
-            elif isinstance(value, float):
-                return key + '=' + str(value)
-            else:
-                return '{}={}'.format(key, value.replace('"', '\\"'))
+class DeploymentHostList(View):
+    """
+    JSON list of the hosts of a deployment with their status and when they were first and last seen
+    """
 
-        if normal_options:
-            command.append('--set')
-            command.append(','.join(get_key_value_string(key, config[key]) for key in normal_options))
+    def get(self, request, *args, **kwargs):
+        deployment = get_object_or_404(models.Deployment.objects.lightweight(), pk=int(kwargs['pk']))
 
-        if special_options:
-            for key in special_options:
-                command.append('--' + get_key_value_string(command_to_config[key], config[key]))
+        hosts = [serialize_deployment_host(host) for host in deployment.hosts.all()]
 
-        command.append('--fabfile={}'.format(get_fabfile_path(self.object.stage.project)))
+        return HttpResponse(json.dumps({'deployment': deployment.pk, 'status': deployment.status, 'hosts': hosts}),
+                            content_type='application/json')
 
-        print command
 
-        return command
+class DeploymentHostDetail(DetailView):
+    """
+    The output of a deployment on a single host. Add ?format=json for the JSON version.
+    """
+    model = models.DeploymentHost
 
-    def output_stream_generator(self):
-        if self.object.task.name not in get_fabric_tasks(self.request, self.object.stage.project):
-            return
+    def get_object(self, queryset=None):
+        return get_object_or_404(models.DeploymentHost.objects.select_related('deployment__stage__project'),
+                                 deployment_id=int(self.kwargs['pk']), host=self.kwargs['host'])
 
-        try:
-            process = subprocess.Popen(self.build_command(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    def get_context_data(self, **kwargs):
+        context = super(DeploymentHostDetail, self).get_context_data(**kwargs)
+
+        context['deployment'] = self.object.deployment
+        context['output'] = self.object.get_output()
 
-            all_output = ''
-            while True:
-                nextline = process.stdout.readline()
-                if nextline == '' and process.poll() != None:
-                    break
+        return context
 
-                all_output += nextline
+    def render_to_response(self, context, **response_kwargs):
+        if self.request.GET.get('format') == 'json':
+            data = serialize_deployment_host(self.object)
+            data['output'] = context['output']
+
+            return HttpResponse(json.dumps(data), content_type='application/json')
+
+        return super(DeploymentHostDetail, self).render_to_response(context, **response_kwargs)
+
+
+class DeploymentOutputStream(View):
+    """
+    Runs a pending deployment (or follows the worker already running it) and streams its output to an iframe.
 
-                yield '<span style="color:rgb(200, 200, 200);font-size: 14px;font-family: \'Helvetica Neue\', Helvetica, Arial, sans-serif;">{} </span><br /> {}'.format(nextline, ' '*1024)
-                sys.stdout.flush()
+    The deployment runs in this request's thread through ``streaming.run_deployment``, the same way socket.io and
+    the gateway run it, and carries on to the end if the browser goes away. Nobody can answer fab's prompts from
+    here, so it aborts on them.
+    """
 
-            self.object.status = self.object.SUCCESS if process.returncode == 0 else self.object.FAILED
+    def format_output(self, text):
+        return '<span style="color:rgb(200, 200, 200);font-size: 14px;font-family: \'Helvetica Neue\', Helvetica, Arial, sans-serif;">{} </span><br /> {}'.format(text, ' '*1024)
 
-            yield '<span id="finished" style="display:none;">{}</span> {}'.format(self.object.status, ' '*1024)
+    def format_finished(self, status):
+        return '<span id="finished" style="display:none;">{}</span> {}'.format(status, ' '*1024)
 
-            self.object.output = all_output
+    def output_stream_generator(self):
+        # A planned deployment had its task checked when it was created
+        planned = models.DeploymentPlan.objects.filter(deployment=self.object).exists()
+        if not planned and self.object.task.name not in get_fabric_tasks(self.request, self.object.stage.project):
+            self.object.status = self.object.FAILED
             self.object.save()
 
-        except Exception as e:
-            message = "An error occurred: " + e.message
-            yield '<span style="color:rgb(200, 200, 200);font-size: 14px;font-family: \'Helvetica Neue\', Helvetica, Arial, sans-serif;">{} </span><br /> {}'.format(message, ' '*1024)
-            yield '<span id="finished" style="display:none;">failed</span> {}'.format('*1024')
+            yield self.format_finished(self.object.FAILED)
+            return
+
+        for event in run_deployment(self.object, self.request.session.get('configuration_values', {})):
+            if 'lines' in event:
+                yield self.format_output(event['lines'])
+            else:
+                yield self.format_finished(event['status'])
 
     def get(self, request, *args, **kwargs):
-        self.object = get_object_or_404(models.Deployment, pk=int(kwargs['pk']), status=models.Deployment.PENDING)
+        self.object = get_object_or_404(models.Deployment.objects.select_related('stage', 'task'),
+                                        pk=int(kwargs['pk']), status=models.Deployment.PENDING)
         resp = StreamingHttpResponse(self.output_stream_generator())
         return resp
 
@@ -473,13 +605,16 @@ class ProjectStageUpdate(MultipleGroupRequiredMixin, UpdateView):
     form_class = forms.StageUpdateForm
 
 
-class ProjectStageView(DetailView):
+class ProjectStageView(FragmentCacheMixin, DetailView):
     """
     Display the details on a project stage: List Hosts, Configurations, and Tasks available to run
     """
 
     model = models.Stage
 
+    def get_fragment_generation(self):
+        return models.get_project_generation(self.object.project_id)
+
     def get_context_data(self, **kwargs):
 
         context = super(ProjectStageView, self).get_context_data(**kwargs)
@@ -487,21 +622,31 @@ class ProjectStageView(DetailView):
         # Hosts Table (Stage->Host Through table)
         stage_hosts = self.object.hosts.all()
 
-        host_table = tables.StageHostTable(stage_hosts, stage_id=self.object.pk)  # Through table
-        RequestConfig(self.request).configure(host_table)
-        context['hosts'] = host_table
+        # The tables are only built for fragments that aren't cached
+        def get_host_table():
+            host_table = tables.StageHostTable(stage_hosts, stage_id=self.object.pk)  # Through table
+            RequestConfig(self.request).configure(host_table)
+            return host_table
+
+        context['hosts'] = lazy_context(get_host_table)
 
-        context['available_hosts'] = Host.objects.exclude(id__in=[host.pk for host in stage_hosts]).all()
+        context['available_hosts'] = Host.objects.exclude(id__in=stage_hosts.values('pk'))
 
         # Configuration Table
-        configuration_table = tables.ConfigurationTable(self.object.stage_configurations())
-        RequestConfig(self.request).configure(configuration_table)
-        context['configurations'] = configuration_table
+        def get_configuration_table():
+            configuration_table = tables.ConfigurationTable(self.object.stage_configurations())
+            RequestConfig(self.request).configure(configuration_table)
+            return configuration_table
+
+        context['configurations'] = lazy_context(get_configuration_table)
 
         #deployment table
-        deployment_table = tables.DeploymentTable(models.Deployment.objects.filter(stage=self.object).select_related('stage', 'task'), prefix='deploy_')
-        RequestConfig(self.request).configure(deployment_table)
-        context['deployment_table'] = deployment_table
+        def get_deployment_table():
+            deployment_table = tables.DeploymentTable(models.Deployment.objects.lightweight().filter(stage=self.object).select_related('stage', 'task'), prefix='deploy_')
+            RequestConfig(self.request).configure(deployment_table)
+            return deployment_table
+
+        context['deployment_table'] = lazy_context(get_deployment_table)
 
         return context
 